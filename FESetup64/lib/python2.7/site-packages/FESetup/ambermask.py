@@ -0,0 +1,499 @@
+#  Copyright (C) 2016  Hannes H Loeffler
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  For full details of the license please see the COPYING file
+#  that should have come with this distribution.
+
+r"""
+Vectorised evaluation of AMBER masks.
+
+Drop-in replacement for parmed.amber.mask.AmberMask.  All per-atom
+properties needed for selections are converted once into NumPy arrays and
+each mask token is evaluated as a boolean array operation instead of a loop
+over all atoms.  Distance operators (<:, >:, <@, >@) follow parmed; the
+< operators use a KD-tree when SciPy is available.
+
+Supported syntax: residue names/numbers (:), atom names/numbers (@), atom
+types (@%), elements (@/), wildcards (*, = and ?), ranges (1-10), the
+logical operators !, &, | and parentheses.
+"""
+
+__revision__ = "$Id$"
+
+
+
+import re
+
+import numpy as np
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+from FESetup import errors
+
+
+
+_SPECIAL = '()&|!<>'
+_NUMBER_RANGE = re.compile(r'^(\d+)(?:-(\d+))?$')
+_DIST_OP = re.compile(r'^([<>])([:@])(\d*\.?\d+(?:[eE][-+]?\d+)?)')
+_CHUNK_SIZE = 2048
+
+
+class MaskTables(object):
+    """
+    Per-atom lookup arrays of a parmtop as needed for mask evaluation.
+    Create once per topology and pass to AmberMask to avoid repeated setup.
+    """
+
+    def __init__(self, parm, coords = None):
+        """
+        :param parm: the topology
+        :type parm: parmed.amber.AmberParm
+        :param coords: optional coordinates for distance based selections,
+                       if not given the coordinates of parm are used (if any)
+        :type coords: Nx3 or flat array-like
+        """
+
+        data = parm.parm_data
+
+        self.natom = len(data['ATOM_NAME'])
+        self.nres = len(data['RESIDUE_LABEL'])
+
+        res_start = np.array(data['RESIDUE_POINTER'], dtype=np.int64) - 1
+        res_len = np.diff(np.append(res_start, self.natom) )
+
+        self.res_of_atom = np.repeat(np.arange(self.nres), res_len)
+        self.res_start = res_start
+
+        self.atom_names = _names(data['ATOM_NAME'])
+        self.res_names = _names(data['RESIDUE_LABEL'])
+        self.atom_types = _names(data['AMBER_ATOM_TYPE'])
+
+        if 'ATOMIC_NUMBER' in data:
+            self.atomic_numbers = np.array(data['ATOMIC_NUMBER'],
+                                           dtype=np.int64)
+        else:
+            self.atomic_numbers = None
+
+        if coords is None:
+            coords = getattr(parm, 'coordinates', None)
+
+            if coords is None:
+                coords = getattr(parm, 'coords', None)
+
+        if coords is not None:
+            coords = _check_coords(coords, self.natom)
+
+        self.coords = coords
+
+
+class AmberMask(object):
+    """
+    AMBER mask evaluated with NumPy boolean arrays.  API compatible with
+    parmed.amber.mask.AmberMask.
+    """
+
+    def __init__(self, parm, mask, coords = None):
+        """
+        :param parm: the topology or precomputed lookup tables
+        :type parm: parmed.amber.AmberParm or MaskTables
+        :param mask: AMBER mask
+        :type mask: string
+        :param coords: optional coordinates for distance based selections
+        :type coords: Nx3 or flat array-like
+        """
+
+        if isinstance(parm, MaskTables):
+            self.tables = parm
+        else:
+            self.tables = MaskTables(parm, coords)
+
+        # the tables may be shared, so coordinates are kept per mask
+        if coords is not None:
+            self.coords = _check_coords(coords, self.tables.natom)
+        else:
+            self.coords = self.tables.coords
+
+        self.mask = mask.strip()
+        self._selection = None
+
+
+    @property
+    def selection(self):
+        """The selection as boolean array over all atoms."""
+
+        if self._selection is None:
+            tokens = _tokenize(self.mask)
+
+            if not tokens:
+                self._selection = np.zeros(self.tables.natom, dtype=bool)
+            else:
+                parser = _Parser(tokens, self.tables, self.coords)
+                self._selection = parser.parse()
+
+        return self._selection
+
+
+    def Selection(self, invert = False):
+        """
+        :param invert: invert the selection
+        :type invert: bool
+        :returns: list of 0/1 flags for every atom
+        """
+
+        sel = self.selection
+
+        if invert:
+            sel = ~sel
+
+        return sel.astype(int).tolist()
+
+
+    def Selected(self, invert = False):
+        """
+        :param invert: invert the selection
+        :type invert: bool
+        :returns: generator over the (0-based) indexes of selected atoms
+        """
+
+        for idx in self.indexes(invert):
+            yield int(idx)
+
+
+    def indexes(self, invert = False):
+        """
+        :param invert: invert the selection
+        :type invert: bool
+        :returns: (0-based) indexes of selected atoms
+        :rtype: numpy.ndarray
+        """
+
+        sel = self.selection
+
+        if invert:
+            sel = ~sel
+
+        return np.flatnonzero(sel)
+
+
+def _check_coords(coords, natom):
+    """Convert coordinates to an Nx3 array and check the number of atoms."""
+
+    coords = np.asarray(coords, dtype=np.float64)
+
+    if coords.size != 3 * natom:
+        raise errors.SetupError('number of coordinates (%i) does not match '
+                                'number of atoms (%i)' %
+                                (coords.size // 3, natom) )
+
+    return coords.reshape(natom, 3)
+
+
+def _names(seq):
+    """Convert a list of names into a NumPy string array."""
+
+    return np.array([str(s).strip() for s in seq])
+
+
+def _pattern(name):
+    """Translate an AMBER name with wildcards into a regular expression."""
+
+    regex = []
+
+    for char in name:
+        if char == '*' or char == '=':
+            regex.append('.*')
+        elif char == '?':
+            regex.append('.')
+        else:
+            regex.append(re.escape(char) )
+
+    return re.compile('^' + ''.join(regex) + '$')
+
+
+def _match_names(names, items):
+    """
+    Match a list of names/patterns against a name array.  Patterns are only
+    applied to the unique names, so this scales with the number of distinct
+    names rather than the number of atoms.
+    """
+
+    uniq, inverse = np.unique(names, return_inverse=True)
+    hit = np.zeros(len(uniq), dtype=bool)
+
+    for item in items:
+        if '*' in item or '=' in item or '?' in item:
+            regex = _pattern(item)
+            hit |= np.array([regex.match(u) is not None for u in uniq],
+                            dtype=bool)
+        else:
+            hit |= (uniq == item)
+
+    return hit[inverse]
+
+
+def _match_list(spec, names, nitems):
+    """
+    Evaluate a comma separated list of numbers, number ranges and names.
+
+    :returns: boolean array over nitems
+    """
+
+    sel = np.zeros(nitems, dtype=bool)
+    pos = np.arange(1, nitems + 1)
+    patterns = []
+
+    for item in spec.split(','):
+        item = item.strip()
+
+        if not item:
+            continue
+
+        m = _NUMBER_RANGE.match(item)
+
+        if m:
+            first = int(m.group(1) )
+            last = int(m.group(2) ) if m.group(2) else first
+            sel |= (pos >= first) & (pos <= last)
+        else:
+            patterns.append(item)
+
+    if patterns:
+        sel |= _match_names(names, patterns)
+
+    return sel
+
+
+def _tokenize(mask):
+    """Split an AMBER mask into operators, distance criteria and selectors."""
+
+    tokens = []
+    i = 0
+    n = len(mask)
+
+    while i < n:
+        char = mask[i]
+
+        if char.isspace():
+            i += 1
+        elif char in '<>':
+            m = _DIST_OP.match(mask[i:])
+
+            if not m:
+                raise errors.SetupError('malformed distance operator in mask '
+                                        '"%s"' % mask)
+
+            tokens.append( ('dist', (m.group(1), m.group(2),
+                                     float(m.group(3) ) ) ) )
+            i += len(m.group(0) )
+        elif char in _SPECIAL:
+            tokens.append( ('op', char) )
+            i += 1
+        else:
+            j = i
+
+            while j < n and not mask[j].isspace() and mask[j] not in _SPECIAL:
+                j += 1
+
+            tokens.append( ('sel', mask[i:j]) )
+            i = j
+
+    return tokens
+
+
+class _Parser(object):
+    """
+    Recursive descent parser evaluating the mask on the fly.  Operator
+    precedence follows ambmask: distance > ! > & > |.
+    """
+
+    def __init__(self, tokens, tables, coords):
+        self.tokens = tokens
+        self.tables = tables
+        self.coords = coords
+        self.pos = 0
+
+
+    def parse(self):
+        sel = self._or()
+
+        if self.pos != len(self.tokens):
+            raise errors.SetupError('unexpected token "%s" in mask' %
+                                    str(self.tokens[self.pos][1]) )
+
+        return sel
+
+
+    def _peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+
+        return (None, None)
+
+
+    def _or(self):
+        sel = self._and()
+
+        while self._peek() == ('op', '|'):
+            self.pos += 1
+            sel = sel | self._and()
+
+        return sel
+
+
+    def _and(self):
+        sel = self._not()
+
+        while self._peek() == ('op', '&'):
+            self.pos += 1
+            sel = sel & self._not()
+
+        return sel
+
+
+    def _not(self):
+        if self._peek() == ('op', '!'):
+            self.pos += 1
+            return ~self._not()
+
+        return self._dist()
+
+
+    def _dist(self):
+        sel = self._primary()
+
+        while self._peek()[0] == 'dist':
+            sel = _distance(self.tables, self.coords, sel, *self._peek()[1])
+            self.pos += 1
+
+        return sel
+
+
+    def _primary(self):
+        kind, value = self._peek()
+
+        if kind == 'op' and value == '(':
+            self.pos += 1
+            sel = self._or()
+
+            if self._peek() != ('op', ')'):
+                raise errors.SetupError('unbalanced parentheses in mask')
+
+            self.pos += 1
+
+            return sel
+
+        if kind == 'sel':
+            self.pos += 1
+            return _select(self.tables, value)
+
+        raise errors.SetupError('unexpected token "%s" in mask' % str(value) )
+
+
+def _select(tables, spec):
+    """Evaluate a single :residue@atom selector."""
+
+    if spec == '*':
+        return np.ones(tables.natom, dtype=bool)
+
+    if spec[0] == ':':
+        res_spec, _, atom_spec = spec[1:].partition('@')
+        has_atom = '@' in spec
+
+        res_sel = _match_list(res_spec, tables.res_names, tables.nres)
+        sel = res_sel[tables.res_of_atom]
+
+        if has_atom:
+            sel &= _select_atoms(tables, atom_spec)
+
+        return sel
+    elif spec[0] == '@':
+        return _select_atoms(tables, spec[1:])
+
+    raise errors.SetupError('invalid mask selector "%s"' % spec)
+
+
+def _select_atoms(tables, spec):
+    """Evaluate the atom part of a selector (names, numbers, types, elements)."""
+
+    if spec.startswith('%'):
+        items = [s.strip() for s in spec[1:].split(',') if s.strip()]
+
+        return _match_names(tables.atom_types, items)
+    elif spec.startswith('/'):
+        if tables.atomic_numbers is None:
+            raise errors.SetupError('element selection requires '
+                                    'ATOMIC_NUMBER in topology')
+
+        from parmed.periodic_table import Element
+
+        symbols = np.array([Element[z] if 0 <= z < len(Element) else 'EP'
+                            for z in tables.atomic_numbers])
+        items = [s.strip().capitalize() for s in spec[1:].split(',')
+                 if s.strip()]
+
+        return _match_names(symbols, items)
+
+    return _match_list(spec, tables.atom_names, tables.natom)
+
+
+def _distance(tables, coords, ref_sel, op, level, cutoff):
+    """
+    Select atoms (@) or whole residues (:) closer (<) or farther (>) than
+    cutoff from the atoms in ref_sel.  Same semantics as _selectDistd in
+    parmed: comparisons are strict, < selects an atom if any reference atom is
+    closer than cutoff, > if any reference atom is farther than cutoff.  A
+    residue is selected if any of its atoms is.
+    """
+
+    if coords is None:
+        raise errors.SetupError('distance based mask requires coordinates')
+
+    ref = coords[ref_sel]
+    sel = np.zeros(tables.natom, dtype=bool)
+
+    if not len(ref):
+        return sel
+
+    if op == '<' and cKDTree:
+        # upper bound is exclusive in cKDTree
+        dist, _ = cKDTree(ref).query(coords, k=1,
+                                     distance_upper_bound=cutoff)
+        sel = dist < cutoff
+    else:
+        cut2 = cutoff * cutoff
+
+        for start in range(0, tables.natom, _CHUNK_SIZE):
+            block = coords[start:start + _CHUNK_SIZE]
+
+            for rstart in range(0, len(ref), _CHUNK_SIZE):
+                diff = block[:, np.newaxis, :] - \
+                       ref[np.newaxis, rstart:rstart + _CHUNK_SIZE, :]
+                d2 = np.einsum('ijk,ijk->ij', diff, diff)
+
+                if op == '<':
+                    sel[start:start + _CHUNK_SIZE] |= (d2 < cut2).any(axis=1)
+                else:
+                    sel[start:start + _CHUNK_SIZE] |= (d2 > cut2).any(axis=1)
+
+    if level == ':':
+        res_sel = np.zeros(tables.nres, dtype=bool)
+        res_sel[tables.res_of_atom[sel]] = True
+        sel = res_sel[tables.res_of_atom]
+
+    return sel
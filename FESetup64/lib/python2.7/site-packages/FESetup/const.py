@@ -29,8 +29,6 @@ __revision__ = "$Id: const.py 648 2017-04-03 12:25:56Z halx $"
 
 import os
 
-import Sire.Units
-
 
 
 AMBER_BIN_PATH = ''
@@ -83,6 +81,7 @@ GB_FRCMOD_FILE = GB_PREFIX + os.extsep + 'frcmod'
 LIGAND_FRCMOD_FILE = 'ligand.frcmod'
 OFF_FILE = 'ligand.off'
 GAFF_MOL2_FILE = 'gaff.mol2'
+COMPLEX_MOL2_FILE = 'ligand_complex.mol2'
 
 DUMMY_TYPE = 'du'
 
@@ -95,17 +94,22 @@ PROTEIN_WORKDIR = '_proteins'
 COMPLEX_WORKDIR = '_complexes'
 MORPH_WORKDIR = '_perturbations'
 
+# finished morph directories, one per line, appended as they are completed
+MORPH_DONE_FILE = 'morphs.done'
+
 PROTEIN_FLEX_FILE = 'protein.flex'
 LIGAND_FLEX_FILE = 'ligand.flex'
 
-BASE_DIHEDRALRING_FLEX = 2.5 * Sire.Units.degrees
-BASE_DIHEDRAL_FLEX = 30.0 * Sire.Units.degrees
-BASE_ANGLERING_FLEX = 0.10 * Sire.Units.degrees
-BASE_ANGLE_FLEX = 0.25 * Sire.Units.degrees
-BASE_BONDRING_FLEX = 0.020 * Sire.Units.angstrom
-BASE_BOND_FLEX = 0.025 * Sire.Units.angstrom
-BASE_TRANSLATION = 0.5 * Sire.Units.angstrom
-BASE_ROTATION = 30.0 * Sire.Units.degrees
+# flexibility in degrees and angstrom, units applied in ligutil.flex() so
+# that Sire is not imported with the constants
+BASE_DIHEDRALRING_FLEX = 2.5
+BASE_DIHEDRAL_FLEX = 30.0
+BASE_ANGLERING_FLEX = 0.10
+BASE_ANGLE_FLEX = 0.25
+BASE_BONDRING_FLEX = 0.020
+BASE_BOND_FLEX = 0.025
+BASE_TRANSLATION = 0.5
+BASE_ROTATION = 30.0
 BASE_MAXVAR = 10
 BASE_MAXBONDVAR = 5
 BASE_MAXANGLEVAR = 5
@@ -151,7 +151,8 @@ class DataDict(dict):
         self.data = data
 
 
-    def add_files(self, files, hash_type='sha1', compression_type='bz2'):
+    def add_files(self, files, hash_type='sha1', compression_type='bz2',
+                  basedir=''):
         """
         Add a list of files to an internal tar(pax) archive.  A manifest is
         automatically created and contains the hashes of every file.  Hashes
@@ -165,6 +166,8 @@ class DataDict(dict):
         :type hash_type: string
         :param compression_type: the compression type (gz or bz2)
         :type compression_type: string
+        :param basedir: directory the file names are relative to
+        :type basedir: string
         """
         
         memtar = cStringIO.StringIO()
@@ -175,16 +178,17 @@ class DataDict(dict):
                           fileobj = memtar) as tar:
 
             for name in files:
-                tinfo = tar.gettarinfo(name)
+                path = os.path.join(basedir, name)
+                tinfo = tar.gettarinfo(path, arcname=name)
                 hash_val = hashlib.new(hash_type)
 
-                with open(name, 'rb') as member:
+                with open(path, 'rb') as member:
                     hash_val.update(member.read())
 
                 hexdig = hash_val.hexdigest()
 
                 tinfo.pax_headers = {'comment': hexdig}
-                tar.addfile(tinfo, open(name, 'rb'))
+                tar.addfile(tinfo, open(path, 'rb'))
 
                 manifest.append('%s  %s\n' % (hexdig, name) )
 
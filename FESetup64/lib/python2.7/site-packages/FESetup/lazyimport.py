@@ -0,0 +1,86 @@
+#  Copyright (C) 2016  Hannes H Loeffler
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  For full details of the license please see the COPYING file
+#  that should have come with this distribution.
+
+r"""
+Lazy module imports.  The chemistry toolkits (Sire, OpenBabel, RDKit,
+ParmEd) take seconds to import.  A LazyModule stands in for a module at
+module level and only imports it on first attribute access, so they are
+only loaded when a stage actually needs them.
+"""
+
+__revision__ = "$Id$"
+
+
+
+import importlib
+import warnings
+
+
+
+class LazyModule(object):
+    """
+    Proxy for a module which is imported on first attribute access.
+    Submodules not imported by the package itself, e.g. Sire.IO, are
+    imported on access too.
+    """
+
+    __slots__ = ('_name', '_ignore', '_module')
+
+    def __init__(self, name, ignore=''):
+        """
+        :param name: full name of the module
+        :type name: string
+        :param ignore: regular expression of warning messages to be ignored
+                       during import
+        :type ignore: string
+        """
+
+        self._name = name
+        self._ignore = ignore
+        self._module = None
+
+
+    def _load(self):
+        if self._module is None:
+            with warnings.catch_warnings():
+                if self._ignore:
+                    warnings.filterwarnings('ignore', self._ignore)
+
+                self._module = importlib.import_module(self._name)
+
+        return self._module
+
+
+    def __getattr__(self, attr):
+        module = self._load()
+
+        try:
+            return getattr(module, attr)
+        except AttributeError:
+            try:
+                return importlib.import_module(self._name + '.' + attr)
+            except ImportError:
+                raise AttributeError("module '%s' has no attribute '%s'" %
+                                     (self._name, attr) )
+
+
+    def __repr__(self):
+        state = 'loaded' if self._module else 'not loaded'
+
+        return '<lazy module %s (%s)>' % (self._name, state)
@@ -87,18 +87,21 @@ class ModelConfig(DataDict):
         self.files = set()
 
 
-    def write(self, filename):
+    def write(self, filename, basedir=''):
         """
         Write out this class into a dictionary plus compressed file archive.
 
         :param filename: the file name
         :type filename: string
+        :param basedir: directory the archived file names are relative to
+        :type basedir: string
         """
 
         if self.files:
             self['data.hash'] = self.add_files(self.files,
                                                self['data.hash_type'],
-                                               self['data.compression_type'])
+                                               self['data.compression_type'],
+                                               basedir)
         self['timestamp'] = time.ctime()
 
         self.check_keys()
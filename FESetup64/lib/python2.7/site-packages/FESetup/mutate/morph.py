@@ -33,6 +33,8 @@ import os
 import re
 import shutil
 
+import numpy as np
+
 from FESetup import const, errors, logger, report
 from . import util
 
@@ -45,12 +47,102 @@ COMPAT_TABLE = {'Sire': 'pertfile', 'AMBER': 'sander/dummy',
 WD_TABLE = {'pertfile': 'sire'}
 
 
+def _fe_type(FE_type):
+    """
+    Split a free energy type into topology backend, sub type and the name of
+    the output directory.
+
+    :param FE_type: the free energy type, e.g. Sire or AMBER/softcore
+    :type FE_type: str
+    :returns: backend, sub type, directory name
+    """
+
+    try:
+        FE_type = COMPAT_TABLE[FE_type]
+    except KeyError:
+        pass
+
+    tmp_FE_type = FE_type.split('/')
+    backend = tmp_FE_type[0]
+
+    # FIXME: cleanup
+    if backend == 'Sire':
+        backend = 'pertfile'
+
+    if len(tmp_FE_type) > 1:
+        sub_type = tmp_FE_type[1]
+    else:
+        sub_type = ''
+
+    try:
+        type_dir = WD_TABLE[backend]
+    except KeyError:
+        type_dir = FE_type.replace('/', '-')
+
+    # FIXME: kludge
+    type_dir = re.sub('\d$', '', type_dir)
+
+    return backend, sub_type, type_dir
+
+
+def _vacuum_ligand(ligand, topdir):
+    """
+    Read the vacuum model of a ligand.
+
+    :param ligand: the ligand
+    :type ligand: Ligand
+    :param topdir: top level directory
+    :type topdir: str
+    :raises: SetupError
+    :returns: the ligand, assumed to be the first molecule in the files
+    :rtype: Sire.Mol.Molecule
+    """
+
+    lig_dir = os.path.join(topdir, const.LIGAND_WORKDIR, ligand.mol_name)
+
+    top = os.path.join(lig_dir, 'vacuum' + ligand.TOP_EXT)
+    crd = os.path.join(lig_dir, 'vacuum' + ligand.RST_EXT)
+
+    amber = Sire.IO.Amber()
+
+    try:
+        molecules = amber.readCrdTop(crd, top)[0]
+    except UserWarning as error:
+        raise errors.SetupError('error opening %s/%s: %s' %
+                                (crd, top, error) )
+
+    nmol = molecules.molNums()
+    nmol.sort()
+
+    return molecules.at(nmol[0]).molecule()
+
+
+def series_core(ligands, mcs_timeout=60.0):
+    """
+    Compute the common core of all ligands of a series once.  The core
+    seeds the MCSS of each morph pair, see Morph.
+
+    :param ligands: the ligands
+    :type ligands: list of Ligand
+    :param mcs_timeout: timeout for the MCSS in seconds
+    :type mcs_timeout: float
+    :raises: SetupError
+    :returns: SMARTS of the core, empty if there is none
+    :rtype: str
+    """
+
+    topdir = os.getcwd()
+    molecules = [_vacuum_ligand(ligand, topdir) for ligand in ligands]
+
+    return util.common_core(molecules, mcs_timeout)
+
+
 class Morph(object):
     """The morphing class."""
 
     def __init__(self, initial, final, workdir1, workdir2, forcefield,
                  FE_type='pertfile', separate=True, mcs_timeout=60.0,
-                 mcs_sel='', gaff='gaff'):
+                 mcs_sel='', gaff='gaff', mcs_seed='', mcs_portfolio=False):
         """
         :param initial: the initial state of the morph pair
         :type initial: either Ligand or Complex
@@ -62,29 +154,29 @@ class Morph(object):
         :type workdir2: string
         :param forcefield: force field details
         :type forcefield: ForceField
-        :param FE_type: the free energy type
-        :type FE_type: str
+        :param FE_type: the free energy type or several comma separated
+           types which all share mapping and morph molecule, each written to
+           its own directory
+        :type FE_type: str or list of str
         :param separate: separate vdw from Coulomb lambda
         :type separate: bool
+        :param mcs_seed: SMARTS of the series core, see series_core()
+        :type mcs_seed: str
+        :param mcs_portfolio: run several MCSS variants concurrently
+        :type mcs_portfolio: bool
         :raises: SetupError
         """
 
-        try:
-            FE_type = COMPAT_TABLE[FE_type]
-        except KeyError:
-            pass
+        if isinstance(FE_type, basestring):
+            FE_type = FE_type.split(',')
 
-        tmp_FE_type = FE_type.split('/')
-        self.FE_type = tmp_FE_type[0]
+        types = [_fe_type(fe_type.strip()) for fe_type in FE_type
+                 if fe_type.strip()]
 
-        # FIXME: cleanup
-        if self.FE_type == 'Sire':
-            self.FE_type = 'pertfile'
+        if not types:
+            raise errors.SetupError('no free energy type given')
 
-        if len(tmp_FE_type) > 1:
-            self.FE_sub_type = tmp_FE_type[1]
-        else:
-            self.FE_sub_type = ''
+        self.FE_type, self.FE_sub_type = types[0][:2]
 
         self.separate = separate
 
@@ -97,25 +189,30 @@ class Morph(object):
 
         self.name = initial.mol_name + const.MORPH_SEP + final.mol_name
 
-        try:
-            type_dir = WD_TABLE[self.FE_type]
-        except KeyError:
-            type_dir = FE_type.replace('/', '-')
+        # backend, sub type and output directory of each free energy type,
+        # the first one is the primary, types listed twice are set up once
+        self.targets = []
 
-        # FIXME: kludge
-        type_dir = re.sub('\d$', '', type_dir)
+        for backend, sub_type, type_dir in types:
+            dst = os.path.join(self.topdir, const.MORPH_WORKDIR, type_dir,
+                               self.name)
 
-        self.dst = os.path.join(self.topdir, const.MORPH_WORKDIR, type_dir,
-                                self.name)
+            if dst in [target[2] for target in self.targets]:
+                continue
 
-        try:
-            if not os.access(self.dst, os.F_OK):
-                logger.write('Creating directory %s' % self.dst)
-                os.makedirs(self.dst)
-        except OSError as why:
-            raise errors.SetupError(why)
+            try:
+                if not os.access(dst, os.F_OK):
+                    logger.write('Creating directory %s' % dst)
+                    os.makedirs(dst)
+            except OSError as why:
+                raise errors.SetupError(why)
+
+            self.targets.append( (backend, sub_type, dst) )
+
+        self.dst = self.targets[0][2]
 
         self.topol = None
+        self.topols = []
 
         self.initial = initial
         self.final = final
@@ -140,34 +237,33 @@ class Morph(object):
         self.con_morph = None
         self.connect_final = None
         self.dummy_idx = []
+        self.dummy_recipe = []
+        self.ref_idx = None
 
         self.files_created = []
 
         self.mcs_timeout = mcs_timeout
         self.mcs_sel = mcs_sel
+        self.mcs_seed = mcs_seed
+        self.mcs_portfolio = mcs_portfolio
 
 
-    # context manager used to keep track of directory changes
+    # context manager kept for scripts, all files are written to explicit
+    # paths so the current directory is never changed
     def __enter__(self):
-        """Enter directory dst."""
-
-        logger.write('Entering %s' % self.dst)
-        os.chdir(self.dst)
+        """Start the morph."""
 
         return self
 
 
     def __exit__(self, typ, value, traceback):
-        """Leave directory dst and return to topdir."""
-
-        logger.write('Entering %s\n' % self.topdir)
-        os.chdir(self.topdir)
+        """Finish the morph."""
 
         return
 
 
     @report
-    def setup(self, cmd1, cmd2, basedir, isotope_map={}):
+    def setup(self, cmd1, cmd2, basedir, isotope_map={}, index_map=None):
         """
         Compute the atom mapping based on MCSS calculations.  Find dummy
         atoms. Set up parameters and connectivities for create_coord().  Create
@@ -175,48 +271,14 @@ class Morph(object):
 
         *Must* be first method called to properly setup Morph object.
 
+        :param index_map: inverted index map of the reverse morph, see
+           reverse_index_map(), skips the MCSS unless the user supplied a map
+        :type index_map: dict
         :raises: SetupError
         """
 
-        initial_dir = os.path.join(self.topdir, const.LIGAND_WORKDIR,
-                                   self.initial.mol_name)
-        final_dir = os.path.join(self.topdir, const.LIGAND_WORKDIR,
-                                 self.final.mol_name)
-
-        system = 'vacuum'
-
-        initial_top = os.path.join(initial_dir,
-                                   system + self.initial.TOP_EXT)
-        initial_crd = os.path.join(initial_dir,
-                                   system + self.initial.RST_EXT)
-
-        final_top = os.path.join(final_dir, system + self.final.TOP_EXT)
-        final_crd = os.path.join(final_dir, system + self.final.RST_EXT)
-
-        amber = Sire.IO.Amber()
-        try:
-            molecules_initial = amber.readCrdTop(initial_crd, initial_top)[0]
-        except UserWarning as error:
-            raise errors.SetupError('error opening %s/%s: %s' %
-                                    (initial_crd, initial_top, error) )
-
-        nmol_i = molecules_initial.molNums()
-        nmol_i.sort()
-
-        # we make the assumption that the ligand is the first mol in the
-        # top/crd
-        lig_initial = molecules_initial.at(nmol_i[0]).molecule()
-
-        try:
-            molecules_final = amber.readCrdTop(final_crd, final_top)[0]
-        except UserWarning as error:
-            raise errors.SetupError('error opening %s/%s: %s' %
-                                    (final_crd, final_top, error) )
-
-        nmol_f = molecules_final.molNums()
-        nmol_f.sort()
-
-        lig_final = molecules_final.at(nmol_f[0]).molecule()
+        lig_initial = _vacuum_ligand(self.initial, self.topdir)
+        lig_final = _vacuum_ligand(self.final, self.topdir)
 
         # user tagging mechanism as per feature request #1074
         if not isotope_map:
@@ -227,10 +289,12 @@ class Morph(object):
 
         if isotope_map:
             logger.write('User supplied tagging map: %s' % isotope_map)
+            index_map = None
 
         (lig_morph, self.atom_map, self.reverse_atom_map) = \
                     util.map_atoms(lig_initial, lig_final, self.mcs_timeout,
-                                   isotope_map, self.mcs_sel)
+                                   isotope_map, self.mcs_sel, index_map,
+                                   self.mcs_seed, self.mcs_portfolio, self.dst)
 
         self.files_created.append(const.MCS_MAP_FILE)
 
@@ -243,6 +307,10 @@ class Morph(object):
 
         self.dummy_idx = [inf.index for inf in self.atom_map if not inf.atom]
 
+        # morph atoms taking their coordinates from the initial state
+        self.ref_idx = np.array([inf.index.value() for inf in self.atom_map
+                                 if inf.atom], dtype=int)
+
         atoms_initial = lig_initial.atoms()
         atoms_final = lig_final.atoms()
 
@@ -250,34 +318,39 @@ class Morph(object):
                 util.parm_conn(lig_morph, atoms_initial, lig_initial, lig_final,
                                self.atom_map, self.reverse_atom_map)
 
-        lig_morph, lig_initial, lig_final, self.zz_atoms = \
-                util.dummy_coords(lig_morph, con_morph, atoms_initial,
-                                  lig_initial, lig_final, self.atom_map,
-                                  self.reverse_atom_map, connect_final,
-                                  self.zz_atoms, self.dummy_idx)
-
-        logger.write('\nWriting perturbed topology for %s%s\n' %
-                     (self.FE_type, '/' + self.FE_sub_type if self.FE_sub_type
-                      else '') )
-
-        try:
-            topol = __import__('topol.' + self.FE_type, globals(), locals(),
-                               ['*'], -1)
-        except ImportError as detail:
-            sys.exit('Error: Unknown free energy type: %s' %
-                     self.FE_type)
-        except AttributeError as detail:
-            sys.exit('Error: %s\nFailed to properly initialize %s' %
-                     (detail, topol) )
-
-        topol = topol.PertTopology(self.FE_sub_type, self.separate,
-                                   self.ff, con_morph, atoms_initial,
-                                   atoms_final, lig_initial, lig_final,
-                                   self.atom_map, self.reverse_atom_map,
-                                   self.zz_atoms, self.gaff)
-
-        topol.setup(os.getcwd(), lig_morph, cmd1, cmd2)
-        self.files_created.extend(topol.files_created)
+        # the dummy build order only depends on the topology and the final
+        # state, create_coords() reapplies it to the new coordinates
+        self.dummy_recipe, self.zz_atoms = \
+                util.dummy_recipe(lig_morph, con_morph, lig_final,
+                                  self.atom_map, self.reverse_atom_map,
+                                  connect_final, self.zz_atoms,
+                                  self.dummy_idx)
+
+        lig_morph = util.place_dummies(lig_morph, self.dummy_recipe)
+
+        # all backends share the mapping and the morph molecule
+        for FE_type, FE_sub_type, dst in self.targets:
+            logger.write('\nWriting perturbed topology for %s%s\n' %
+                         (FE_type, '/' + FE_sub_type if FE_sub_type else '') )
+
+            try:
+                module = __import__('topol.' + FE_type, globals(), locals(),
+                                    ['*'], -1)
+            except ImportError as detail:
+                sys.exit('Error: Unknown free energy type: %s' % FE_type)
+            except AttributeError as detail:
+                sys.exit('Error: %s\nFailed to properly initialize %s' %
+                         (detail, FE_type) )
+
+            topol = module.PertTopology(FE_sub_type, self.separate,
+                                        self.ff, con_morph, atoms_initial,
+                                        atoms_final, lig_initial, lig_final,
+                                        self.atom_map, self.reverse_atom_map,
+                                        self.zz_atoms, self.gaff)
+
+            topol.setup(dst, lig_morph, cmd1, cmd2)
+            self.files_created.extend(topol.files_created)
+            self.topols.append(topol)
 
         self.lig_morph = lig_morph
         self.lig_initial = lig_initial
@@ -289,7 +362,26 @@ class Morph(object):
         self.con_morph = con_morph
         self.connect_final = connect_final
 
-        self.topol = topol
+        self.topol = self.topols[0]
+
+
+    def reverse_index_map(self):
+        """
+        Invert the atom mapping for the reverse morph, i.e. map atom indices
+        of the final state onto those of the initial state.  Dummies are not
+        part of the map.
+
+        :returns: index map of final to initial state
+        :rtype: dict
+        """
+
+        index_map = {}
+
+        for iinfo, finfo in self.atom_map.items():
+            if iinfo.atom and finfo.atom:
+                index_map[finfo.index.value()] = iinfo.index.value()
+
+        return index_map
 
 
     @report
@@ -320,26 +412,19 @@ class Morph(object):
         :type sys_rev_path: str
         """
 
-        os.chdir(self.dst)        # FIXME: kludge to allow non-context use
-        curr_dir = os.getcwd()
-
         if type(system) != self.ff.Complex and \
                type(system) != self.ff.Ligand:
             raise errors.SetupError('create_coord(): system must be '
                                     'either Ligand or Complex')
 
-        if not os.access(workdir, os.F_OK):
-            os.mkdir(workdir)
+        rest_pdb = os.path.join(self.dst, workdir, REST_PDB_NAME)
 
-        os.chdir(workdir)
+        if not os.access(os.path.dirname(rest_pdb), os.F_OK):
+            os.mkdir(os.path.dirname(rest_pdb) )
 
         crd = os.path.join(sys_base, system.amber_crd)
         top = os.path.join(sys_base, system.amber_top)
 
-        if system.ssbond_file and not os.path.isfile(system.ssbond_file):
-            os.symlink(os.path.join(sys_base, system.ssbond_file),
-                       system.ssbond_file)
-
         if not crd:
             raise errors.SetupError('no suitable rst7 file found')
 
@@ -386,8 +471,6 @@ class Morph(object):
 
         logger.write('Using %s for coordinate file creation' % crd)
 
-        atoms_initial = lig.atoms()
-
         # not using
         # Sire.IO.PDB().write(rest, REST_PDB_NAME)
         # because out of order and creates CONECTs for atoms > 99999
@@ -396,7 +479,7 @@ class Morph(object):
         # is in the center contrary to the prmtop which has it in one box
         # corner unless "set default nocenter on" is used (and coordinates
         # stay unmodified)
-        with open(REST_PDB_NAME, 'w') as pdb:
+        with open(rest_pdb, 'w') as pdb:
             moln = rest.molNums()
             moln.sort()
 
@@ -438,36 +521,28 @@ class Morph(object):
             pdb.write('END\n')
 
 
-        self.lig_morph = self.lig_morph.edit()
-
         # update coordinates only, everything else done already in setup()
-        for iinfo in self.atom_map:
-            if iinfo.atom:
-                try:
-                    base = atoms_initial.select(iinfo.index)
-                except UserWarning as error:     # could be "anything"...
-                    raise errors.SetupError('%s not found in reference: %s'
-                                            % (iinfo.index, error) )
-
-                coordinates = base.property('coordinates')
+        self.lig_morph = util.update_coords(self.lig_morph, lig, self.ref_idx,
+                                            self.dummy_recipe)
 
-            new = self.lig_morph.atom(iinfo.index)
-            new.setProperty('coordinates', coordinates)
+        boxdims.extend((90.0, 90.0, 90.0))
 
-            self.lig_morph = new.molecule()
+        # the coordinates are only computed once for all backends
+        for topol, (FE_type, FE_sub_type, dst) in zip(self.topols,
+                                                      self.targets):
+            path = os.path.join(dst, workdir)
 
-        self.lig_morph.commit()
+            if not os.access(path, os.F_OK):
+                os.mkdir(path)
 
-        self.lig_morph, self.lig_initial, self.lig_final, self.zz_atoms = \
-                util.dummy_coords(self.lig_morph, self.con_morph,
-                                  atoms_initial, self.lig_initial,
-                                  self.lig_final, self.atom_map,
-                                  self.reverse_atom_map, self.connect_final,
-                                  self.zz_atoms, self.dummy_idx)
+            if dst != self.dst:
+                shutil.copy(rest_pdb, os.path.join(path, REST_PDB_NAME) )
 
-        boxdims.extend((90.0, 90.0, 90.0))
+            ssbond_file = os.path.join(path, system.ssbond_file)
 
-        self.topol.create_coords(curr_dir, workdir, self.lig_morph,
-                                 REST_PDB_NAME, system, cmd1, cmd2, boxdims)
+            if system.ssbond_file and not os.path.isfile(ssbond_file):
+                os.symlink(os.path.join(sys_base, system.ssbond_file),
+                           ssbond_file)
 
-        os.chdir(curr_dir)
+            topol.create_coords(dst, workdir, self.lig_morph, REST_PDB_NAME,
+                                system, cmd1, cmd2, boxdims)
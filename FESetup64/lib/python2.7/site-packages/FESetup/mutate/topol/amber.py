@@ -26,6 +26,8 @@ pmemd or sander.
 __revision__ = "$Id$"
 
 
+import os
+
 import Sire.Mol
 import Sire.Units
 
@@ -244,7 +246,8 @@ GROUP_FILE_TEMPLATE = '''\
 '''
 
 #FIXME: one vs two topology files
-def write_mdin(atoms_initial, atoms_final, atom_map, prog, style='', vac=True):
+def write_mdin(atoms_initial, atoms_final, atom_map, prog, style='', vac=True,
+               workdir=''):
     """
     Create mdin input file(s) with proper masks.
 
@@ -260,6 +263,8 @@ def write_mdin(atoms_initial, atoms_final, atom_map, prog, style='', vac=True):
     :type prog: str
     :param vac: create vacuum input file
     :type vac: bool
+    :param workdir: directory to write the files to
+    :type workdir: str
     :raises: SetupError
     """
 
@@ -333,7 +338,8 @@ def write_mdin(atoms_initial, atoms_final, atom_map, prog, style='', vac=True):
         if prog == 'pmemd':
             tmpl = COMMON_TEMPLATE % PMEMD_TEMPLATE
 
-            with open(ONESTEP_MDIN % '', mode) as stfile:
+            with open(os.path.join(workdir, ONESTEP_MDIN % ''),
+                      mode) as stfile:
                 stfile.write(
                     tmpl.format(
                         title=title,
@@ -347,7 +353,7 @@ def write_mdin(atoms_initial, atoms_final, atom_map, prog, style='', vac=True):
             for filen, mask_str in ( (ONESTEP_MDIN % '_a', mask_str0),
                                      (ONESTEP_MDIN % '_b',
                                       mask_str1.replace(':2', ':1', 1))):
-                with open(filen, mode) as stfile:
+                with open(os.path.join(workdir, filen), mode) as stfile:
                     stfile.write(
                         tmpl.format(
                             title=title,
@@ -356,7 +362,8 @@ def write_mdin(atoms_initial, atoms_final, atom_map, prog, style='', vac=True):
                             crgmask='', ifsc=ifsc,
                             scmask=mask_str))
 
-            with open(GROUP_FILE % 'onestep', mode) as gfile:
+            with open(os.path.join(workdir, GROUP_FILE % 'onestep'),
+                      mode) as gfile:
                 gfile.write(
                     GROUP_FILE_TEMPLATE.format(
                         mdin_a=ONESTEP_MDIN % '_a', mdin_b=ONESTEP_MDIN % '_b',
@@ -400,7 +407,8 @@ def write_mdin(atoms_initial, atoms_final, atom_map, prog, style='', vac=True):
         if prog == 'pmemd':
             tmpl = COMMON_TEMPLATE % PMEMD_TEMPLATE
 
-            with open(step1_filename % '' , mode) as stfile:
+            with open(os.path.join(workdir, step1_filename % ''),
+                      mode) as stfile:
                 stfile.write(
                     tmpl.format(
                         title=title1,
@@ -409,7 +417,8 @@ def write_mdin(atoms_initial, atoms_final, atom_map, prog, style='', vac=True):
                         noshakemask=':1,2', crgmask='', ifsc=ifsc1,
                         scmask1=m0, scmask2=m1))
 
-            with open(step2_filename % '', mode) as stfile:
+            with open(os.path.join(workdir, step2_filename % ''),
+                      mode) as stfile:
                 stfile.write(
                     tmpl.format(
                         title=title2,
@@ -420,7 +429,8 @@ def write_mdin(atoms_initial, atoms_final, atom_map, prog, style='', vac=True):
         else:
             tmpl = COMMON_TEMPLATE % SANDER_TEMPLATE
 
-            with open(step1_filename % '_a' , mode) as stfile:
+            with open(os.path.join(workdir, step1_filename % '_a'),
+                      mode) as stfile:
                 stfile.write(
                     tmpl.format(
                         title=title1 + ', step a',
@@ -428,7 +438,8 @@ def write_mdin(atoms_initial, atoms_final, atom_map, prog, style='', vac=True):
                         noshakemask=':1', crgmask='',
                         ifsc=ifsc1, scmask=m0))
 
-            with open(step1_filename % '_b' , mode) as stfile:
+            with open(os.path.join(workdir, step1_filename % '_b'),
+                      mode) as stfile:
                 stfile.write(
                     tmpl.format(
                         title=title1 + ', step b',
@@ -437,13 +448,15 @@ def write_mdin(atoms_initial, atoms_final, atom_map, prog, style='', vac=True):
                         ifsc=ifsc1, scmask=m1.replace(':2', ':1', 1)))
 
             fname = step1_name.replace('%s', '')
-            with open(GROUP_FILE % fname, mode) as gfile:
+            with open(os.path.join(workdir, GROUP_FILE % fname),
+                      mode) as gfile:
                 gfile.write(
                     GROUP_FILE_TEMPLATE.format(
                         mdin_a=step1_name % '_a', mdin_b=step1_name % '_b',
                         base_a='state0', base_b='state_int'))
 
-            with open(step2_filename % '_a', mode) as stfile:
+            with open(os.path.join(workdir, step2_filename % '_a'),
+                      mode) as stfile:
                 stfile.write(
                     tmpl.format(
                         title=title2 + ', step a',
@@ -451,7 +464,8 @@ def write_mdin(atoms_initial, atoms_final, atom_map, prog, style='', vac=True):
                         noshakemask=':1', crgmask='',
                         ifsc=ifsc2, scmask=m2))
 
-            with open(step2_filename % '_b', mode) as stfile:
+            with open(os.path.join(workdir, step2_filename % '_b'),
+                      mode) as stfile:
                 stfile.write(
                     tmpl.format(
                         title=title2 + ', step b',
@@ -460,7 +474,8 @@ def write_mdin(atoms_initial, atoms_final, atom_map, prog, style='', vac=True):
                         ifsc=ifsc2, scmask=m3.replace(':2', ':1', 1)))
 
             fname = step2_name.replace('%s', '')
-            with open(GROUP_FILE % fname, mode) as gfile:
+            with open(os.path.join(workdir, GROUP_FILE % fname),
+                      mode) as gfile:
                 gfile.write(
                     GROUP_FILE_TEMPLATE.format(
                         mdin_a=step2_name % '_a', mdin_b=step2_name % '_b',
@@ -480,7 +495,8 @@ def write_mdin(atoms_initial, atoms_final, atom_map, prog, style='', vac=True):
             tmpl = COMMON_TEMPLATE % PMEMD_TEMPLATE
 
             # FIXME: partial de/recharging with scmask for crgmask?
-            with open(DECHARGE_MDIN % '', mode) as stfile:
+            with open(os.path.join(workdir, DECHARGE_MDIN % ''),
+                      mode) as stfile:
                 stfile.write(
                     tmpl.format(
                         title='decharge transformation',
@@ -489,7 +505,7 @@ def write_mdin(atoms_initial, atoms_final, atom_map, prog, style='', vac=True):
                         crgmask=':2', noshakemask=':1,2',
                         ifsc=0, scmask1='', scmask2=''))
 
-            with open(VDW_MDIN % '', mode) as stfile:
+            with open(os.path.join(workdir, VDW_MDIN % ''), mode) as stfile:
                 stfile.write(
                     tmpl.format(
                         title='vdW+bonded transformation',
@@ -499,7 +515,8 @@ def write_mdin(atoms_initial, atoms_final, atom_map, prog, style='', vac=True):
                         scmask1=':1@%s' % mask_str0 + add_str0,
                         scmask2=':2@%s' % mask_str1 + add_str1))
 
-            with open(RECHARGE_MDIN % '', mode) as stfile:
+            with open(os.path.join(workdir, RECHARGE_MDIN % ''),
+                      mode) as stfile:
                 stfile.write(
                     tmpl.format(
                         title='recharge transformation',
@@ -510,7 +527,8 @@ def write_mdin(atoms_initial, atoms_final, atom_map, prog, style='', vac=True):
         else:
             tmpl = COMMON_TEMPLATE % SANDER_TEMPLATE
 
-            with open(DECHARGE_MDIN % '_a', mode) as stfile:
+            with open(os.path.join(workdir, DECHARGE_MDIN % '_a'),
+                      mode) as stfile:
                 stfile.write(
                     tmpl.format(
                         title='decharge transformation, step a',
@@ -518,7 +536,8 @@ def write_mdin(atoms_initial, atoms_final, atom_map, prog, style='', vac=True):
                         crgmask='', noshakemask=':1',
                         ifsc=0, scmask=''))
 
-            with open(DECHARGE_MDIN % '_b', mode) as stfile:
+            with open(os.path.join(workdir, DECHARGE_MDIN % '_b'),
+                      mode) as stfile:
                 stfile.write(
                     tmpl.format(
                         title='decharge transformation, step b',
@@ -526,14 +545,15 @@ def write_mdin(atoms_initial, atoms_final, atom_map, prog, style='', vac=True):
                         crgmask=':1', noshakemask=':1',
                         ifsc=0, scmask=''))
 
-            with open(GROUP_FILE % 'decharge', mode) as gfile:
+            with open(os.path.join(workdir, GROUP_FILE % 'decharge'),
+                      mode) as gfile:
                 gfile.write(
                     GROUP_FILE_TEMPLATE.format(
                         mdin_a=DECHARGE_MDIN % '_a',
                         mdin_b=DECHARGE_MDIN % '_b',
                         base_a='state0', base_b='state0'))
 
-            with open(VDW_MDIN % '_a', mode) as stfile:
+            with open(os.path.join(workdir, VDW_MDIN % '_a'), mode) as stfile:
                 stfile.write(
                     tmpl.format(
                         title='vdW+bonded transformation, step a',
@@ -541,7 +561,7 @@ def write_mdin(atoms_initial, atoms_final, atom_map, prog, style='', vac=True):
                         crgmask=':1', noshakemask=':1',
                         ifsc=ifsc, scmask=':1@%s' % mask_str0 + add_str0))
 
-            with open(VDW_MDIN % '_b', mode) as stfile:
+            with open(os.path.join(workdir, VDW_MDIN % '_b'), mode) as stfile:
                 stfile.write(
                     tmpl.format(
                         title='vdW+bonded transformation, step b',
@@ -549,13 +569,15 @@ def write_mdin(atoms_initial, atoms_final, atom_map, prog, style='', vac=True):
                         crgmask=':1', noshakemask=':1',
                         ifsc=ifsc, scmask=':1@%s' % mask_str1 + add_str1))
 
-            with open(GROUP_FILE % 'vdw', mode) as gfile:
+            with open(os.path.join(workdir, GROUP_FILE % 'vdw'),
+                      mode) as gfile:
                 gfile.write(
                     GROUP_FILE_TEMPLATE.format(
                         mdin_a=VDW_MDIN % '_a', mdin_b=VDW_MDIN % '_b',
                         base_a='state0', base_b='state1'))
 
-            with open(RECHARGE_MDIN % '_a', mode) as stfile:
+            with open(os.path.join(workdir, RECHARGE_MDIN % '_a'),
+                      mode) as stfile:
                 stfile.write(
                     tmpl.format(
                         title='recharge transformation, step a',
@@ -563,7 +585,8 @@ def write_mdin(atoms_initial, atoms_final, atom_map, prog, style='', vac=True):
                         crgmask=':1', noshakemask=':1',
                         ifsc=0, scmask=''))
 
-            with open(RECHARGE_MDIN % '_b', mode) as stfile:
+            with open(os.path.join(workdir, RECHARGE_MDIN % '_b'),
+                      mode) as stfile:
                 stfile.write(
                     tmpl.format(
                         title='recharge transformation, step b',
@@ -571,7 +594,8 @@ def write_mdin(atoms_initial, atoms_final, atom_map, prog, style='', vac=True):
                         crgmask='', noshakemask=':1',
                         ifsc=0, scmask=''))
 
-            with open(GROUP_FILE % 'recharge', mode) as gfile:
+            with open(os.path.join(workdir, GROUP_FILE % 'recharge'),
+                      mode) as gfile:
                 gfile.write(
                     GROUP_FILE_TEMPLATE.format(
                         mdin_a=RECHARGE_MDIN % '_a',
@@ -49,7 +49,7 @@ STATE_INT = 'state_int'
 TR_TABLE = {'pert': 'dummy', 'pert2': 'dummy2', 'pert3': 'dummy3'}
 
 
-def _create_inp_file(stype, softcore, dummies1, tmpl):
+def _create_inp_file(stype, softcore, dummies1, tmpl, workdir=''):
     """
     Create a CHARMM INP file for TI.
 
@@ -61,6 +61,8 @@ def _create_inp_file(stype, softcore, dummies1, tmpl):
     :type softcore: str
     :param tmpl: template file
     :type tmpl: str
+    :param workdir: directory the INP files are written to
+    :type workdir: str
     """
 
     # for pert3 we go down the sander route otherwise we would need
@@ -71,7 +73,7 @@ def _create_inp_file(stype, softcore, dummies1, tmpl):
     # FIXME: consider this for all stypeS
 
     if stype == 'pert':        # no separation, linear
-        with open(ONESTEP_INP_FILE, 'w') as inp:
+        with open(os.path.join(workdir, ONESTEP_INP_FILE), 'w') as inp:
             inp.write(tmpl.format(charge0='', charge1='',
                                   state0='state0', state1='state1',
                                   softcore=softcore))
@@ -87,12 +89,12 @@ def _create_inp_file(stype, softcore, dummies1, tmpl):
             sc1 = 'pssp'
             sc2 = 'nopssp'
 
-        with open(file1, 'w') as inp:
+        with open(os.path.join(workdir, file1), 'w') as inp:
             inp.write(tmpl.format(charge0='', charge1='',
                                   state0='state0', state1='state_int',
                                   softcore=sc1))
 
-        with open(file2, 'w') as inp:
+        with open(os.path.join(workdir, file2), 'w') as inp:
             inp.write(tmpl.format(charge0='', charge1='',
                                   state0='state_int', state1='state1',
                                   softcore=sc2))
@@ -100,17 +102,17 @@ def _create_inp_file(stype, softcore, dummies1, tmpl):
         cht = ('!scalar charge set 0.0 select FIXME: atom-name-or-other end\n'
                'scalar charge set 0.0 select resname LIG end')
 
-        with open(DECHARGE_INP_FILE, 'w') as inp:
+        with open(os.path.join(workdir, DECHARGE_INP_FILE), 'w') as inp:
             inp.write(tmpl.format(charge0='', charge1=cht,
                                   state0='state0', state1='state0',
                                   softcore='nopssp'))
 
-        with open(VDW_INP_FILE, 'w') as inp:
+        with open(os.path.join(workdir, VDW_INP_FILE), 'w') as inp:
             inp.write(tmpl.format(charge0=cht, charge1=cht,
                                   state0='state0', state1='state1',
                                   softcore='pssp'))
 
-        with open(RECHARGE_INP_FILE, 'w') as inp:
+        with open(os.path.join(workdir, RECHARGE_INP_FILE), 'w') as inp:
             inp.write(tmpl.format(charge0=cht, charge1='',
                                   state0='state1', state1='state1',
                                   softcore='nopssp'))
@@ -194,29 +196,32 @@ class PertTopology(object):
         top = topol.lig0.TOP_EXT
         rst = topol.lig0.RST_EXT
 
+        def path(filename):
+            return os.path.join(curr_dir, filename)
+
         # top0 and top1 written mainly for debugging purposes
         top0 = charmm.CharmmTop(self.ftypes)
-        top0.readParm(lig0 + top, lig0 + rst)
-        top0.writePsf('state0.psf')
-        top0.writeCrd('state0.cor')
+        top0.readParm(path(lig0 + top), path(lig0 + rst) )
+        top0.writePsf(path('state0.psf') )
+        top0.writeCrd(path('state0.cor') )
         self.files_created.extend(('state0.psf', 'state0.cor'))
 
         # NOTE: pert2 - dummies zero q, vdW
         #       pert3 - disappearing zero q
         if self.stype == 'pert2':
             top_int = charmm.CharmmTop()
-            top_int.readParm(STATE_INT + top, STATE_INT + rst)
-            top_int.writePsf(STATE_INT + '.psf')
-            top_int.writeCrd(STATE_INT + '.cor')
+            top_int.readParm(path(STATE_INT + top), path(STATE_INT + rst) )
+            top_int.writePsf(path(STATE_INT + '.psf') )
+            top_int.writeCrd(path(STATE_INT + '.cor') )
             self.files_created.extend((STATE_INT + '.psf', STATE_INT + '.cor'))
 
         top1 = charmm.CharmmTop(self.itypes)
-        top1.readParm(lig1 + top, lig1 + rst)
-        top1.writePsf('state1.psf')
-        top1.writeCrd('state1.cor')
+        top1.readParm(path(lig1 + top), path(lig1 + rst) )
+        top1.writePsf(path('state1.psf') )
+        top1.writeCrd(path('state1.cor') )
 
         top0.combine(top1)              # adds parms from top1 to top0!
-        top0.writeRtfPrm('combined.rtf', 'combined.prm')
+        top0.writeRtfPrm(path('combined.rtf'), path('combined.prm') )
 
         self.files_created.extend(('state1.psf', 'state1.cor',
                                    'combined.rtf', 'combined.prm'))
@@ -224,7 +229,7 @@ class PertTopology(object):
         self.topol = topol
 
         _create_inp_file(self.stype, self.softcore, self.dummies1,
-                         VAC_TEMPLATE)
+                         VAC_TEMPLATE, curr_dir)
 
 
     def create_coords(self, curr_dir, dir_name, lig_morph, pdb_file, system,
@@ -242,28 +247,33 @@ class PertTopology(object):
         top = self.topol.lig0.TOP_EXT
         rst = self.topol.lig0.RST_EXT
 
+        workdir = os.path.join(curr_dir, dir_name)
+
+        def path(filename):
+            return os.path.join(workdir, filename)
+
         # top0 and top1 written mainly for debugging purposes
         top0 = charmm.CharmmTop(self.ftypes)
-        top0.readParm(lig0 + top, lig0 + rst)
-        top0.writePsf('state0.psf')
-        top0.writeCrd('state0.cor')
+        top0.readParm(path(lig0 + top), path(lig0 + rst) )
+        top0.writePsf(path('state0.psf') )
+        top0.writeCrd(path('state0.cor') )
 
         if self.stype == 'pert2':
             top_int = charmm.CharmmTop()
-            top_int.readParm(STATE_INT + top, STATE_INT + rst)
-            top_int.writePsf(STATE_INT + '.psf')
-            top_int.writeCrd(STATE_INT + '.cor')
+            top_int.readParm(path(STATE_INT + top), path(STATE_INT + rst) )
+            top_int.writePsf(path(STATE_INT + '.psf') )
+            top_int.writeCrd(path(STATE_INT + '.cor') )
 
         top1 = charmm.CharmmTop(self.itypes)
-        top1.readParm(lig1 + top, lig1 + rst)
-        top1.writePsf('state1.psf')
-        top1.writeCrd('state1.cor')
+        top1.readParm(path(lig1 + top), path(lig1 + rst) )
+        top1.writePsf(path('state1.psf') )
+        top1.writeCrd(path('state1.cor') )
 
         top0.combine(top1)              # adds parms from top1 to top0!
-        top0.writeRtfPrm('combined.rtf', 'combined.prm')
+        top0.writeRtfPrm(path('combined.rtf'), path('combined.prm') )
 
         _create_inp_file(self.stype, self.softcore, self.dummies1,
-                         SOL_TEMPLATE)
+                         SOL_TEMPLATE, workdir)
 
 
 
@@ -151,25 +151,31 @@ class PertTopology(object):
         top = topol.lig0.TOP_EXT
         rst = topol.lig0.RST_EXT
 
+        def path(filename):
+            return os.path.join(curr_dir, filename)
+
         # top0 and top1 written mainly for debugging purposes
         top0 = gromacs.GromacsTop()
-        top0.readParm(lig0 + top, lig0 + rst)
-        top0.writeTop(lig0 + const.GROMACS_ITP_EXT, lig0 + '.atp')
-        top0.writeGro(lig0 + const.GROMACS_GRO_EXT)
+        top0.readParm(path(lig0 + top), path(lig0 + rst) )
+        top0.writeTop(path(lig0 + const.GROMACS_ITP_EXT),
+                      path(lig0 + '.atp') )
+        top0.writeGro(path(lig0 + const.GROMACS_GRO_EXT) )
 
         top1 = gromacs.GromacsTop()
-        top1.readParm(lig1 + top, lig1 + rst)
-        top1.writeTop(lig1 + const.GROMACS_ITP_EXT, lig1 + '.atp')
-        top1.writeGro(lig1 + const.GROMACS_GRO_EXT)
+        top1.readParm(path(lig1 + top), path(lig1 + rst) )
+        top1.writeTop(path(lig1 + const.GROMACS_ITP_EXT),
+                      path(lig1 + '.atp') )
+        top1.writeGro(path(lig1 + const.GROMACS_GRO_EXT) )
 
         if self.FE_sub_type == 'dummy':
-            gromacs.mixer(top0, top1)
+            gromacs.mixer(top0, top1, path(const.GROMACS_PERT_ITP),
+                          path(const.GROMACS_PERT_ATP) )
 
             # FIXME: ugly kludges!
-            if not os.access(MORPH_GRO, os.F_OK):
-                os.symlink(lig0 + const.GROMACS_GRO_EXT, MORPH_GRO)
+            if not os.access(path(MORPH_GRO), os.F_OK):
+                os.symlink(lig0 + const.GROMACS_GRO_EXT, path(MORPH_GRO) )
 
-            with open(MORPH_TOP, 'w') as mtop:
+            with open(path(MORPH_TOP), 'w') as mtop:
                 mtop.write(TOP_TMPL.format(title='one-step TI/FEP',
                                            atp=const.GROMACS_PERT_ATP,
                                            itp=const.GROMACS_PERT_ITP,
@@ -179,7 +185,7 @@ class PertTopology(object):
                                                             self.dummies1,
                                                             self.separate)
 
-            with open(VAC_MDP_FILE, 'w') as mdp:
+            with open(path(VAC_MDP_FILE), 'w') as mdp:
                 mdp.write(
                     (VAC_MDP % (COMMON_MDP_TMPL,
                                 FE_TMPL)).format(nsteps='2000000',
@@ -197,28 +203,28 @@ class PertTopology(object):
             int_name = topol.int_state._parm_overwrite
 
             int_state = gromacs.GromacsTop()
-            int_state.readParm(int_name + top, int_name + rst)
-            int_state.writeTop(int_name + const.GROMACS_ITP_EXT,
-                               int_name + '.atp')
-            int_state.writeGro(int_name + const.GROMACS_GRO_EXT)
+            int_state.readParm(path(int_name + top), path(int_name + rst) )
+            int_state.writeTop(path(int_name + const.GROMACS_ITP_EXT),
+                               path(int_name + '.atp') )
+            int_state.writeGro(path(int_name + const.GROMACS_GRO_EXT) )
 
-            gromacs.mixer(top0, int_state, PERT1_ITP, PERT1_ATP)
-            gromacs.mixer(int_state, top1, PERT2_ITP, PERT2_ATP)
+            gromacs.mixer(top0, int_state, path(PERT1_ITP), path(PERT1_ATP) )
+            gromacs.mixer(int_state, top1, path(PERT2_ITP), path(PERT2_ATP) )
 
             # FIXME: ugly kludges!
-            if not os.access(MORPH1_GRO, os.F_OK):
-                os.symlink(lig0 + const.GROMACS_GRO_EXT, MORPH1_GRO)
+            if not os.access(path(MORPH1_GRO), os.F_OK):
+                os.symlink(lig0 + const.GROMACS_GRO_EXT, path(MORPH1_GRO) )
 
-            if not os.access(MORPH2_GRO, os.F_OK):
-                os.symlink(lig1 + const.GROMACS_GRO_EXT, MORPH2_GRO)
+            if not os.access(path(MORPH2_GRO), os.F_OK):
+                os.symlink(lig1 + const.GROMACS_GRO_EXT, path(MORPH2_GRO) )
 
-            with open(MORPH1_TOP, 'w') as mtop:
+            with open(path(MORPH1_TOP), 'w') as mtop:
                 mtop.write(TOP_TMPL.format(title='step 1/2: q_off and vdW '
                                            'on/off',
                                            atp=PERT1_ATP, itp=PERT1_ITP,
                                            ligname=const.LIGAND_NAME))
 
-            with open(MORPH2_TOP, 'w') as mtop:
+            with open(path(MORPH2_TOP), 'w') as mtop:
                 mtop.write(TOP_TMPL.format(title='step 2/2: q_on',
                                            atp=PERT2_ATP, itp=PERT2_ITP,
                                            ligname=const.LIGAND_NAME))
@@ -231,7 +237,7 @@ class PertTopology(object):
                     '0.0 0.0 0.0')
             seps = 'step 1: q_off (disappearing) followed by vdW on/off'
 
-            with open(VAC1_MDP_FILE, 'w') as mdp:
+            with open(path(VAC1_MDP_FILE), 'w') as mdp:
                 mdp.write(
                     (VAC_MDP % (COMMON_MDP_TMPL,
                                 FE_TMPL)).format(nsteps='2000000',
@@ -245,7 +251,7 @@ class PertTopology(object):
             masl = '0.0 0.0 0.0 0.0 0.0 0.0'
             seps = 'step 2: q_on (appearing)'
 
-            with open(VAC2_MDP_FILE, 'w') as mdp:
+            with open(path(VAC2_MDP_FILE), 'w') as mdp:
                 mdp.write(
                     (VAC_MDP % (COMMON_MDP_TMPL,
                                 FE_TMPL)).format(nsteps='2000000',
@@ -275,22 +281,26 @@ class PertTopology(object):
         self.topol.create_coords(curr_dir, dir_name, lig_morph, pdb_file,
                                  system, cmd1, cmd2, boxdims)
 
+        workdir = os.path.join(curr_dir, dir_name)
+        def path(filename):
+            return os.path.join(workdir, filename)
+
         if self.FE_sub_type == 'dummy':
             # FIXME: ugly kludge, assuming the file is one level up
-            if not os.access(const.GROMACS_PERT_ATP, os.F_OK):
+            if not os.access(path(const.GROMACS_PERT_ATP), os.F_OK):
                 os.symlink('../%s' % const.GROMACS_PERT_ATP,
-                           '%s' % const.GROMACS_PERT_ATP)
+                           path(const.GROMACS_PERT_ATP) )
 
-            if not os.access(const.GROMACS_PERT_ITP, os.F_OK):
+            if not os.access(path(const.GROMACS_PERT_ITP), os.F_OK):
                 os.symlink('../%s' % const.GROMACS_PERT_ITP,
-                           '%s' % const.GROMACS_PERT_ITP)
+                           path(const.GROMACS_PERT_ITP) )
 
 
             top = gromacs.GromacsTop()
-            top.readParm(self.topol.parmtop, self.topol.inpcrd)
+            top.readParm(path(self.topol.parmtop), path(self.topol.inpcrd) )
 
             # FIXME: need to reparse ATP file
-            with open(const.GROMACS_PERT_ATP, 'r') as atp:
+            with open(path(const.GROMACS_PERT_ATP), 'r') as atp:
                 atomtypes = []
 
                 for line in atp:
@@ -299,13 +309,13 @@ class PertTopology(object):
                                        float(tmp[6]) ) )
 
             top.addAtomTypes(atomtypes)
-            top.writeTop(MORPH_TOP, '', const.LIGAND_NAME, False)
-            top.writeGro(MORPH_GRO)
+            top.writeTop(path(MORPH_TOP), '', const.LIGAND_NAME, False)
+            top.writeGro(path(MORPH_GRO) )
 
             fepl, vdwl, masl, seps, sc_coul = _lambda_paths(self.dummies0,
                                                             self.dummies1,
                                                             self.separate)
-            with open(SOL_MDP_FILE, 'w') as mdp:
+            with open(path(SOL_MDP_FILE), 'w') as mdp:
                 mdp.write(
                     (SOL_MDP % (COMMON_MDP_TMPL,
                                 FE_TMPL)).format(nsteps='500000',
@@ -316,24 +326,17 @@ class PertTopology(object):
                                                  sc_coul=sc_coul))
         elif self.FE_sub_type == 'dummy3':
             # FIXME: ugly kludge, assuming the file is one level up
-            if not os.access(PERT1_ATP, os.F_OK):
-                os.symlink('../%s' % PERT1_ATP, '%s' % PERT1_ATP)
-
-            if not os.access(PERT2_ATP, os.F_OK):
-                os.symlink('../%s' % PERT2_ATP, '%s' % PERT2_ATP)
-
-            if not os.access(PERT1_ITP, os.F_OK):
-                os.symlink('../%s' % PERT1_ITP, '%s' % PERT1_ITP)
-
-            if not os.access(PERT2_ITP, os.F_OK):
-                os.symlink('../%s' % PERT2_ITP, '%s' % PERT2_ITP)
+            for filename in (PERT1_ATP, PERT2_ATP, PERT1_ITP, PERT2_ITP):
+                if not os.access(path(filename), os.F_OK):
+                    os.symlink('../%s' % filename, path(filename) )
 
 
             top0 = gromacs.GromacsTop()
-            top0.readParm(self.topol.parmtop0, self.topol.inpcrd0)
+            top0.readParm(path(self.topol.parmtop0),
+                          path(self.topol.inpcrd0) )
 
             # FIXME: need to reparse ATP file
-            with open(PERT1_ATP, 'r') as atp:
+            with open(path(PERT1_ATP), 'r') as atp:
                 atomtypes = []
 
                 for line in atp:
@@ -342,9 +345,9 @@ class PertTopology(object):
                                        float(tmp[6]) ) )
 
             top0.addAtomTypes(atomtypes)
-            top0.writeTop(MORPH1_TOP, PERT1_ATP, const.LIGAND_NAME, False,
-                          PERT1_ITP)
-            top0.writeGro(MORPH1_GRO)
+            top0.writeTop(path(MORPH1_TOP), path(PERT1_ATP), const.LIGAND_NAME,
+                          False, PERT1_ITP)
+            top0.writeGro(path(MORPH1_GRO) )
 
             fepl = ('0.0 0.2 0.4 0.6 0.8 1.0 1.0 1.0 1.0 1.0 1.0 1.0 1.0 '
                     '1.0 1.0 1.0')
@@ -354,7 +357,7 @@ class PertTopology(object):
                     '0.0 0.0 0.0')
             seps = 'step 1: q_off (disappearing) followed by vdW on/off'
 
-            with open(SOL1_MDP_FILE, 'w') as mdp:
+            with open(path(SOL1_MDP_FILE), 'w') as mdp:
                 mdp.write(
                     (SOL_MDP % (COMMON_MDP_TMPL,
                                 FE_TMPL)).format(nsteps='500000',
@@ -365,10 +368,11 @@ class PertTopology(object):
                                                  sc_coul='no'))
 
             top1 = gromacs.GromacsTop()
-            top1.readParm(self.topol.parmtop1, self.topol.inpcrd1)
+            top1.readParm(path(self.topol.parmtop1),
+                          path(self.topol.inpcrd1) )
 
             # FIXME: need to reparse ATP file
-            with open(PERT2_ATP, 'r') as atp:
+            with open(path(PERT2_ATP), 'r') as atp:
                 atomtypes = []
 
                 for line in atp:
@@ -377,15 +381,15 @@ class PertTopology(object):
                                        float(tmp[6]) ) )
 
             top1.addAtomTypes(atomtypes)
-            top1.writeTop(MORPH2_TOP, PERT2_ATP, const.LIGAND_NAME, False,
-                          PERT2_ITP)
-            top1.writeGro(MORPH2_GRO)
+            top1.writeTop(path(MORPH2_TOP), path(PERT2_ATP), const.LIGAND_NAME,
+                          False, PERT2_ITP)
+            top1.writeGro(path(MORPH2_GRO) )
 
             coul = '0.0 0.2 0.4 0.6 0.8 1.0'
             masl = '0.0 0.0 0.0 0.0 0.0 0.0'
             seps = 'step 2: q_on (appearing)'
 
-            with open(SOL2_MDP_FILE, 'w') as mdp:
+            with open(path(SOL2_MDP_FILE), 'w') as mdp:
                 mdp.write(
                     (SOL_MDP % (COMMON_MDP_TMPL,
                                  FE_TMPL)).format(nsteps='500000',
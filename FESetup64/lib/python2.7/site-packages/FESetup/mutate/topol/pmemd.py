@@ -102,7 +102,8 @@ class PertTopology(object):
             raise NotImplementedError
 
         amber.write_mdin(self.atoms_initial, self.atoms_final,
-                         self.atom_map, 'pmemd', self.FE_sub_type, True)
+                         self.atom_map, 'pmemd', self.FE_sub_type, True,
+                         curr_dir)
 
         mol2_0 = os.path.join(curr_dir, const.MORPH_NAME + '0' +
                               const.MOL2_EXT)
@@ -120,6 +121,7 @@ class PertTopology(object):
         lig = self.ff.Ligand(const.MORPH_NAME, start_file=mol2_0,
                              start_fmt='mol2', frcmod=frcmod0,
                              gaff=self.gaff)
+        lig.workdir = curr_dir
 
         lig.set_atomtype(self.gaff)
 
@@ -167,6 +169,7 @@ class PertTopology(object):
             lig = self.ff.Ligand(const.MORPH_NAME, start_file=mol2_0,
                                  start_fmt='mol2', frcmod=frcmod0,
                                  gaff=self.gaff)
+            lig.workdir = curr_dir
             lig.set_atomtype(self.gaff)
 
             if self.dummies0:
@@ -186,6 +189,7 @@ class PertTopology(object):
             lig = self.ff.Ligand(const.MORPH_NAME, start_file=mol2_int,
                                  start_fmt='mol2', frcmod=frcmod1,
                                  gaff=self.gaff)
+            lig.workdir = curr_dir
             lig.set_atomtype(self.gaff)
 
             if self.dummies1:
@@ -209,6 +213,7 @@ class PertTopology(object):
             lig = self.ff.Ligand(const.MORPH_NAME, start_file=mol2_0,
                                  start_fmt='mol2', frcmod=frcmod0,
                                  gaff=self.gaff)
+            lig.workdir = curr_dir
             lig.set_atomtype(self.gaff)
             lig._parm_overwrite = 'decharge'
 
@@ -223,6 +228,7 @@ class PertTopology(object):
             lig = self.ff.Ligand(const.MORPH_NAME, start_file=mol2_1,
                                  start_fmt='mol2', frcmod=frcmod1,
                                  gaff=self.gaff)
+            lig.workdir = curr_dir
             lig.set_atomtype(self.gaff)
             lig._parm_overwrite = 'recharge'
 
@@ -247,12 +253,15 @@ class PertTopology(object):
 
         if self.FE_sub_type[:5] == 'dummy':
             for prm in patch_parms:
-                util.patch_parmtop(prm[0] + lig.TOP_EXT, "", prm[1], prm[2])
+                util.patch_parmtop(os.path.join(curr_dir, prm[0] + lig.TOP_EXT),
+                                   "", prm[1], prm[2])
 
 
     def create_coords(self, curr_dir, dir_name, lig_morph, pdb_file, system,
                       cmd1, cmd2, boxdims):
 
+        workdir = os.path.join(curr_dir, dir_name)
+
         patch_parms = []
 
         if self.FE_sub_type[:8] == 'softcore':
@@ -269,7 +278,8 @@ class PertTopology(object):
             raise NotImplementedError
 
         amber.write_mdin(self.atoms_initial, self.atoms_final,
-                         self.atom_map, 'pmemd', self.FE_sub_type, False)
+                         self.atom_map, 'pmemd', self.FE_sub_type, False,
+                         workdir)
 
         mol2_0 = os.path.join(curr_dir, const.MORPH_NAME + '0' +
                               const.MOL2_EXT)
@@ -280,6 +290,7 @@ class PertTopology(object):
         util.write_mol2(state1, mol2_1, resname = const.LIGAND1_NAME)
 
         com = self.ff.Complex(pdb_file, mol2_0)
+        com.workdir = workdir
         com.__class__.SSBONDS_OFFSET = 2 # FIXME: kludge
         com.box_dims = boxdims
         com.ligand_fmt = 'mol2'
@@ -322,6 +333,7 @@ class PertTopology(object):
             util.write_mol2(int_state, mol2_int, resname = const.INT_NAME)
 
             com = self.ff.Complex(pdb_file, mol2_0)
+            com.workdir = workdir
             com.__class__.SSBONDS_OFFSET = 2 # FIXME: kludge
             com.box_dims = boxdims
             com.ligand_fmt = 'mol2'
@@ -341,6 +353,7 @@ class PertTopology(object):
             com.create_top(boxtype='set', addcmd=cmd1 + cmd2)
 
             com = self.ff.Complex(pdb_file, mol2_int)
+            com.workdir = workdir
             com.__class__.SSBONDS_OFFSET = 2 # FIXME: kludge
             com.box_dims = boxdims
             com.ligand_fmt = 'mol2'
@@ -362,6 +375,7 @@ class PertTopology(object):
         # FIXME: residue name will be both the same
         elif self.FE_sub_type == 'softcore3' or self.FE_sub_type == 'dummy3':
             com = self.ff.Complex(pdb_file, mol2_0)
+            com.workdir = workdir
             com.__class__.SSBONDS_OFFSET = 2 # FIXME: kludge
             com.box_dims = boxdims
             com.ligand_fmt = 'mol2'
@@ -373,6 +387,7 @@ class PertTopology(object):
             com.create_top(boxtype='set', addcmd=cmd1 + cmd2)
 
             com = self.ff.Complex(pdb_file, mol2_1)
+            com.workdir = workdir
             com.__class__.SSBONDS_OFFSET = 2 # FIXME: kludge
             com.box_dims = boxdims
             com.ligand_fmt = 'mol2'
@@ -389,4 +404,5 @@ class PertTopology(object):
 
         if self.FE_sub_type[:5] == 'dummy':
             for prm in patch_parms:
-                util.patch_parmtop(prm[0] + com.TOP_EXT, "", prm[1], prm[2])
+                util.patch_parmtop(os.path.join(workdir, prm[0] + com.TOP_EXT),
+                                   "", prm[1], prm[2])
@@ -118,7 +118,8 @@ class PertTopology(object):
 
         if self.mdin:
             amber.write_mdin(self.atoms_initial, self.atoms_final,
-                             self.atom_map, 'sander', self.FE_sub_type, True)
+                             self.atom_map, 'sander', self.FE_sub_type, True,
+                             curr_dir)
 
         mol2_0 = os.path.join(curr_dir, const.MORPH_NAME + '0' +
                               const.MOL2_EXT)
@@ -129,6 +130,7 @@ class PertTopology(object):
         lig0 = self.ff.Ligand(const.MORPH_NAME, start_file=mol2_0,
                               start_fmt='mol2', frcmod=frcmod0,
                               gaff=self.gaff)
+        lig0.workdir = curr_dir
 
         lig0.set_atomtype(self.gaff)
         lig0._parmchk(mol2_0, 'mol2', frcmod0)
@@ -150,6 +152,7 @@ class PertTopology(object):
         lig1 = self.ff.Ligand(const.MORPH_NAME, start_file=mol2_1,
                               start_fmt='mol2', frcmod=frcmod1,
                               gaff=self.gaff)
+        lig1.workdir = curr_dir
 
         lig1.set_atomtype(self.gaff)
         lig1._parmchk(mol2_1, 'mol2', frcmod1)
@@ -187,6 +190,7 @@ class PertTopology(object):
             lig = self.ff.Ligand(const.MORPH_NAME, start_file=mol2_int,
                                  start_fmt='mol2', frcmod=frcmod0,
                                  gaff=self.gaff)
+            lig.workdir = curr_dir
             lig.set_atomtype(self.gaff)
             lig._parm_overwrite = 'state_int'
 
@@ -197,7 +201,9 @@ class PertTopology(object):
             top0 = lig0._parm_overwrite + lig0.TOP_EXT
             top1 = lig1._parm_overwrite + lig1.TOP_EXT
 
-            util.patch_parmtop(top0, top1, ':%s' % const.LIGAND_NAME, '')
+            util.patch_parmtop(os.path.join(curr_dir, top0),
+                               os.path.join(curr_dir, top1),
+                               ':%s' % const.LIGAND_NAME, '')
 
         if self.FE_sub_type == 'dummy3':
             ow_add = '_int'
@@ -211,6 +217,7 @@ class PertTopology(object):
             lig = self.ff.Ligand(const.MORPH_NAME, start_file=mol2_int,
                                  start_fmt='mol2', frcmod=frcmod1,
                                  gaff=self.gaff)
+            lig.workdir = curr_dir
             lig.set_atomtype(self.gaff)
             lig._parm_overwrite = 'state_int'
 
@@ -221,8 +228,12 @@ class PertTopology(object):
             int_name = lig._parm_overwrite + lig.TOP_EXT
             top1 = lig1._parm_overwrite + lig1.TOP_EXT
 
-            util.patch_parmtop(top0, int_name, ':%s' % const.LIGAND_NAME, '')
-            util.patch_parmtop(int_name, top1, ':%s' % const.LIGAND_NAME, '')
+            util.patch_parmtop(os.path.join(curr_dir, top0),
+                               os.path.join(curr_dir, int_name),
+                               ':%s' % const.LIGAND_NAME, '')
+            util.patch_parmtop(os.path.join(curr_dir, int_name),
+                               os.path.join(curr_dir, top1),
+                               ':%s' % const.LIGAND_NAME, '')
 
             self.int_state = lig
 
@@ -230,6 +241,8 @@ class PertTopology(object):
     def create_coords(self, curr_dir, dir_name, lig_morph, pdb_file, system,
                       cmd1, cmd2, boxdims):
 
+        workdir = os.path.join(curr_dir, dir_name)
+
         if self.FE_sub_type[:8] == 'softcore':
             state0, state1 = \
                     amber.softcore(lig_morph, self.lig_final,
@@ -249,13 +262,15 @@ class PertTopology(object):
 
         if self.mdin:
             amber.write_mdin(self.atoms_initial, self.atoms_final,
-                             self.atom_map, 'sander', self.FE_sub_type, False)
+                             self.atom_map, 'sander', self.FE_sub_type, False,
+                             workdir)
 
         mol2_0 = os.path.join(curr_dir, const.MORPH_NAME + '0' +
                               const.MOL2_EXT)
         util.write_mol2(state0, mol2_0)
 
         com0 = self.ff.Complex(pdb_file, mol2_0)
+        com0.workdir = workdir
         com0.box_dims = boxdims
         com0.ligand_fmt = 'mol2'
         com0.frcmod = self.frcmod0
@@ -275,6 +290,7 @@ class PertTopology(object):
         util.write_mol2(state1, mol2_1)
 
         com1 = self.ff.Complex(pdb_file, mol2_1)
+        com1.workdir = workdir
         com1.box_dims = boxdims
         com1.ligand_fmt = 'mol2'
         com1.frcmod = self.frcmod1
@@ -303,6 +319,7 @@ class PertTopology(object):
             util.write_mol2(int_state, mol2_int, resname = const.INT_NAME)
 
             com = self.ff.Complex(pdb_file, mol2_int)
+            com.workdir = workdir
             com.box_dims = boxdims
             com.ligand_fmt = 'mol2'
             com.frcmod = self.frcmod1
@@ -314,7 +331,9 @@ class PertTopology(object):
             top0 = com0._parm_overwrite + com0.TOP_EXT
             top1 = com1._parm_overwrite + com1.TOP_EXT
 
-            util.patch_parmtop(top0, top1, ':%s' % const.LIGAND_NAME, '')
+            util.patch_parmtop(os.path.join(workdir, top0),
+                               os.path.join(workdir, top1),
+                               ':%s' % const.LIGAND_NAME, '')
             
             self.parmtop = top0
             self.inpcrd = com0._parm_overwrite + com0.RST_EXT
@@ -329,6 +348,7 @@ class PertTopology(object):
             util.write_mol2(int_mol, mol2_int, resname = const.LIGAND_NAME)
 
             com = self.ff.Complex(pdb_file, mol2_int)
+            com.workdir = workdir
             com.box_dims = boxdims
             com.ligand_fmt = 'mol2'
             com.frcmod = self.frcmod1
@@ -345,8 +365,12 @@ class PertTopology(object):
             int_name = com._parm_overwrite + com.TOP_EXT
             top1 = com1._parm_overwrite + com1.TOP_EXT
 
-            util.patch_parmtop(top0, int_name, ':%s' % const.LIGAND_NAME, '')
-            util.patch_parmtop(int_name, top1, ':%s' % const.LIGAND_NAME, '')
+            util.patch_parmtop(os.path.join(workdir, top0),
+                               os.path.join(workdir, int_name),
+                               ':%s' % const.LIGAND_NAME, '')
+            util.patch_parmtop(os.path.join(workdir, int_name),
+                               os.path.join(workdir, top1),
+                               ':%s' % const.LIGAND_NAME, '')
 
             self.parmtop0 = top0
             self.inpcrd0 = com0._parm_overwrite + com0.RST_EXT
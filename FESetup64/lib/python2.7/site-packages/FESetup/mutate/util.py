@@ -31,6 +31,7 @@ import re
 import glob
 import math
 import itertools
+import multiprocessing
 import cPickle as pickle
 from collections import OrderedDict, defaultdict
 
@@ -46,13 +47,14 @@ import Sire.Mol
 import Sire.MM
 import Sire.Units
 import Sire.Maths
+import Sire.Vol
 
 # parmed 2.4.0 from AMBER16
-from parmed.amber.mask import AmberMask
 from parmed.amber.readparm import AmberParm
 import parmed.tools.actions as Action
 
 from FESetup import const, errors, logger
+from FESetup.ambermask import AmberMask, MaskTables
 
 from FESetup.munkres import Munkres, print_matrix
 
@@ -200,6 +202,8 @@ def create_isotope_map(filename):
 
 _fmcs_imp = 'c++'                       # 'python' or 'c++'
 
+# NOTE: _params holds the read-only defaults, every search works on a copy
+
 if _fmcs_imp == 'c++':
     from rdkit.Chem.rdFMCS import FindMCS, AtomCompare, BondCompare
 
@@ -229,7 +233,228 @@ else:
                    ringMatchesRingOnly = True, completeRingsOnly = True,
                    threshold = None)
 
-def mcss(mol2str_1, mol2str_2, maxtime=60, isotope_map=None, selec=''):
+# FMCS variants run concurrently in portfolio mode, in order of preference:
+# the default parameters, bond maximization, partial rings
+_PORTFOLIO = ( {}, {'maximizeBonds': True}, {'completeRingsOnly': False} )
+
+# a completed portfolio search is accepted before the less preferred
+# variants have finished when the MCS covers at least this fraction of the
+# smaller molecule
+_PORTFOLIO_MIN_FRACTION = 0.8
+
+
+def _variant_params(overrides, seed, maxtime):
+    """
+    FMCS parameters of a portfolio variant.
+
+    :param overrides: parameters replacing the defaults
+    :type overrides: dict
+    :param seed: SMARTS of a common core to seed the search
+    :type seed: string
+    :param maxtime: timeout in seconds
+    :type maxtime: float
+    :returns: FMCS parameters
+    :rtype: dict
+    """
+
+    params = dict(_params)
+    params.update(timeout = int(maxtime),
+                  atomCompare = AtomCompare.CompareAny)
+    params.update(overrides)
+
+    if seed:
+        params.update(seedSmarts = seed)
+
+    return params
+
+
+def _fmcs_variant(args):
+    """
+    Run one FMCS variant in a worker process.  Only plain values are passed
+    between processes.
+
+    :param args: variant number, both MOL2 strings, parameter overrides,
+       seed SMARTS and timeout
+    :type args: tuple
+    :returns: variant number, SMARTS, completion flag, number of atoms,
+       error message if the variant failed
+    """
+
+    num, mol2str_1, mol2str_2, overrides, seed, maxtime = args
+
+    # any error, e.g. from RDKit on a bad seed, only fails this variant
+    try:
+        rdBase.DisableLog('rdApp.warning')
+        mol1 = rdkit.Chem.MolFromMol2Block(mol2str_1, sanitize = False,
+                                           removeHs = False)
+        mol2 = rdkit.Chem.MolFromMol2Block(mol2str_2, sanitize = False,
+                                           removeHs = False)
+        rdBase.EnableLog('rdApp.warning')
+
+        mcs = FindMCS( (mol1, mol2),
+                       **_variant_params(overrides, seed, maxtime) )
+    except Exception as why:
+        return num, '', False, 0, str(why)
+
+    return num, mcs.smartsString, not mcs.canceled, mcs.numAtoms, ''
+
+
+def _preferred(results, nvariants, min_atoms, natoms):
+    """
+    Pick the portfolio result in order of preference.  A variant is only
+    taken when all more preferred variants have finished without a completed
+    MCS of min_atoms atoms.  A still running variant is only passed over for a
+    completed MCS covering the whole smaller molecule as it cannot be beaten.
+
+    :param results: finished results by variant number
+    :type results: dict
+    :param nvariants: number of variants
+    :type nvariants: int
+    :param min_atoms: minimum size of an acceptable MCS
+    :type min_atoms: int
+    :param natoms: number of atoms of the smaller molecule
+    :type natoms: int
+    :returns: the accepted result or None
+    """
+
+    for num in range(nvariants):
+        if num not in results:
+            for later in range(num + 1, nvariants):
+                result = results.get(later)
+
+                if result and result[2] and result[3] >= natoms:
+                    return result
+
+            return None
+
+        result = results[num]
+
+        if result[1] and result[2] and result[3] >= min_atoms:
+            return result
+
+    return None
+
+
+def _portfolio(mol2str_1, mol2str_2, natoms, maxtime, seed=''):
+    """
+    Run several FMCS variants concurrently.  Results are accepted in order
+    of preference, see _preferred(), so that the choice does not depend on
+    which variant happens to finish first.  The remaining variants are
+    terminated as soon as a result is accepted.  If none qualifies the
+    largest MCS found is taken, completed searches first, ties going to the
+    more preferred variant.  A variant raising an error counts as failed.
+
+    :param mol2str_1: first MOL2 string
+    :type mol2str_1: string
+    :param mol2str_2: second MOL2 string
+    :type mol2str_2: string
+    :param natoms: number of atoms of the smaller molecule
+    :type natoms: int
+    :param maxtime: timeout for each variant in seconds
+    :type maxtime: float
+    :param seed: SMARTS of a common core to seed the search
+    :type seed: string
+    :returns: SMARTS, completion flag, FMCS parameters of the chosen variant
+    """
+
+    variants = [(overrides, seed) for overrides in _PORTFOLIO]
+
+    # the seed may be a poor start for this pair
+    if seed:
+        variants.append( ({}, '') )
+
+    jobs = [(num, mol2str_1, mol2str_2, overrides, vseed, maxtime)
+            for num, (overrides, vseed) in enumerate(variants)]
+
+    min_atoms = int(math.ceil(_PORTFOLIO_MIN_FRACTION * natoms) )
+    results = {}
+    best = None
+
+    pool = multiprocessing.Pool(min(len(jobs),
+                                    multiprocessing.cpu_count() ) )
+
+    try:
+        for result in pool.imap_unordered(_fmcs_variant, jobs):
+            num, smarts, completed, nmcs, error = result
+            results[num] = result
+
+            if error:
+                logger.write('FMCS variant %i failed: %s' % (num, error) )
+            else:
+                logger.write('FMCS variant %i %s with %i atoms: %s%s' %
+                             (num, 'completed' if completed else 'timed out',
+                              nmcs, variants[num][0],
+                              ' (seeded)' if variants[num][1] else '') )
+
+            best = _preferred(results, len(variants), min_atoms, natoms)
+
+            if best:
+                break
+    except Exception as why:
+        raise errors.SetupError('MCSS portfolio failed: %s' % why)
+    finally:
+        pool.terminate()
+        pool.join()
+
+    if not best:
+        found = [result for result in results.values() if result[1] ]
+
+        if found:
+            best = max(found,
+                       key=lambda result: (result[2], result[3], -result[0]) )
+
+    if not best:
+        return '', False, _variant_params({}, seed, maxtime)
+
+    logger.write('Using FMCS variant %i' % best[0])
+
+    return best[1], best[2], _variant_params(variants[best[0]][0],
+                                             variants[best[0]][1], maxtime)
+
+
+def common_core(molecules, maxtime=60):
+    """
+    Common core of a whole ligand series via RDKit/fmcs over all molecules.
+    The core is used to seed the pairwise searches in mcss() which then only
+    need to extend the core into the R-groups.
+
+    :param molecules: the ligands
+    :type molecules: list of Sire.Mol.Molecule
+    :param maxtime: timeout for fmcs in seconds
+    :type maxtime: float
+    :returns: SMARTS of the core or empty string if there is no core or
+       the fmcs implementation does not support seeding
+    :rtype: string
+    """
+
+    if _fmcs_imp != 'c++' or len(molecules) < 3:
+        return ''
+
+    rdBase.DisableLog('rdApp.warning')
+    mols = [rdkit.Chem.MolFromMol2Block(write_mol2(mol, notypes = True),
+                                        sanitize = False, removeHs = False)
+            for mol in molecules]
+    rdBase.EnableLog('rdApp.warning')
+
+    params = dict(_params)
+    params.update(timeout = int(maxtime),
+                  atomCompare = AtomCompare.CompareAny)
+
+    mcs = FindMCS(mols, **params)
+
+    if mcs.canceled:
+        logger.write('Warning: series core search timed out after %.2fs, '
+                     'core not used' % maxtime)
+        return ''
+
+    logger.write('Series core of %i ligands with %i atoms: %s' %
+                 (len(mols), mcs.numAtoms, mcs.smartsString) )
+
+    return mcs.smartsString
+
+
+def mcss(mol2str_1, mol2str_2, maxtime=60, isotope_map=None, selec='',
+         seed='', portfolio=False, workdir=''):
     """
     Maximum common substructure search via RDKit/fmcs.
 
@@ -243,6 +468,14 @@ def mcss(mol2str_1, mol2str_2, maxtime=60, isotope_map=None, selec=''):
     :type isotope_map: dict
     :param selec: selection method for multiple MCS
     :type selec: string
+    :param seed: SMARTS of a common core to seed the search, see
+       common_core(), ignored for explicit user atom mappings
+    :type seed: string
+    :param portfolio: run several FMCS variants concurrently, ignored for
+       explicit user atom mappings
+    :type portfolio: bool
+    :param workdir: directory to write the MCS files to
+    :type workdir: string
     :raises: SetupError
     :returns: index map
     :rtype: dict
@@ -256,14 +489,15 @@ def mcss(mol2str_1, mol2str_2, maxtime=60, isotope_map=None, selec=''):
                                        removeHs = False)
     rdBase.EnableLog('rdApp.warning')
 
-    _params.update(timeout = int(maxtime) )
+    params = dict(_params)
+    params.update(timeout = int(maxtime) )
 
     # FIXME: test c++ implementation
     if isotope_map:
         if _fmcs_imp == 'c++':
-            _params.update(atomCompare = AtomCompare.CompareIsotopes)
+            params.update(atomCompare = AtomCompare.CompareIsotopes)
         else:
-            _params.update(atomCompare = 'isotopes')
+            params.update(atomCompare = 'isotopes')
 
         max_idx1 = mol1.GetNumAtoms()
         max_idx2 = mol2.GetNumAtoms()
@@ -295,9 +529,9 @@ def mcss(mol2str_1, mol2str_2, maxtime=60, isotope_map=None, selec=''):
                 atom2.SetIsotope(icnt)
     else:
         if _fmcs_imp == 'c++':
-            _params.update(atomCompare = AtomCompare.CompareAny)
+            params.update(atomCompare = AtomCompare.CompareAny)
         else:
-            _params.update(atomCompare = 'any')
+            params.update(atomCompare = 'any')
 
         n_chiral1 = len(rdkit.Chem.FindMolChiralCenters(mol1) )
         n_chiral2 = len(rdkit.Chem.FindMolChiralCenters(mol2) )
@@ -312,18 +546,34 @@ def mcss(mol2str_1, mol2str_2, maxtime=60, isotope_map=None, selec=''):
                          % (n_chiral2, 's' if n_chiral2 > 1 else '') )
 
 
-    mcs = FindMCS( (mol1, mol2), **_params)
+    if isotope_map or _fmcs_imp != 'c++':
+        seed = ''
+        portfolio = False
+
+    if seed:
+        logger.write('Seeding MCSS with series core %s' % seed)
 
-    if _fmcs_imp == 'c++':
-        smarts = mcs.smartsString
-        completed = not mcs.canceled
+    if portfolio:
+        natoms = min(mol1.GetNumAtoms(), mol2.GetNumAtoms() )
+        smarts, completed, params = _portfolio(mol2str_1, mol2str_2, natoms,
+                                               maxtime, seed)
     else:
-        smarts = mcs.smarts
-        completed = mcs.completed
+        if seed:
+            params.update(seedSmarts = seed)
+
+        mcs = FindMCS( (mol1, mol2), **params)
+
+        if _fmcs_imp == 'c++':
+            smarts = mcs.smartsString
+            completed = not mcs.canceled
+        else:
+            smarts = mcs.smarts
+            completed = mcs.completed
 
     logger.write('Running RDKit/fmcs (%s implementation) with arguments:\n%s' %
                  (_fmcs_imp,
-                  ', '.join(['%s=%s' % (k,v) for k,v in _params.iteritems()] ) ) )
+                  ', '.join(['%s=%s' % (k,v)
+                             for k,v in params.iteritems()] ) ) )
 
     if not smarts:
         raise errors.SetupError('No MCSS match could be found')
@@ -333,21 +583,6 @@ def mcss(mol2str_1, mol2str_2, maxtime=60, isotope_map=None, selec=''):
 
     p = rdkit.Chem.MolFromSmarts(smarts)
 
-    conv = ob.OBConversion()
-    conv.SetInAndOutFormats('mol2', 'mol2')
-
-    # NOTE: this relies on a modified Openbabel MOL2 writer
-    conv.AddOption('r', ob.OBConversion.OUTOPTIONS)  # do not append resnum
-
-    obmol1 = ob.OBMol()
-
-    errlev = ob.obErrorLog.GetOutputLevel()
-    ob.obErrorLog.SetOutputLevel(0)
-
-    conv.ReadString(obmol1, mol2str_1)
-
-    ob.obErrorLog.SetOutputLevel(errlev)
-
     # NOTE: experimental!
     if selec == 'spatially-closest':
         m1 = mol1.GetSubstructMatches(p, uniquify=False, maxMatches=100, useChirality=False)
@@ -465,6 +700,38 @@ def mcss(mol2str_1, mol2str_2, maxtime=60, isotope_map=None, selec=''):
 
         mapping = {k: v for k, v in mapping.items() if v not in delete_values}
 
+    write_mcs(mol2str_1, mapping, workdir)
+
+    return mapping
+
+
+def write_mcs(mol2str, mapping, workdir=''):
+    """
+    Write the common substructure as found in the first molecule and the
+    index map to the working directory.
+
+    :param mol2str: MOL2 string of the first molecule
+    :type mol2str: string
+    :param mapping: index map from first to second molecule
+    :type mapping: dict
+    :param workdir: directory to write the files to
+    :type workdir: string
+    """
+
+    conv = ob.OBConversion()
+    conv.SetInAndOutFormats('mol2', 'mol2')
+
+    # NOTE: this relies on a modified Openbabel MOL2 writer
+    conv.AddOption('r', ob.OBConversion.OUTOPTIONS)  # do not append resnum
+
+    obmol1 = ob.OBMol()
+
+    errlev = ob.obErrorLog.GetOutputLevel()
+    ob.obErrorLog.SetOutputLevel(0)
+
+    conv.ReadString(obmol1, mol2str)
+
+    ob.obErrorLog.SetOutputLevel(errlev)
 
     delete_atoms = []
 
@@ -481,14 +748,12 @@ def mcss(mol2str_1, mol2str_2, maxtime=60, isotope_map=None, selec=''):
 
     obmol1.EndModify()
 
-    conv.WriteFile(obmol1, const.MCS_MOL_FILE)
+    conv.WriteFile(obmol1, os.path.join(workdir, const.MCS_MOL_FILE) )
 
-    with open(const.MCS_MAP_FILE, 'wb') as pkl:
+    with open(os.path.join(workdir, const.MCS_MAP_FILE), 'wb') as pkl:
         pickle.dump(mapping.keys(), pkl, 0)
         pickle.dump(mapping.values(), pkl, 0)
 
-    return mapping
-
 
 def split_system(mols):
     """Create new Sire molecule with first residue (=ligand) deleted.
@@ -511,10 +776,12 @@ def split_system(mols):
 
 
 def map_atoms(lig_initial, lig_final, timeout, isotope_map = None,
-              mcs_sel = ''):
+              mcs_sel = '', index_map = None, seed = '', portfolio = False,
+              workdir = ''):
     """
     Compute the atom mapping between initial and final state using MCSS.
-    Creates lig_morph, appends to atom_map and reverse_atom_map.
+    Creates lig_morph, appends to atom_map and reverse_atom_map.  A known
+    index map, e.g. the inverted map of the reverse morph, skips the MCSS.
 
     atom_map contains the AtomIdx (including newly created dummies where
     necessary) of state0 mapping to state1, reverse_atom_map does the opposite.
@@ -528,6 +795,16 @@ def map_atoms(lig_initial, lig_final, timeout, isotope_map = None,
     :type timeout: float
     :param isotope_map: explicit user atom mapping
     :type isotope_map: dict
+    :param mcs_sel: selection method for multiple MCS
+    :type mcs_sel: string
+    :param index_map: atom index map from initial to final state
+    :type index_map: dict
+    :param seed: SMARTS of the series core
+    :type seed: string
+    :param portfolio: run several FMCS variants concurrently
+    :type portfolio: bool
+    :param workdir: directory to write the MCS files to
+    :type workdir: string
     :raises: SetupError
     :returns: morph molecule, forward map, reverse map
     :rtype: Sire.Mol.CutGroup, OrderedDict of Sire.Mol.AtomName to
@@ -539,8 +816,11 @@ def map_atoms(lig_initial, lig_final, timeout, isotope_map = None,
     mol1 = write_mol2(lig_initial, notypes = True)
     mol2 = write_mol2(lig_final, notypes = True)
 
+    if index_map:
+        logger.write('Reusing inverted atom mapping of reverse morph')
+        write_mcs(mol1, index_map, workdir)
     # JM 10/16
-    if (mcs_sel == 'shapealign' and len(isotope_map) > 0):
+    elif (mcs_sel == 'shapealign' and len(isotope_map) > 0):
         logger.write("user provided mappings override shape align mode")
     elif mcs_sel == 'shapealign':
         logger.write("Will map atoms using shape align mode")
@@ -626,7 +906,10 @@ def map_atoms(lig_initial, lig_final, timeout, isotope_map = None,
     #print (isotope_map)
     #import pdb ; pdb.set_trace()
     #sys.exit(-1)
-    index_map = mcss(mol1, mol2, timeout, isotope_map, mcs_sel)
+
+    if not index_map:
+        index_map = mcss(mol1, mol2, timeout, isotope_map, mcs_sel, seed,
+                         portfolio, workdir)
 
     if not index_map:
         raise errors.SetupError('MCSS error')
@@ -879,21 +1162,91 @@ def parm_conn(lig_morph, atoms_initial, lig_initial, lig_final, atom_map,
     return lig_morph, con_morph, con_final
 
 
-def dummy_coords(lig_morph, con_morph, atoms_initial, lig_initial, lig_final,
-                 atom_map, reverse_atom_map, connect_final, zz_atoms,
-                 dummy_atoms):
+def _vec(vector):
+    """Sire.Maths.Vector to numpy array."""
+
+    return np.array( (vector.x(), vector.y(), vector.z() ) )
+
+
+def _coords(molecule):
+    """All coordinates of a molecule in atom index order as numpy array."""
+
+    return np.array([(v.x(), v.y(), v.z() )
+                     for v in molecule.property('coordinates').toVector()])
+
+
+def _internal(q0, q1, q2, q3):
     """
-    Create coordinates for dummy atoms from initial state.
-    Prepares the initial state for make_pert_file().
+    Bond q0-q1, angle q0-q1-q2 and dihedral q0-q1-q2-q3 in radians.
+    """
+
+    b01 = q0 - q1
+    b21 = q2 - q1
+    bond = np.linalg.norm(b01)
+
+    angle = math.acos(np.clip(np.dot(b01, b21) /
+                              (bond * np.linalg.norm(b21) ), -1.0, 1.0) )
+
+    u = b21 / np.linalg.norm(b21)
+    b32 = q3 - q2
+    v = b01 - np.dot(b01, u) * u
+    w = b32 - np.dot(b32, u) * u
+
+    dihedral = math.atan2(np.dot(np.cross(u, v), w), np.dot(v, w) )
+
+    return bond, angle, dihedral
+
+
+def _nerf(q1, q2, q3, bond, angle, dihedral):
+    """
+    Place atoms from internal coordinates (natural extension reference
+    frame), vectorised over all rows.  Inverse of _internal().
+
+    :param q1: bonded atoms
+    :type q1: numpy array Nx3
+    :param q2: angle atoms
+    :type q2: numpy array Nx3
+    :param q3: dihedral atoms
+    :type q3: numpy array Nx3
+    :param bond: bond lengths
+    :type bond: numpy array
+    :param angle: angles in radians
+    :type angle: numpy array
+    :param dihedral: dihedrals in radians
+    :type dihedral: numpy array
+    :returns: the new positions
+    :rtype: numpy array Nx3
+    """
+
+    bc = q1 - q2
+    bc /= np.linalg.norm(bc, axis=1)[:, np.newaxis]
+
+    n = np.cross(q2 - q3, bc)
+    n /= np.linalg.norm(n, axis=1)[:, np.newaxis]
+
+    m = np.cross(n, bc)
+
+    x = -bond * np.cos(angle)
+    y = bond * np.sin(angle) * np.cos(dihedral)
+    z = bond * np.sin(angle) * np.sin(dihedral)
+
+    return (q1 + x[:, np.newaxis] * bc + y[:, np.newaxis] * m +
+            z[:, np.newaxis] * n)
+
+
+def dummy_recipe(lig_morph, con_morph, lig_final, atom_map, reverse_atom_map,
+                 connect_final, zz_atoms, dummy_atoms):
+    """
+    Determine once the build order of the dummy atoms and for each dummy
+    the reference atoms in the morph and the bond, angle and dihedral as
+    found in the final state.  The recipe only depends on the topology and
+    the final state so it can be applied to any new set of coordinates with
+    place_dummies().
 
     :param lig_morph: the morph molecule
     :type lig_morph: Sire.Mol.Molecule
     :param con_morph: the connectivity of the morph
     :type con_morph: Sire.Mol.Connectivity
-    :param atoms_initial: set of initial atoms
-    :type atoms_initial: Sire.Mol.Selector_Atom
-    :param lig_initial: the initial state molecule
-    :type lig_initial: Sire.Mol.Molecule
     :param lig_final: the final state molecule
     :type lig_final: Sire.Mol.Molecule
     :param atom_map: the forward atom map
@@ -907,12 +1260,13 @@ def dummy_coords(lig_morph, con_morph, atoms_initial, lig_initial, lig_final,
     :param dummy_atoms: the atom indexes of the dummy atoms
     :type dummy_atoms: list of Sire.Mol.AtomIdx
     :raises: SetupError
-    :return: morph molecule, initial state molecule, final state molecule,
-       zz map
-    :rtype: Sire.Mol.Molecule, Sire.Mol.Molecule, Sire.Mol.Molecule,
-       list of Sire.Mol.AtomName
+    :return: recipe of (dummy, bond atom, angle atom, dihedral atom,
+       alternative atom or -1, bond, angle, dihedral) in build order, zz map
+    :rtype: list of tuple, list of Sire.Mol.AtomName
     """
 
+    recipe = []
+
     # Fix coordinates of dummies: needs to be done for every coord set
     # For each dummy, use connectivity to find bond/angle/dihedral
     # Select dihedral that does not involve other dummies
@@ -920,7 +1274,7 @@ def dummy_coords(lig_morph, con_morph, atoms_initial, lig_initial, lig_final,
     # 1 other dummy, then with 2, then with 3
 
     if dummy_atoms:
-        logger.write('Computing coordinates of added dummy atoms')
+        logger.write('Computing build order of added dummy atoms')
         dummies = dummy_atoms[:]
         toprocess = len(dummies)
     else:
@@ -1056,20 +1410,12 @@ def dummy_coords(lig_morph, con_morph, atoms_initial, lig_initial, lig_final,
             at3 = lig_morph.select(search_by_index(at3f.index(),
                                                   reverse_atom_map) )
 
-        q1 = at1.property('coordinates')
-        q2 = at2.property('coordinates')
-        q3 = at3.property('coordinates')
+        q0f = _vec(at0f.property('coordinates') )
+        q1f = _vec(at1f.property('coordinates') )
+        q2f = _vec(at2f.property('coordinates') )
+        q3f = _vec(at3f.property('coordinates') )
 
-        q0f = at0f.property('coordinates')
-        q1f = at1f.property('coordinates')
-        q2f = at2f.property('coordinates')
-        q3f = at3f.property('coordinates')
-
-        bond = Sire.Maths.Vector.distance(q0f, q1f)
-        angle = Sire.Maths.Vector.angle(q0f, q1f, q2f)
-        dihedral = Sire.Maths.Vector.dihedral(q0f, q1f, q2f, q3f)
-
-        coords = Sire.Maths.Vector.generate(bond, q1, angle, q2, dihedral, q3)
+        bond, angle, dihedral = _internal(q0f, q1f, q2f, q3f)
 
         # What if MORE THAN 2 alternates?
         #
@@ -1080,24 +1426,142 @@ def dummy_coords(lig_morph, con_morph, atoms_initial, lig_initial, lig_final,
         # problems.
 
         if len(alternates3f) == 2:
-            # Check if we overlapped dummy with alternates[1]
-            alt3f1c = lig_morph.select(
-                search_by_index(alternates3f[1].index(),
-                               reverse_atom_map)).property('coordinates')
-
-            if Sire.Maths.Vector.distance(coords, alt3f1c) < 0.90:
-                coords = Sire.Maths.Vector.generate(bond, q1, angle, q2,
-                                                    dihedral +
-                                                    120 * Sire.Units.degrees,
-                                                    q3)
+            alt = search_by_index(alternates3f[1].index(),
+                                  reverse_atom_map).value()
+        else:
+            alt = -1
 
-        lig_morph = lig_morph.edit()\
-            .atom(dummy).setProperty('coordinates', coords).molecule().commit()
+        recipe.append( (dummy.value(), at1.index().value(),
+                        at2.index().value(), at3.index().value(), alt,
+                        bond, angle, dihedral) )
 
         dummies.remove(dummy)
         toprocess -= 1
 
-    return lig_morph, lig_initial, lig_final, zz_atoms
+    return recipe, zz_atoms
+
+
+def _place(xyz, recipe):
+    """
+    Compute the dummy coordinates from a recipe in place.  Dummies only
+    depending on atoms with known coordinates are placed together.
+
+    :param xyz: coordinates of the morph, updated for the dummies
+    :type xyz: numpy array Nx3
+    :param recipe: the dummy recipe, see dummy_recipe()
+    :type recipe: list of tuple
+    """
+
+    # dummies depending on dummies are built in a later generation
+    generation = {}
+
+    for entry in recipe:
+        deps = [generation[idx] for idx in entry[1:5] if idx in generation]
+        generation[entry[0]] = max(deps) + 1 if deps else 0
+
+    for gen in range(max(generation.values() ) + 1):
+        rows = [entry for entry in recipe if generation[entry[0]] == gen]
+
+        idx, q1, q2, q3, alt = [np.array(col, dtype=int)
+                                for col in zip(*rows)[:5]]
+        bond, angle, dihedral = [np.array(col) for col in zip(*rows)[5:]]
+
+        coords = _nerf(xyz[q1], xyz[q2], xyz[q3], bond, angle, dihedral)
+
+        # check if we overlapped dummy with the second alternative
+        clash = alt >= 0
+        clash[clash] = np.linalg.norm(coords[clash] - xyz[alt[clash]],
+                                      axis=1) < 0.90
+
+        if clash.any():
+            coords[clash] = _nerf(xyz[q1[clash]], xyz[q2[clash]],
+                                  xyz[q3[clash]], bond[clash], angle[clash],
+                                  dihedral[clash] + 2.0 * math.pi / 3.0)
+
+        xyz[idx] = coords
+
+
+def _set_coords(lig_morph, xyz):
+    """
+    Replace the coordinates property of the morph with a single edit.  The
+    morph has one cut group with the atoms in index order, see map_atoms().
+
+    :param lig_morph: the morph molecule
+    :type lig_morph: Sire.Mol.Molecule
+    :param xyz: coordinates of all atoms of the morph
+    :type xyz: numpy array Nx3
+    :raises: SetupError
+    :return: morph molecule
+    :rtype: Sire.Mol.Molecule
+    """
+
+    if lig_morph.nCutGroups() != 1:
+        raise errors.SetupError('morph molecule must have exactly one cut '
+                                'group but has %i' % lig_morph.nCutGroups() )
+
+    group = Sire.Vol.CoordGroup([Sire.Maths.Vector(x, y, z)
+                                 for x, y, z in xyz])
+    coords = Sire.Mol.AtomCoords(Sire.Vol.CoordGroupArray([group]) )
+
+    return lig_morph.edit().setProperty('coordinates', coords).commit()
+
+
+def place_dummies(lig_morph, recipe):
+    """
+    Compute the dummy coordinates from a recipe created by dummy_recipe().
+
+    :param lig_morph: the morph molecule with coordinates for the non-dummies
+    :type lig_morph: Sire.Mol.Molecule
+    :param recipe: the dummy recipe
+    :type recipe: list of tuple
+    :return: morph molecule
+    :rtype: Sire.Mol.Molecule
+    """
+
+    if not recipe:
+        return lig_morph
+
+    xyz = _coords(lig_morph)
+    _place(xyz, recipe)
+
+    return _set_coords(lig_morph, xyz)
+
+
+def update_coords(lig_morph, reference, ref_idx, recipe):
+    """
+    Take the coordinates of the non-dummy atoms from a reference molecule
+    and place the dummies.  The reference coordinates are mapped onto the
+    morph with one index array and the coordinates property of the morph is
+    replaced as a whole.
+
+    :param lig_morph: the morph molecule
+    :type lig_morph: Sire.Mol.Molecule
+    :param reference: the reference state, i.e. the initial ligand in a new
+       environment
+    :type reference: Sire.Mol.Molecule
+    :param ref_idx: indices of the non-dummies, the same in the morph and in
+       the reference
+    :type ref_idx: numpy array of int
+    :param recipe: the dummy recipe, see dummy_recipe()
+    :type recipe: list of tuple
+    :raises: SetupError
+    :return: morph molecule
+    :rtype: Sire.Mol.Molecule
+    """
+
+    ref_xyz = _coords(reference)
+
+    if len(ref_idx) and ref_idx.max() >= len(ref_xyz):
+        raise errors.SetupError('atom index %i not found in reference' %
+                                ref_idx.max() )
+
+    xyz = np.zeros( (lig_morph.nAtoms(), 3) )
+    xyz[ref_idx] = ref_xyz[ref_idx]
+
+    if recipe:
+        _place(xyz, recipe)
+
+    return _set_coords(lig_morph, xyz)
 
 
 def _get_dihedrals(dihedrals, idx_list):
@@ -1223,7 +1687,7 @@ def patch_parmtop(parm0_fn, parm1_fn, mask0, mask1, copy_dih=True):
                      (parm0_fn, parm1_fn, mask0) )
 
         mask_str = mask0
-        idx_list = [i for i in AmberMask(parm0, mask_str).Selected()]
+        idx_list = AmberMask(parm0, mask_str).indexes().tolist()
         idx_list2 = idx_list
 
         pmemd = False
@@ -1236,8 +1700,9 @@ def patch_parmtop(parm0_fn, parm1_fn, mask0, mask1, copy_dih=True):
 
         mask_str0 = mask0
         mask_str1 = mask1
-        idx_list =  [i for i in AmberMask(parm0, mask_str0).Selected()]
-        idx_list2 = [i for i in AmberMask(parm0, mask_str1).Selected()]
+        tables = MaskTables(parm0)
+        idx_list = AmberMask(tables, mask_str0).indexes().tolist()
+        idx_list2 = AmberMask(tables, mask_str1).indexes().tolist()
 
         pmemd = True
 
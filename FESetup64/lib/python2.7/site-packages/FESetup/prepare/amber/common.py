@@ -37,14 +37,37 @@ __revision__ = "$Id: common.py 621 2016-08-15 13:17:09Z halx $"
 
 
 import os, sys, re, shutil
-import openbabel as ob
-import pybel
+
+import numpy as np
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
 
 import utils                            # relative import
-from FESetup import const, errors, logger, report
+from FESetup import const, errors, logger, report, restart
+from FESetup.lazyimport import LazyModule
 from leap import Leap
 
-import Sire.IO
+ob = LazyModule('openbabel')
+pybel = LazyModule('pybel')
+parmed = LazyModule('parmed')
+Sire = LazyModule('Sire')
+
+
+
+WATER_NAMES = frozenset( ('WAT', 'HOH') )
+ION_TEMPLATE = 'ions'
+
+# leap residue names of the monovalent solvent ions, structural ions like Zn
+# or Mg are part of the solute
+POS_ION_NAMES = frozenset( ('Na+', 'K+', 'Li+', 'Rb+', 'Cs+') )
+NEG_ION_NAMES = frozenset( ('Cl-', 'F-', 'Br-', 'I-') )
+
+# the ions added, must match leap's addIons commands
+POS_ION = 'Na+'
+NEG_ION = 'Cl-'
 
 
 
@@ -88,6 +111,138 @@ def ssbonds(ss_file, offset=0):
     return pairs
 
 
+def box_volume(box):
+    """
+    Volume of a triclinic box.
+
+    :param box: box lengths and optionally angles in degrees
+    :type box: array-like
+    :returns: volume in A^3
+    """
+
+    a, b, c = box[:3]
+
+    if len(box) < 6:
+        return a * b * c
+
+    cosa, cosb, cosg = np.cos(np.radians(box[3:6]) )
+
+    return a * b * c * np.sqrt(1.0 - cosa**2 - cosb**2 - cosg**2 +
+                               2.0 * cosa * cosb * cosg)
+
+
+def ion_numbers(charge, volume, conc):
+    """
+    Number of positive and negative ions needed to neutralise a system and
+    reach an ion concentration.
+
+    :param charge: total charge of the solute
+    :type charge: float
+    :param volume: volume of the box in A^3
+    :type volume: float
+    :param conc: ion concentration in mol/litres
+    :type conc: float
+    :returns: number of positive and negative ions
+    """
+
+    nions = abs(round(charge) )
+
+    # 1 mol/l = 6.022140857*10^23 particles/litre (NIST)
+    # 1 A^3   = 10^-27 l
+    npart = round(0.0006022141 * conc * volume)
+
+    if charge < 0.0:
+        return int(npart + nions), int(npart)
+    elif charge > 0.0:
+        return int(npart), int(npart + nions)
+
+    return int(npart), int(npart)
+
+
+def overlap(ref, coords, box, cutoff):
+    """
+    Find all atoms in coords within cutoff of any atom in ref.  Minimum image
+    for rectangular boxes, other box shapes are searched without periodic
+    images.
+
+    :param ref: reference coordinates
+    :type ref: (N,3) array
+    :param coords: coordinates to be checked
+    :type coords: (M,3) array
+    :param box: box lengths and optionally angles
+    :type box: array-like
+    :param cutoff: distance cutoff
+    :type cutoff: float
+    :returns: boolean array over coords
+    """
+
+    lengths, rect = _box_lengths(box)
+
+    if not len(ref):
+        return np.zeros(len(coords), dtype=bool)
+
+    if rect:
+        ref = _wrap(ref, lengths)
+        coords = _wrap(coords, lengths)
+
+    if cKDTree:
+        if rect:
+            tree = cKDTree(ref, boxsize=lengths)
+        else:
+            tree = cKDTree(ref)
+
+        # upper bound is exclusive in cKDTree
+        dist, _ = tree.query(coords, k=1,
+                             distance_upper_bound=np.nextafter(cutoff, np.inf))
+
+        return dist <= cutoff
+
+    close = np.zeros(len(coords), dtype=bool)
+    cut2 = cutoff * cutoff
+
+    for pos in ref:
+        close |= _dist2(coords, pos, lengths, rect) <= cut2
+
+    return close
+
+
+def _box_lengths(box):
+    """
+    Box lengths and if the box is rectangular.
+    """
+
+    lengths = np.asarray(box[:3], dtype=np.float64)
+    rect = len(box) < 6 or np.allclose(box[3:6], 90.0)
+
+    return lengths, rect
+
+
+def _wrap(coords, lengths):
+    """
+    Wrap coordinates into the rectangular box [0, lengths).
+    """
+
+    coords = np.mod(coords, lengths)
+
+    # mod may round up to the box length
+    coords[coords >= lengths] = 0.0
+
+    return coords
+
+
+def _dist2(coords, pos, lengths, rect):
+    """
+    Squared distances of coords to pos, minimum image for rectangular boxes.
+    """
+
+    diff = coords - pos
+
+    if rect:
+        diff -= lengths * np.round(diff / lengths)
+
+    return np.einsum('ij,ij->i', diff, diff)
+
+
 class Common(object):
     """
     Common methods for the setup protocol.  Used through subclasses for
@@ -150,6 +305,10 @@ class Common(object):
         self._parm_overwrite = None
         self.mdengine = None
 
+        # working directory, all files are relative to it, '' for the current
+        # directory
+        self.workdir = ''
+
         self.leap = Leap(self.force_fields, self.solvent_load)
 
         # set in __init__.py before this __init__(): do not set here or anywhere
@@ -158,17 +317,28 @@ class Common(object):
         #self.solvent_box, self.MDEngine, self.parmchk_version, self.gaff
 
 
+    def _path(self, filename):
+        """
+        Get the path of a file in the working directory.
+
+        :param filename: file name relative to the working directory
+        :type filename: string
+        :returns: path usable from the current directory
+        """
+
+        return os.path.join(self.workdir, filename)
+
+
     # FIXME: remove
-    @staticmethod
-    def copy_files(srcs, filenames=None, overwrite=False):
+    def copy_files(self, srcs, filenames=None, overwrite=False):
         """
-        Copy files from basedir to the current directory.
+        Copy files from basedir to the working directory.
 
         :param src: the source directories to copy from
         :type src: list of str
         :param filenames: the filenames to be copied
         :type filenames: list of str
-        :param overwrite: overwrite the files in the current dir?
+        :param overwrite: overwrite the files in the working dir?
         :type overwrite: bool
         """
 
@@ -176,18 +346,20 @@ class Common(object):
             for src in srcs:
                 logger.write('%sopying directory contents of %s to %s' %
                              ('Overwrite mode: c' if overwrite else 'C', src,
-                              os.getcwd()))
+                              os.path.abspath(self.workdir)))
 
                 if not filenames:
                     filenames = os.listdir(src)
 
                 for filename in filenames:
-                    if overwrite or not os.access(filename, os.F_OK):
+                    dst_file = self._path(filename)
+
+                    if overwrite or not os.access(dst_file, os.F_OK):
                         src_file = os.path.join(src, filename)
 
                         # FIXME: only here to accommodate Complex
                         if os.access(src_file, os.F_OK):
-                            shutil.copy(src_file, '.')
+                            shutil.copy(src_file, dst_file)
 
         except OSError as why:
             raise errors.SetupError(why)
@@ -216,8 +388,9 @@ class Common(object):
 
         leapin = self.leap.generate_init()
 
-        if os.access(const.SSBOND_FILE, os.R_OK):
-            pairs = ssbonds(const.SSBOND_FILE, self.__class__.SSBONDS_OFFSET)
+        if os.access(self._path(const.SSBOND_FILE), os.R_OK):
+            pairs = ssbonds(self._path(const.SSBOND_FILE),
+                            self.__class__.SSBONDS_OFFSET)
             cmd = []
 
             for a, b in pairs:
@@ -279,23 +452,9 @@ class Common(object):
             self.amber_crd = const.LEAP_IONIZED + self.RST_EXT
             self.amber_pdb = const.LEAP_IONIZED + const.PDB_EXT
 
-            nions = abs(round(self.charge) )
-
             # FIXME: check if this is correct
             volume = self.volume * self.density / dens
-
-            # 1 mol/l = 6.022140857*10^23 particles/litre (NIST)
-            # 1 A^3   = 10^-27 l
-            npart = round(0.0006022141 * conc * volume)
-
-            if self.charge < 0.0:
-                npos = npart + nions
-                nneg = npart
-            elif self.charge > 0.0:
-                npos = npart
-                nneg = npart + nions
-            else:
-                npos = nneg = npart
+            npos, nneg = ion_numbers(self.charge, volume, conc)
 
             logger.write('box info: V = %f A^3, rho = %f g/cc\n'
                          'charge = %f; computed #pos = %i, #neg = %i\n' %
@@ -322,6 +481,210 @@ class Common(object):
         return leapin
 
 
+    @report
+    def add_ions(self, conc, dens=1.0, separation=5.0):
+        """
+        Add ions to the solvated system to reach the ion concentration by
+        replacing randomly chosen waters.  Volume and mass are taken from
+        the current topology and coordinates, ions already present count
+        towards the total.  The system is always neutralised, also for a
+        zero concentration.  Waters closer than separation to the solute or
+        to another ion are not replaced.
+
+        :param conc: ion concentration in mol/litres
+        :type conc: float
+        :param dens: expected target density
+        :type dens: float
+        :param separation: minimum distance of ions to solute and ions
+        :type separation: float
+        :raises: SetupError
+        """
+
+        rst = restart.read_restart(self._path(self.amber_crd) )
+
+        if rst.box is None or not len(rst.box):
+            raise errors.SetupError('%s has no periodic box' % self.amber_crd)
+
+        parm = parmed.amber.AmberParm(self._path(self.amber_top) )
+        coords = rst.coords
+
+        self.box_dims = list(rst.box)
+        self.volume = box_volume(rst.box)
+        self.density = (sum(parm.parm_data['MASS']) * const.AMU2GRAMS /
+                        self.volume)
+
+        # FIXME: check if this is correct
+        volume = self.volume * self.density / dens
+        npos, nneg = ion_numbers(self.charge, volume, conc)
+
+        logger.write('box info: V = %f A^3, rho = %f g/cc\n'
+                     'charge = %f; computed #pos = %i, #neg = %i\n' %
+                     (self.volume , self.density, self.charge, npos, nneg) )
+
+        is_water = np.array([atom.residue.name in WATER_NAMES
+                             for atom in parm.atoms])
+        pos_ions = []
+        neg_ions = []
+
+        for residue in parm.residues:
+            if len(residue.atoms) != 1:
+                continue
+
+            if residue.name in POS_ION_NAMES:
+                pos_ions.append(residue.atoms[0].idx)
+            elif residue.name in NEG_ION_NAMES:
+                neg_ions.append(residue.atoms[0].idx)
+
+        npos = max(0, npos - len(pos_ions) )
+        nneg = max(0, nneg - len(neg_ions) )
+
+        # ions already present may not match the solute charge, e.g. after a
+        # charged ligand has been inserted into a neutralised box
+        net = int(round(self.charge) ) + len(pos_ions) - len(neg_ions)
+        net += npos - nneg
+
+        if net > 0:
+            nneg += net
+        elif net < 0:
+            npos -= net
+
+        if not npos and not nneg:
+            logger.write('Ion concentration already reached\n')
+            return
+
+        # first atom of each water as its position
+        first = np.flatnonzero(is_water)
+        first = first[np.r_[True, np.diff([parm.atoms[i].residue.idx
+                                            for i in first]) != 0] ]
+
+        if not len(first):
+            raise errors.SetupError('no waters found in %s' % self.amber_top)
+
+        is_ion = np.zeros(len(parm.atoms), dtype=bool)
+        is_ion[pos_ions + neg_ions] = True
+
+        solute = coords[~is_water & ~is_ion]
+        far = ~overlap(solute, coords[first], rst.box, separation)
+
+        lengths, rect = _box_lengths(rst.box)
+        sep2 = separation * separation
+
+        placed = list(coords[is_ion])
+        chosen = []
+
+        for idx in first[np.random.permutation(np.flatnonzero(far) )]:
+            if len(chosen) == npos + nneg:
+                break
+
+            if (placed and
+                (_dist2(np.array(placed), coords[idx], lengths,
+                        rect) < sep2).any() ):
+                continue
+
+            chosen.append(idx)
+            placed.append(coords[idx])
+
+        if len(chosen) < npos + nneg:
+            raise errors.SetupError('cannot place %i ions further than %.1f '
+                                    'A from solute and other ions' %
+                                    (npos + nneg, separation) )
+
+        logger.write('Replacing %i waters with %i positive and %i negative '
+                     'ions' % (len(chosen), npos, nneg) )
+
+        pos_tmpl, neg_tmpl = self._ion_template(parm)
+
+        remove = set(parm.atoms[idx].residue.idx for idx in chosen)
+        keep = np.array([atom.residue.idx not in remove
+                         for atom in parm.atoms])
+
+        # ions go in front of the solvent
+        head = np.arange(len(parm.atoms) ) < first[0]
+        tail = ~head & keep
+
+        struct = parm.copy(parmed.Structure)
+        ions = parmed.Structure()
+
+        for tmpl, num in (pos_tmpl, npos), (neg_tmpl, nneg):
+            if num:
+                ions += tmpl * num
+
+        crd = np.concatenate( (coords[head], coords[chosen], coords[tail]) )
+
+        self._save_system(struct[head] + ions + struct[tail], crd, rst.box,
+                          const.LEAP_IONIZED)
+
+
+    def _ion_template(self, parm):
+        """
+        Get single Na+ and Cl- structures from the ions in the topology or
+        from a minimal leap run if the topology does not have them.
+
+        :param parm: the topology
+        :type parm: parmed.amber.AmberParm
+        :returns: positive and negative ion structures
+        """
+
+        pos_ions = [res.atoms[0].idx for res in parm.residues
+                    if res.name == POS_ION and len(res.atoms) == 1]
+        neg_ions = [res.atoms[0].idx for res in parm.residues
+                    if res.name == NEG_ION and len(res.atoms) == 1]
+
+        if not pos_ions or not neg_ions:
+            top = ION_TEMPLATE + self.TOP_EXT
+            crd = ION_TEMPLATE + self.RST_EXT
+
+            leapin = (self.leap.generate_ff() +
+                      '\ns = combine {%s %s}\n'
+                      'saveAmberParm s "%s" "%s"\nquit\n' %
+                      (POS_ION, NEG_ION, top, crd) )
+
+            utils.run_leap(top, crd, 'tleap', leapin, self.workdir)
+
+            parm = parmed.amber.AmberParm(self._path(top) )
+            pos_ions = [0]
+            neg_ions = [1]
+
+        struct = parm.copy(parmed.Structure)
+        natoms = len(parm.atoms)
+
+        return [struct[np.arange(natoms) == ion[0]]
+                for ion in (pos_ions, neg_ions)]
+
+
+    def _save_system(self, struct, coords, box, prefix):
+        """
+        Write topology, coordinates and PDB of a periodic system assembled
+        from structures.
+
+        :param struct: the system
+        :type struct: parmed.Structure
+        :param coords: coordinates
+        :type coords: (N,3) array
+        :param box: box lengths and angles
+        :type box: array-like
+        :param prefix: file name prefix
+        :type prefix: string
+        """
+
+        self.amber_top = prefix + self.TOP_EXT
+        self.amber_crd = prefix + self.RST_EXT
+        self.amber_pdb = prefix + const.PDB_EXT
+
+        parm = parmed.amber.AmberParm.from_structure(struct)
+        parm.box = box
+
+        parm.write_parm(self._path(self.amber_top) )
+        restart.write_rst7(self._path(self.amber_crd), coords, box=box)
+
+        # the PDB has the origin at the centre of the box like leap's
+        parm.coordinates = coords - np.asarray(box[:3]) / 2.0
+        parm.save(self._path(self.amber_pdb), overwrite=True)
+
+        self.box_dims = list(box)
+        self.sander_crd = self.amber_crd
+
+
     def setup_MDEngine(self, mdprog = 'sander', mdpref = '', mdpost = ''):
         """
         Instantiate MD engine.
@@ -332,7 +695,8 @@ class Common(object):
         self.mdengine = self.MDEngine(self.amber_top, self.amber_crd,
                                       self.sander_crd, self.sander_rst,
                                       self.amber_pdb, self.box_dims,
-                                      self.solvent, mdprog, mdpref, mdpost)
+                                      self.solvent, mdprog, mdpref, mdpost,
+                                      self.workdir)
 
 
     @report
@@ -400,9 +764,11 @@ class Common(object):
         self.mdengine.md(namelist, nsteps, T, p, restraint, restr_force,
                          nrestr, wrap)
 
-        # FIXME: do we also want to density?
-        self.box_dims = self.mdengine.get_box_dims()
-        self.amber_crd = self.mdengine.sander_crd  # FIXME: only for AMBER
+        # queued stages have no results yet, updated in to_rst7
+        if not self.mdengine.chain:
+            # FIXME: do we also want to density?
+            self.box_dims = self.mdengine.get_box_dims()
+            self.amber_crd = self.mdengine.sander_crd  # FIXME: only for AMBER
 
 
     def to_rst7(self):
@@ -415,6 +781,9 @@ class Common(object):
         self.mdengine.to_rst7()
         self.amber_crd = self.mdengine.sander_crd
 
+        if self.mdengine.chain:
+            self.box_dims = self.mdengine.get_box_dims()
+
 
     @report
     def flatten_rings(self):
@@ -446,7 +815,8 @@ class Common(object):
                      ', '.join(const.AROMATICS) )
 
         amber = Sire.IO.Amber()
-        molecules = amber.readCrdTop(self.amber_crd, self.amber_top)[0]
+        molecules = amber.readCrdTop(self._path(self.amber_crd),
+                                     self._path(self.amber_top) )[0]
 
         zmat_maker = Sire.IO.ZmatrixMaker()
         protein_zmatrices = os.path.join(Sire.Config.parameter_directory,
@@ -505,7 +875,7 @@ class Common(object):
             molec = curr_mol.edit().setProperty('coordinates', ncoor).commit()
             newmols.add(molec)
 
-        Sire.IO.PDB().write(newmols, const.FLAT_RINGS_FILE)
+        Sire.IO.PDB().write(newmols, self._path(const.FLAT_RINGS_FILE) )
 
         self.amber_pdb = const.FLAT_RINGS_FILE
         self.mol_file = self.amber_pdb
@@ -524,11 +894,7 @@ class Common(object):
         if not filename:
             filename = self.sander_rst
 
-        with open(filename, 'r') as rst:
-            for line in rst:
-                self.box_dims = line
-
-        self.box_dims = self.box_dims.split()
+        self.box_dims = restart.read_box(self._path(filename) )
 
 
     # called in common.py/_amber_top_common (1x)
@@ -542,7 +908,8 @@ class Common(object):
 
         # Sire.Mol.Molecules, Sire.Vol.PeriodicBox or Sire.Vol.Cartesian
         molecules, space = \
-                   Sire.IO.Amber().readCrdTop(self.amber_crd, self.amber_top)
+                   Sire.IO.Amber().readCrdTop(self._path(self.amber_crd),
+                                              self._path(self.amber_top) )
 
         if space.isPeriodic():
             self.volume = space.volume().value()  # in A^3
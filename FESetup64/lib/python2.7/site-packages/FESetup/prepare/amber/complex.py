@@ -21,7 +21,9 @@ r"""
 A class to build a complex.  Derives from Common.
 
 The complex Setup class composes a complex object from a protein and a ligand
-object.  The class can create an AMBER topology file for the complex.
+object.  The class can create an AMBER topology file for the complex, either
+solvated from scratch by leap or by inserting the ligand into a pre-solvated,
+equilibrated protein box.
 """
 
 
@@ -29,14 +31,22 @@ __revision__ = "$Id: complex.py 580 2016-05-13 08:24:28Z halx $"
 
 
 
+import numpy as np
+
 import FESetup
-from FESetup import const, errors, logger
+from FESetup import const, errors, logger, restart
+from FESetup.lazyimport import LazyModule
 import utils
 
 from ligand import Ligand
 from protein import Protein
 from common import *
+from common import _box_lengths
+
+parmed = LazyModule('parmed')
 
+# maximum RMSD in A of the vacuum protein fitted onto the equilibrated one
+MAX_FIT_RMSD = 5.0
 
 
 class Complex(Common):
@@ -101,13 +111,20 @@ class Complex(Common):
         energy setups.
         """
 
+        # the ligand MOL2/GAFF file is converted once in the ligand directory
+        # and shared by all complexes and morphs of the ligand
+        src = self.ligand.workdir
+
+        if not os.access(os.path.join(src, const.LIGAND_AC_FILE), os.F_OK):
+            src = self.workdir
+
         # ensure ligand is in MOL2/GAFF format
-        if os.access(const.LIGAND_AC_FILE, os.F_OK):
+        if os.access(os.path.join(src, const.LIGAND_AC_FILE), os.F_OK):
             mol_file = const.GAFF_MOL2_FILE
-            antechamber = utils.check_amber('antechamber')
-            utils.run_amber(antechamber,
-                            '-i %s -fi ac -o %s -fo mol2 -j 1 -at %s -pf y' %
-                            (const.LIGAND_AC_FILE, mol_file, gaff) )
+            utils.ac_to_mol2(const.LIGAND_AC_FILE, const.COMPLEX_MOL2_FILE,
+                             gaff, '-j 1 -pf y', src)
+            shutil.copyfile(os.path.join(src, const.COMPLEX_MOL2_FILE),
+                            self._path(mol_file) )
             self.ligand_fmt = 'mol2'
         else:
             # antechamber has trouble with dummy atoms
@@ -164,7 +181,100 @@ class Complex(Common):
                                         remove_first=remove_first,
                                         conc=conc, dens=dens)
 
-        utils.run_leap(self.amber_top, self.amber_crd, 'tleap', leapin)
+        utils.run_leap(self.amber_top, self.amber_crd, 'tleap', leapin,
+                       self.workdir)
+
+
+    @report
+    def create_top_presolvated(self, prot_top, prot_crd, cutoff=2.2,
+                               conc=0.0, dens=1.0):
+        """
+        Create the solvated complex from the solvated and equilibrated protein
+        box instead of solvating from scratch.  The vacuum complex is fitted
+        onto the equilibrated protein, the ligand inserted and all waters
+        within cutoff of any ligand atom removed.  Finally ions are added to
+        neutralise the ligand charge and to reach the ion concentration.
+        Requires the vacuum complex from create_top(boxtype='').
+
+        :param prot_top: topology of the solvated protein
+        :type prot_top: string
+        :param prot_crd: equilibrated coordinates of the solvated protein
+        :type prot_crd: string
+        :param cutoff: overlap distance between ligand and water atoms
+        :type cutoff: float
+        :param conc: ion concentration in mol/litres
+        :type conc: float
+        :param dens: expected target density
+        :type dens: float
+        :raises: SetupError
+        """
+
+        rst = restart.read_restart(self._path(prot_crd) )
+
+        if rst.box is None or not len(rst.box):
+            raise errors.SetupError('%s has no periodic box' % prot_crd)
+
+        solv = parmed.amber.AmberParm(self._path(prot_top) )
+        vac = parmed.amber.AmberParm(self._path(self.amber_top) )
+        vac_crd = restart.read_restart(self._path(self.amber_crd) ).coords
+
+        # leap combines the ligand as first unit, see remove_first
+        nlig = len(vac.residues[0].atoms)
+        nprot = len(vac.atoms) - nlig
+
+        if (len(solv.atoms) < nprot or
+            [a.name for a in vac.atoms[nlig:]] !=
+            [a.name for a in solv.atoms[:nprot]]):
+            raise errors.SetupError('protein in %s does not match the protein '
+                                    'in %s' % (prot_top, self.amber_top) )
+
+        # the protein box was wrapped per molecule
+        prot_xyz = _make_whole(rst.coords[:nprot], vac_crd[nlig:], rst.box,
+                               solv.parm_data.get('ATOMS_PER_MOLECULE') )
+
+        rot, mob_cen, ref_cen = _fit(vac_crd[nlig:], prot_xyz)
+
+        fitted = np.dot(vac_crd[nlig:] - mob_cen, rot.T) + ref_cen
+        rmsd = np.sqrt(((fitted - prot_xyz)**2).sum(axis=1).mean() )
+
+        if rmsd > MAX_FIT_RMSD:
+            raise errors.SetupError('protein in %s does not fit onto the '
+                                    'protein in %s (RMSD %.2f A)' %
+                                    (prot_crd, self.amber_crd, rmsd) )
+
+        lig_crd = np.dot(vac_crd[:nlig] - mob_cen, rot.T) + ref_cen
+
+        close = overlap(lig_crd, rst.coords[nprot:], rst.box, cutoff)
+
+        remove = set()
+
+        for idx in np.flatnonzero(close):
+            residue = solv.atoms[nprot + idx].residue
+
+            if residue.name in WATER_NAMES:
+                remove.add(residue.idx)
+            else:
+                logger.write('Warning: ligand overlaps with %s %i' %
+                             (residue.name, residue.idx + 1) )
+
+        logger.write('Inserting ligand into pre-solvated box %s, removing '
+                     '%i overlapping waters' % (prot_crd, len(remove) ) )
+
+        keep = np.array([atom.residue.idx not in remove
+                         for atom in solv.atoms])
+        crd = np.concatenate( (lig_crd, rst.coords[keep]) )
+
+        solv.strip(~keep)
+        vac.strip('!:1')
+
+        self._save_system(vac.copy(parmed.Structure) + solv, crd, rst.box,
+                          const.LEAP_SOLVATED)
+
+        solv.write_parm(self._path(const.NOT_FIRST_TOP) )
+        restart.write_rst7(self._path(const.NOT_FIRST_CRD), crd[nlig:],
+                           box=rst.box)
+
+        self.add_ions(conc, dens)
 
 
     @report
@@ -188,7 +298,8 @@ class Complex(Common):
         import Sire.IO
 
         amber = Sire.IO.Amber()
-        molecules, space = amber.readCrdTop(self.sander_crd, self.amber_top)
+        molecules, space = amber.readCrdTop(self._path(self.sander_crd),
+                                            self._path(self.amber_top) )
 
         moleculeNumbers = molecules.molNums()
         moleculeNumbers.sort()
@@ -285,10 +396,77 @@ class Complex(Common):
 
             lines.append('%s\n' % line)
 
-        with open(const.PROTEIN_FLEX_FILE, 'w') as output:
+        with open(self._path(const.PROTEIN_FLEX_FILE), 'w') as output:
             output.write(''.join(lines))
 
 
 
+def _make_whole(coords, reference, box, mol_sizes):
+    """
+    Shift the molecules of a protein wrapped into a rectangular box by box
+    vectors such that their arrangement matches the reference, i.e. image
+    each molecule onto the first one.
+
+    :param coords: protein coordinates from the periodic box
+    :type coords: (N,3) array
+    :param reference: protein coordinates in vacuum
+    :type reference: (N,3) array
+    :param box: box lengths and optionally angles
+    :type box: array-like
+    :param mol_sizes: number of atoms of each molecule in the box
+    :type mol_sizes: list of int
+    :returns: the imaged coordinates
+    """
+
+    lengths, rect = _box_lengths(box)
+
+    if not rect or not mol_sizes:
+        return coords
+
+    coords = coords.copy()
+    start = 0
+    bounds = []
+
+    for size in mol_sizes:
+        if start >= len(coords):
+            break
+
+        bounds.append( (start, min(start + size, len(coords) ) ) )
+        start += size
+
+    first = bounds[0]
+    cen0 = coords[first[0]:first[1]].mean(axis=0)
+    ref0 = reference[first[0]:first[1]].mean(axis=0)
+
+    for begin, end in bounds[1:]:
+        shift = ( (coords[begin:end].mean(axis=0) - cen0) -
+                  (reference[begin:end].mean(axis=0) - ref0) )
+        coords[begin:end] -= lengths * np.round(shift / lengths)
+
+    return coords
+
+
+def _fit(mobile, reference):
+    """
+    Least squares fit (Kabsch) of mobile onto reference coordinates.
+
+    :returns: rotation matrix and centres of mobile and reference such that
+              dot(mobile - mob_cen, rot.T) + ref_cen fits reference
+    """
+
+    mob_cen = mobile.mean(axis=0)
+    ref_cen = reference.mean(axis=0)
+
+    cov = np.dot( (mobile - mob_cen).T, reference - ref_cen)
+    u, _, vt = np.linalg.svd(cov)
+
+    # avoid reflections
+    d = np.sign(np.linalg.det(np.dot(vt.T, u.T) ) )
+    rot = np.dot(vt.T * np.array([1.0, 1.0, d]), u.T)
+
+    return rot, mob_cen, ref_cen
+
+
+
 if __name__ == '__main__':
     pass
@@ -0,0 +1,284 @@
+#  Copyright (C) 2016  Hannes H Loeffler
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  For full details of the license please see the COPYING file
+#  that should have come with this distribution.
+
+r"""
+Campaign-wide cache of parmchk frcmod fragments.
+
+The parameters parmchk generates for a molecule only depend on the atom type
+tuples of its bonds, angles, dihedrals and impropers.  Every parmchk run is
+split into per-term fragments keyed by those type tuples.  A molecule whose
+terms have all been seen before gets its frcmod file assembled from the
+cached fragments, otherwise parmchk is run and its output added to the cache.
+"""
+
+__revision__ = "$Id$"
+
+
+
+import os
+
+from FESetup import errors, logger
+import utils
+
+
+
+SECTIONS = ('MASS', 'BOND', 'ANGLE', 'DIHE', 'IMPROPER', 'NONBON')
+
+# width of the atom type field in the parameter lines of a section
+_KEY_WIDTH = {'BOND': 5, 'ANGLE': 8, 'DIHE': 11, 'IMPROPER': 11}
+
+# (program, gaff) -> {term key: list of frcmod lines}, no lines for terms
+# which are not missing
+_fragments = {}
+
+
+def signature(infile, informat):
+    """
+    Get the term signature of a molecule: the keys of all its masses,
+    bonds, angles, dihedrals and impropers by atom types.
+
+    :param infile: the AC or MOL2 file
+    :type infile: string
+    :param informat: the file format, ac or mol2
+    :type informat: string
+    :raises: SetupError
+    :returns: set of term keys
+    """
+
+    if informat == 'ac':
+        types, bonds = _read_ac(infile)
+    elif informat == 'mol2':
+        types, bonds = _read_mol2(infile)
+    else:
+        raise errors.SetupError('unsupported format %s for term signature' %
+                                informat)
+
+    neighbours = dict( (idx, []) for idx in types)
+
+    for i, j in bonds:
+        neighbours[i].append(j)
+        neighbours[j].append(i)
+
+    terms = set()
+
+    for idx, atype in types.iteritems():
+        terms.add( ('MASS', atype) )
+        terms.add( ('NONBON', atype) )
+
+        nbs = neighbours[idx]
+
+        for m, a in enumerate(nbs):
+            for c in nbs[m+1:]:
+                terms.add(_key('ANGLE', (types[a], atype, types[c]) ) )
+
+        if len(nbs) == 3:
+            terms.add(_key('IMPROPER', [types[n] for n in nbs] + [atype]) )
+
+    for i, j in bonds:
+        terms.add(_key('BOND', (types[i], types[j]) ) )
+
+        for a in neighbours[i]:
+            if a == j:
+                continue
+
+            for d in neighbours[j]:
+                if d == i or d == a:
+                    continue
+
+                terms.add(_key('DIHE', (types[a], types[i], types[j],
+                                        types[d]) ) )
+
+    return terms
+
+
+def parmchk(program, gaff, infile, informat, outfile, params, cwd=None):
+    """
+    Create a frcmod file from cached fragments or run parmchk if the molecule
+    has terms not seen before.
+
+    :param program: the parmchk executable
+    :type program: string
+    :param gaff: GAFF version
+    :type gaff: string
+    :param infile: the AC or MOL2 file
+    :type infile: string
+    :param informat: the file format, ac or mol2
+    :type informat: string
+    :param outfile: the frcmod file
+    :type outfile: string
+    :param params: the full parmchk command line parameters
+    :type params: string
+    :param cwd: working directory, file names are relative to it
+    :type cwd: string
+    """
+
+    infile = os.path.join(cwd or '', infile)
+    outfile_path = os.path.join(cwd or '', outfile)
+
+    try:
+        terms = signature(infile, informat)
+    except (errors.SetupError, IOError, IndexError, KeyError, ValueError):
+        terms = None
+
+    cache = _fragments.setdefault( (program, gaff), {})
+
+    if terms and all(term in cache for term in terms):
+        logger.write('Assembling %s from cached parmchk fragments' % outfile)
+        _write(outfile_path, [(term, cache[term]) for term in sorted(terms)])
+        return
+
+    utils.run_amber(program, params, cwd)
+
+    if not terms or not os.access(outfile_path, os.F_OK):
+        return
+
+    fragments = _read(outfile_path)
+
+    # only learn from runs where every fragment belongs to a known term
+    if fragments is None or not set(fragments).issubset(terms):
+        logger.write('Warning: cannot split %s into fragments, not cached' %
+                     outfile)
+        return
+
+    for term in terms:
+        cache[term] = fragments.get(term, [])
+
+
+def _key(section, atypes):
+    """
+    Canonical key of a term: bonds, angles and dihedrals read the same
+    both ways.  Impropers are passed with the central atom last and the outer
+    atoms are unordered.
+    """
+
+    atypes = tuple(atypes)
+
+    if section == 'IMPROPER':
+        return (section, ) + tuple(sorted(atypes[:3]) ) + atypes[3:]
+
+    return (section, ) + min(atypes, atypes[::-1])
+
+
+def _read_ac(filename):
+    """
+    Read atom types and bonds from an AC file.
+    """
+
+    types = {}
+    bonds = []
+
+    with open(filename, 'r') as ac:
+        for line in ac:
+            if line.startswith('ATOM'):
+                fields = line.split()
+                types[int(fields[1])] = fields[-1]
+            elif line.startswith('BOND'):
+                fields = line.split()
+                bonds.append( (int(fields[2]), int(fields[3]) ) )
+
+    return types, bonds
+
+
+def _read_mol2(filename):
+    """
+    Read atom types and bonds from a MOL2 file.
+    """
+
+    types = {}
+    bonds = []
+    section = ''
+
+    with open(filename, 'r') as mol2:
+        for line in mol2:
+            if line.startswith('@<TRIPOS>'):
+                section = line[9:].strip()
+                continue
+
+            fields = line.split()
+
+            if not fields:
+                continue
+
+            if section == 'ATOM':
+                types[int(fields[0])] = fields[5]
+            elif section == 'BOND':
+                bonds.append( (int(fields[1]), int(fields[2]) ) )
+
+    return types, bonds
+
+
+def _read(filename):
+    """
+    Split a frcmod file into fragments keyed by term.
+
+    :returns: dict of term key to list of lines or None if the file contains
+              lines that cannot be attributed to a term
+    """
+
+    fragments = {}
+    section = ''
+
+    with open(filename, 'r') as frcmod:
+        frcmod.readline()                   # title
+
+        for line in frcmod:
+            word = line.strip()
+
+            if word in SECTIONS:
+                section = word
+                continue
+
+            if not word:
+                continue
+
+            if section in _KEY_WIDTH:
+                atypes = [t.strip() for t in
+                          line[:_KEY_WIDTH[section]].split('-')]
+
+                if section == 'IMPROPER':
+                    # AMBER: central atom third
+                    atypes = atypes[:2] + atypes[3:] + atypes[2:3]
+
+                term = _key(section, atypes)
+            elif section:
+                term = (section, word.split()[0])
+            else:
+                return None
+
+            fragments.setdefault(term, []).append(line)
+
+    return fragments
+
+
+def _write(filename, fragments):
+    """
+    Write a frcmod file from fragments.
+    """
+
+    with open(filename, 'w') as frcmod:
+        frcmod.write('Remark line goes here\n')
+
+        for section in SECTIONS:
+            frcmod.write(section + '\n')
+
+            for term, lines in fragments:
+                if term[0] == section:
+                    frcmod.writelines(lines)
+
+            frcmod.write('\n')
@@ -553,7 +553,8 @@ class GromacsTop(object):
             for mt in self.top.moleculetype:
                 if pertname and not first:  # FIXME: ligand first mol
                     if typename:
-                        top.write('#include "%s"\n' % typename)
+                        top.write('#include "%s"\n' %
+                                  os.path.basename(typename) )
 
                     top.write('\n#include "%s"\n' % itp_inc_file)
                     mt.molname = pertname
@@ -66,7 +66,7 @@ class Leap(object):
         self.force_fields.add(ff)
 
 
-    def generate_init(self):
+    def generate_ff(self):
         leap_cmds = []
 
         for ff in self.force_fields:
@@ -75,7 +75,13 @@ class Leap(object):
         leap_cmds.append(self.solvents)
 
         for up in self.user_params:
-            leap_cmds(up)
+            leap_cmds.append(up)
+
+        return '\n'.join(leap_cmds)
+
+
+    def generate_init(self):
+        leap_cmds = [self.generate_ff()]
 
         load_cmd = {'pdb': 'loadPDB', 'mol2': 'loadmol2'}
 
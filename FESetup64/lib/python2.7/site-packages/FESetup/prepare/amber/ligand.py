@@ -36,21 +36,25 @@ __revision__ = "$Id: ligand.py 642 2017-02-09 08:52:37Z halx $"
 
 
 
-import os, math, shutil
+import os, math, shutil, tempfile, time
 
-import openbabel as ob
+import numpy as np
 
 import FESetup
 from FESetup import const, errors, logger
-from . import dlfield
+from FESetup.lazyimport import LazyModule
+from . import dlfield, frcmod
 from common import *
 import utils
 
-import Sire.IO
+ob = LazyModule('openbabel')
+parmed = LazyModule('parmed')
+Sire = LazyModule('Sire')
 
 
 
 SQM_OUT = 'sqm.out'
+SQM_POLL = 0.5                           # s between checks of raced sqm runs
 
 GAUSS_INP = 'esp.in'
 GUS_INP = 'esp.inp'
@@ -98,14 +102,114 @@ GB_MIN_IN = '''Minimise whole system
  /
 '''
 
+def _sqm_namelist(scfconv, tight, itrmax, maxcyc, sqm_extra):
+    """
+    Create the sqm namelist variables passed to antechamber with -ek.
+    """
+
+    return ("qm_theory='AM1',grms_tol=0.0002,tight_p_conv=%i,\n  "
+            "scfconv=%s,itrmax=%i,pseudo_diag=1,\n  "
+            "maxcyc=%i,\n%s" % (tight, scfconv, itrmax, maxcyc, sqm_extra) )
+
+
+def _sqm_failure(stdout, sqm_out, sqm_path):
+    """
+    Classify a failed antechamber/sqm run.  Returns normally only if SCF has
+    not converged.
+
+    :param stdout: standard output of antechamber
+    :type stdout: string
+    :param sqm_out: the sqm output file
+    :type sqm_out: string
+    :param sqm_path: path to the sqm output file for the error message
+    :type sqm_path: string
+    :raises: SetupError
+    """
+
+    if 'the assigned bond types may be wrong' in stdout:
+        logger.write('Error: antechamber failed to assign '
+                     'atom/bond types properly\n')
+        raise errors.SetupError('antechamber cannot assign atom '
+                                'and/or bond types, check input '
+                                'structure, e.g. with acdoctor')
+
+    if os.access(sqm_out, os.F_OK):
+        with open(sqm_out, 'r') as sqm:
+            for line in sqm:
+                if 'Unable to achieve self consistency' in line:
+                    return
+
+                if 'odd number of electrons' in line:
+                    logger.write('Error: odd electron number\n')
+                    raise errors.SetupError('wrong ligand charge, or '
+                                            'radical')
+
+    raise errors.SetupError('unknown error see log file and %s file' %
+                            sqm_path)
+
+
+def _mol2_charges(filename):
+    """
+    Read the atom charges from a MOL2 file.
+
+    :param filename: the MOL2 file
+    :type filename: string
+    :returns: the charges
+    :rtype: numpy.ndarray
+    """
+
+    charges = []
+    in_atoms = False
+
+    with open(filename, 'r') as mol2:
+        for line in mol2:
+            if line.startswith('@<TRIPOS>'):
+                in_atoms = line.startswith('@<TRIPOS>ATOM')
+                continue
+
+            if in_atoms and line.strip():
+                charges.append(line.split()[8])
+
+    return np.array(charges, dtype=np.float64)
+
+
+def _min_steps(mdout):
+    """
+    Get the number of the last minimisation step from a sander output file.
+
+    :param mdout: the sander output file
+    :type mdout: string
+    :rtype: integer
+    """
+
+    nstep = 0
+    found = False
+
+    with open(mdout, 'r') as sander_out:
+        for line in sander_out:
+            if line.startswith('   NSTEP'):
+                found = True
+                continue
+
+            if found:
+                nstep = int(line.split()[0])
+                found = False
+
+    return nstep
+
+
 def _calc_gb_charge(ac_file, frcmod_file, charge, scfconv, tight,
-                    sqm_extra, antechamber, gaff):
+                    sqm_extra, antechamber, gaff, workdir=''):
     """
     Compute AM1/BCC charges using a GB model via the sander QM/MM
     interface. So far, this does not prevent zwitterions from 'folding'
     but helps/enables wave function convergence, also - but not only -
     because sander does not terminate when SCF does not converge.
 
+    The topology is built only once.  Each iteration minimises from the
+    previous restart file and then only updates the charges in the topology.
+    The loop stops as soon as the geometry or the charges have converged.
+
     :param ac_file: the input AC file
     :type ac_file: string
     :param frcmod_file: the initial frcmod file
@@ -122,10 +226,11 @@ def _calc_gb_charge(ac_file, frcmod_file, charge, scfconv, tight,
     :type antechamber: string
     :param gaff: 'gaff' or 'gaff2'
     :type gaff: string
+    :param workdir: working directory, file names are relative to it
+    :type workdir: string
     :returns: bool if converged or not
     """
 
-    tleap = utils.check_amber('tleap')
     sander = utils.check_amber('sander')
 
     step = 0
@@ -134,7 +239,6 @@ def _calc_gb_charge(ac_file, frcmod_file, charge, scfconv, tight,
     minin = const.GB_PREFIX + os.extsep + 'in'
     top = const.GB_PREFIX + os.extsep + 'parm7'
     crd = const.GB_PREFIX + os.extsep + 'rst7'
-    ch_file = const.GB_PREFIX + os.extsep + 'charges'
     tmp_mol2 = const.GB_PREFIX + '_tmp' + os.extsep + 'mol2'
     mol2_file = fmt % (const.GB_PREFIX, step, os.extsep + 'mol2')
 
@@ -146,20 +250,23 @@ def _calc_gb_charge(ac_file, frcmod_file, charge, scfconv, tight,
 
     utils.run_amber(antechamber,
                     '-i %s -fi ac '
-                    '-o %s -fo mol2' % (ac_file, mol2_file) )
+                    '-o %s -fo mol2' % (ac_file, mol2_file), workdir)
 
     # FIXME: may want to change maxcyc
-    with open(minin, 'w') as min:
+    with open(os.path.join(workdir, minin), 'w') as min:
         min.write(GB_MIN_IN % (GB_MAX_STEP, GB_MAX_STEP, GB_MAX_STEP,
                                charge, sqm_params) )
 
-    first = True
+    utils.run_leap(top, crd, 'tleap',
+                   GB_LEAP_IN % (frcmod_file, mol2_file, top, crd), workdir)
+
+    parm = parmed.amber.AmberParm(os.path.join(workdir, top) )
+    old_charges = None
+    converged = False
 
     # FIXME: more robust error checking!
     for i in range(0, GB_MAX_ITER):
-        leap_script = GB_LEAP_IN % (frcmod_file, mol2_file, top, crd)
-
-        utils.run_leap(top, crd, 'tleap', leap_script)
+        start = time.time()
 
         step += 1
         mdout = fmt % (const.GB_PREFIX, step, os.extsep + 'out')
@@ -168,7 +275,8 @@ def _calc_gb_charge(ac_file, frcmod_file, charge, scfconv, tight,
         utils.run_amber(sander, '-O -i %s -c %s -p %s -o %s '
                         '-r %s -inf %s' % (minin, crd, top, mdout, rstrt,
                                            const.GB_PREFIX + os.extsep +
-                                           'info') )
+                                           'info'), workdir)
+        crd = rstrt
 
         # work-around for AmberTools14 antechamber which does not
         # write the coordinates from the rst7 to sqm.pdb
@@ -176,7 +284,7 @@ def _calc_gb_charge(ac_file, frcmod_file, charge, scfconv, tight,
                         '-i %s -fi ac '
                         '-a %s -fa rst -ao crd '
                         '-o %s -fo mol2' %
-                        (ac_file, rstrt, tmp_mol2) )
+                        (ac_file, rstrt, tmp_mol2), workdir)
 
         mol2_file = fmt % (const.GB_PREFIX, step, os.extsep + 'mol2')
 
@@ -186,65 +294,37 @@ def _calc_gb_charge(ac_file, frcmod_file, charge, scfconv, tight,
                         '-ek "%s" '
                         '-i %s -fi mol2 '
                         '-o %s -fo mol2'
-                        % (charge, gaff, sqm_nml, tmp_mol2, mol2_file) )
+                        % (charge, gaff, sqm_nml, tmp_mol2, mol2_file),
+                        workdir)
 
-        # geometry converged?
-        found = False
-        nstep = 0
+        nstep = _min_steps(os.path.join(workdir, mdout) )
+        charges = _mol2_charges(os.path.join(workdir, mol2_file) )
 
-        with open(mdout, 'r') as sander_out:
-            for line in sander_out:
-                if line.startswith('   NSTEP'):
-                    found = True
-                    continue
+        if old_charges is None:
+            delta = float('inf')
+        else:
+            delta = np.abs(charges - old_charges).max()
 
-                if found:
-                    nstep = int(line.split()[0])
-                    found = False
+        logger.write('GB charge iteration %i: %i minimisation steps, maximum '
+                     'charge change %.4f, %.1f s' %
+                     (step, nstep, delta, time.time() - start) )
 
-        if nstep < GB_MAX_STEP:
+        # geometry or charges converged?
+        if nstep < GB_MAX_STEP or delta <= GB_MAX_CHARGE:
             converged = True
             break
 
-        # charges convergenced?
-        utils.run_amber(antechamber,
-                        '-i %s -fi mol2 '
-                        '-o %s -fo mol2 '
-                        '-cf %s -c wc -s 2 ' %
-                        (mol2_file, tmp_mol2, ch_file) )
-
-        charges = []
-
-        with open(ch_file, 'r') as infile:
-            for line in infile:
-                elems = line.split()
-    
-                for elem in elems:
-                    chg = float(elem)
-                    charges.append(chg)
-
-        if first:
-            old_charges = charges
-            first = False
-            continue
-
-        converged = True
-
-        for ch1, ch2 in zip(charges, old_charges):
-            if (math.fabs(ch1) - math.fabs(ch2) ) > GB_MAX_CHARGE:
-                converged = False
-                break
-
-        if converged:
-            break
+        for atom, chg in zip(parm.atoms, charges):
+            atom.charge = chg
 
+        parm.write_parm(os.path.join(workdir, top) )
         old_charges = charges
 
     # FIXME: do not read and write to the same AC file?
     utils.run_amber(antechamber,
                     '-i %s -fi mol2 '
                     '-o %s -fo ac -pf y ' %
-                    (mol2_file, ac_file) )
+                    (mol2_file, ac_file), workdir)
 
     return converged
     
@@ -298,7 +378,7 @@ class Ligand(Common):
 
 
     @report
-    def param(self, gb_charges=False, sqm_strategy=None):
+    def param(self, gb_charges=False, sqm_strategy=None, sqm_parallel=1):
         """
         Compute symmetrized AM1/BCC charges and generate missing forcefield
         parameters. Runs antechamber, parmchk. Finally generated MOL2 file
@@ -309,6 +389,8 @@ class Ligand(Common):
         :param sqm_strategy: a strategy pattern using preminimize() and setting
            the SCF convergence criterion for sqm
         :type sqm_strategy: list of 2-tuples
+        :param sqm_parallel: number of sqm_strategy entries run concurrently
+        :type sqm_parallel: int
         :raises: SetupError
         """
 
@@ -336,7 +418,7 @@ class Ligand(Common):
             ]
 
         tmp_file = const.LIGAND_TMP + os.extsep + self.mol_fmt
-        shutil.copyfile(self.mol_file, tmp_file)
+        shutil.copyfile(self._path(self.mol_file), self._path(tmp_file) )
 
         # NOTE: The main problem is SCF convergence. If this happens MM
         #       minimisation is used to hope to obtain a better structure with a
@@ -373,55 +455,46 @@ class Ligand(Common):
 
         logger.write('Optimizing structure and creating AM1/BCC charges')
         premin_done = False
+        sce = False
 
-        for premin, scfconv, tight, itrmax, maxcyc, sqm_extra in sqm_strategy:
-            converged = False
+        if sqm_parallel > 1 and len(sqm_strategy) > 1:
+            win = self._race_sqm(antechamber, ac_cmd, sqm_strategy,
+                                 sqm_parallel)
+            converged = win is not None
 
-            if premin:
-                self.preminimize(nsteps = premin)
-                premin_done = True
-
-            sqm_nlv = ("qm_theory='AM1',grms_tol=0.0002,tight_p_conv=%i,\n  "
-                       "scfconv=%s,itrmax=%i,pseudo_diag=1,\n  "
-                       "maxcyc=%i,\n%s" %
-                       (tight, scfconv, itrmax, maxcyc, sqm_extra) )
-            ek = ['-ek "%s"' % sqm_nlv]  # sqm namelist variables
-
-            # FIXME: Buffering messes with the stdout output order of
-            #        antechamber (last line comes first).  Use stdbuf, pexpect
-            #        or pty (probably Linux only)?
-            err = utils.run_amber(antechamber, ' '.join(ac_cmd + ek) )
-
-            if err:
-                if 'the assigned bond types may be wrong' in err[0]:
-                    logger.write('Error: antechamber failed to assign '
-                                 'atom/bond types properly\n')
-                    raise errors.SetupError('antechamber cannot assign atom '
-                                            'and/or bond types, check input '
-                                            'structure, e.g. with acdoctor')
-
-                sce = False
-
-                with open(SQM_OUT, 'r') as sqm:
-                    for line in sqm:
-                        if 'Unable to achieve self consistency' in line:
-                            logger.write('Warning: SCF has not converged '
-                                         'with %i %s\n' % (premin, scfconv) )
-                            sce = True
-                            break
-
-                        if 'odd number of electrons' in line:
-                            logger.write('Error: odd electron number\n')
-                            raise errors.SetupError('wrong ligand charge, or '
-                                                    'radical')
-
-                if not sce:
-                    raise errors.SetupError('unknown error see log file '
-                                            'and %s file' %
-                                            os.path.join(self.dst, SQM_OUT) )
+            if converged:
+                premin, scfconv, tight, itrmax, maxcyc, sqm_extra = \
+                        sqm_strategy[win]
+                premin_done = any(entry[0] for entry in sqm_strategy[:win+1])
             else:
-                converged = True
-                break
+                sce = True
+        else:
+            for premin, scfconv, tight, itrmax, maxcyc, sqm_extra in \
+                    sqm_strategy:
+                converged = False
+
+                if premin:
+                    self.preminimize(nsteps = premin)
+                    premin_done = True
+
+                ek = ['-ek "%s"' % _sqm_namelist(scfconv, tight, itrmax, maxcyc,
+                                                 sqm_extra)]
+
+                # FIXME: Buffering messes with the stdout output order of
+                #        antechamber (last line comes first).  Use stdbuf,
+                #        pexpect or pty (probably Linux only)?
+                err = utils.run_amber(antechamber, ' '.join(ac_cmd + ek),
+                                      self.workdir)
+
+                if err:
+                    _sqm_failure(err[0], self._path(SQM_OUT),
+                                 os.path.abspath(self._path(SQM_OUT) ) )
+                    logger.write('Warning: SCF has not converged with %i %s\n'
+                                 % (premin, scfconv) )
+                    sce = True
+                else:
+                    converged = True
+                    break
 
         if not converged:
             if sce:
@@ -440,7 +513,8 @@ class Ligand(Common):
                             '-o %s -fo ac' %
                             (const.LIGAND_AC_FILE,
                              tmp_file, self.mol_fmt,
-                             const.LIGAND_AC_FILE))  # FIXME: dangerous?
+                             const.LIGAND_AC_FILE),  # FIXME: dangerous?
+                            self.workdir)
 
         if not gb_charges:
             logger.write('SCF has converged with %i preminimisation steps and '
@@ -450,7 +524,7 @@ class Ligand(Common):
             H_form = 'unknown'
             grad = 'unknown'
 
-            with open(SQM_OUT, 'r') as sqm:
+            with open(self._path(SQM_OUT), 'r') as sqm:
                 for line in sqm:
                     if line.startswith('xmin'):
                         ngconv = int(line[4:10].strip() )
@@ -467,22 +541,12 @@ class Ligand(Common):
                              'formation: %s and gradient = %s\n' %
                              (ngconv, H_form, grad) )
         else:
-            if self.parmchk_version > 1:
-                parmchk = utils.check_amber('parmchk%s' %
-                                            str(self.parmchk_version) )
-
-                if self.gaff == 'gaff2':
-                    params += '-s gaff2 '
-            else:
-                parmchk = utils.check_amber('parmchk')
-
-            utils.run_amber(parmchk, '-i %s -f ac -o %s' %
-                            (const.LIGAND_AC_FILE, const.GB_FRCMOD_FILE) )
+            self._parmchk(const.LIGAND_AC_FILE, 'ac', const.GB_FRCMOD_FILE)
 
             converged = _calc_gb_charge(const.LIGAND_AC_FILE,
                                         const.GB_FRCMOD_FILE, self.charge,
                                         scfconv, tight, sqm_extra,
-                                        antechamber, self.gaff)
+                                        antechamber, self.gaff, self.workdir)
 
             if not converged:
                 logger.write('Error: GB parameterisation failed\n')
@@ -493,7 +557,7 @@ class Ligand(Common):
 
         charges = []
 
-        with open(const.LIGAND_AC_FILE, 'r') as acfile:
+        with open(self._path(const.LIGAND_AC_FILE), 'r') as acfile:
             for line in acfile:
                 if line[:4] == 'ATOM':
                     charges.append(float(line[54:64]) )
@@ -514,7 +578,7 @@ class Ligand(Common):
         for idx, charge in enumerate(charges):
             charges[idx] = charge - corr
 
-        with open(const.CORR_CH_FILE, 'w') as chfile:
+        with open(self._path(const.CORR_CH_FILE), 'w') as chfile:
            for charge in charges:
                chfile.write('%.9f\n' % charge)
 
@@ -524,14 +588,15 @@ class Ligand(Common):
                         '-cf %s -c rc '
                         '-s 2 -pf y -at %s' %
                         (const.LIGAND_AC_FILE, const.CORR_AC_FILE,
-                         const.CORR_CH_FILE, self.gaff) )
+                         const.CORR_CH_FILE, self.gaff), self.workdir)
 
         # FIXME: Do we really need this? It only documents the charge orginally
         #        derived via antechamber.
-        shutil.copyfile(const.LIGAND_AC_FILE,
-                        const.LIGAND_AC_FILE + os.extsep + '0')
+        shutil.copyfile(self._path(const.LIGAND_AC_FILE),
+                        self._path(const.LIGAND_AC_FILE + os.extsep + '0') )
 
-        shutil.move(const.CORR_AC_FILE, const.LIGAND_AC_FILE)
+        shutil.move(self._path(const.CORR_AC_FILE),
+                    self._path(const.LIGAND_AC_FILE) )
 
         self.charge = float('%.12f' % sum(charges))
         logger.write('Total molecule charge is %.2f\n' % self.charge)
@@ -540,6 +605,150 @@ class Ligand(Common):
         self.ref_fmt = self.mol_fmt
 
 
+    def _race_sqm(self, antechamber, ac_cmd, sqm_strategy, nparallel):
+        """
+        Run the entries of sqm_strategy concurrently, at most nparallel at a
+        time, each in its own temporary directory.  Starting structures are
+        preminimised cumulatively just like in the serial ladder.  The first
+        converged entry in strategy order wins and the entries behind it are
+        cancelled.  Its AC and sqm output files are copied to the working
+        directory.
+
+        :param antechamber: the antechamber executable
+        :type antechamber: string
+        :param ac_cmd: antechamber flags without the sqm namelist
+        :type ac_cmd: list of strings
+        :param sqm_strategy: the strategy ladder, see param()
+        :type sqm_strategy: list of tuples
+        :param nparallel: maximum number of concurrent runs
+        :type nparallel: int
+        :raises: SetupError
+        :returns: index of the converged entry or None
+        """
+
+        nentries = len(sqm_strategy)
+        mol_base = os.path.basename(self.mol_file)
+        orig_file = self._path(const.LIGAND_TMP + os.extsep + self.mol_fmt)
+        mol_file = self._path(self.mol_file)
+        cmd = ['-i %s' % mol_base] + ac_cmd[1:]
+        workdirs = []
+
+        for premin, scfconv, tight, itrmax, maxcyc, sqm_extra in sqm_strategy:
+            if premin:
+                self.preminimize(nsteps = premin)
+
+            wd = tempfile.mkdtemp(prefix='sqm',
+                                  dir=os.path.abspath(self.workdir) )
+            shutil.copyfile(mol_file, os.path.join(wd, mol_base) )
+            workdirs.append(wd)
+
+        shutil.copyfile(orig_file, mol_file)
+
+        procs = {}
+        status = [None] * nentries      # True: converged, False: SCF failure
+        nstarted = 0
+        limit = nentries
+        win = None
+
+        try:
+            while win is None:
+                while nstarted < limit and len(procs) < nparallel:
+                    premin, scfconv, tight, itrmax, maxcyc, sqm_extra = \
+                            sqm_strategy[nstarted]
+                    ek = ['-ek "%s"' % _sqm_namelist(scfconv, tight, itrmax,
+                                                     maxcyc, sqm_extra)]
+                    procs[nstarted] = utils.start_amber(antechamber,
+                                                        ' '.join(cmd + ek),
+                                                        workdirs[nstarted],
+                                                        'antechamber')
+                    nstarted += 1
+
+                if not procs:
+                    break
+
+                time.sleep(SQM_POLL)
+
+                for k, proc in procs.items():
+                    if proc.poll() is None:
+                        continue
+
+                    del procs[k]
+                    status[k] = self._sqm_status(proc.returncode, workdirs[k],
+                                                 sqm_strategy[k])
+
+                    # entries behind a converged one are not needed anymore
+                    if status[k] is True and k < limit:
+                        limit = k + 1
+
+                for k in procs.keys():
+                    if k >= limit:
+                        utils.stop_amber(procs.pop(k) )
+
+                for k in range(nentries):
+                    if status[k] is None:
+                        break
+
+                    if isinstance(status[k], errors.SetupError):
+                        raise status[k]
+
+                    if status[k]:
+                        win = k
+                        break
+
+            if win is not None:
+                logger.write('sqm strategy %i of %i has converged' %
+                             (win + 1, nentries) )
+                wd = workdirs[win]
+
+                shutil.copyfile(os.path.join(wd, const.LIGAND_AC_FILE),
+                                self._path(const.LIGAND_AC_FILE) )
+
+                # keep the preminimised structure as the serial ladder does
+                if any(entry[0] for entry in sqm_strategy[:win+1]):
+                    shutil.copyfile(os.path.join(wd, mol_base), mol_file)
+            else:
+                wd = workdirs[-1]
+
+            if os.access(os.path.join(wd, SQM_OUT), os.F_OK):
+                shutil.copyfile(os.path.join(wd, SQM_OUT),
+                                self._path(SQM_OUT) )
+        finally:
+            for proc in procs.values():
+                utils.stop_amber(proc)
+
+            for wd in workdirs:
+                shutil.rmtree(wd, ignore_errors=True)
+
+        return win
+
+
+    def _sqm_status(self, retcode, workdir, entry):
+        """
+        Check the result of a raced antechamber/sqm run.
+
+        :returns: True if converged, False if SCF has not converged or the
+                  SetupError for any other failure
+        """
+
+        if not retcode:
+            return True
+
+        with open(os.path.join(workdir, 'antechamber' + os.extsep + 'out'),
+                  'r') as out:
+            stdout = out.read()
+
+        try:
+            _sqm_failure(stdout, os.path.join(workdir, SQM_OUT),
+                         os.path.abspath(self._path(SQM_OUT) ) )
+        except errors.SetupError as why:
+            return why
+
+        logger.write('Warning: SCF has not converged with %i %s\n' %
+                     (entry[0], entry[1]) )
+
+        return False
+
+
     def _parmchk(self, infile, informat, outfile):
         """
         Run parmcheck to generate missing parameters.
@@ -584,7 +793,8 @@ class Ligand(Common):
 #                                             'leap', 'parm', addon) +
 #                                 os.extsep + 'dat')
 
-        utils.run_amber(parmchk, params)
+        frcmod.parmchk(parmchk, self.gaff, infile, informat, outfile, params,
+                       self.workdir)
 
     @report
     def prepare_top(self, gaff='gaff', pert=None, add_frcmods=[]):
@@ -599,14 +809,8 @@ class Ligand(Common):
         if self.mol_fmt == 'mol2':
             if self.mol_atomtype != self.gaff:
                 mol_file = const.GAFF_MOL2_FILE
-                antechamber = utils.check_amber('antechamber')
-
-                utils.run_amber(antechamber,
-                                '-i %s -fi ac '
-                                '-o %s -fo mol2 '
-                                '-at %s -s 2 -pf y' %
-                                (const.LIGAND_AC_FILE, mol_file,
-                                 self.gaff) )
+                utils.ac_to_mol2(const.LIGAND_AC_FILE, mol_file, self.gaff,
+                                 '-s 2 -pf y', self.workdir)
                 self.mol_file = mol_file
         elif self.mol_fmt == 'pdb':
             pass
@@ -614,7 +818,7 @@ class Ligand(Common):
             raise errors.SetupError('unsupported leap input format: %s (only '
                                     'mol2 and pdb)' % self.mol_fmt)
 
-        if os.path.isfile(self.frcmod):
+        if os.path.isfile(self._path(self.frcmod) ):
             frcmods = [self.frcmod]
         else:
             frcmods = []
@@ -661,13 +865,13 @@ class Ligand(Common):
 
         # we allow the user to have their own leap input file which is used
         # instead of the autogenerated one
-        if os.access(const.LEAP_IN, os.F_OK):
+        if os.access(self._path(const.LEAP_IN), os.F_OK):
             self.amber_top = const.LEAP_IN + self.TOP_EXT
             self.amber_crd = const.LEAP_IN + self.RST_EXT
             self.amber_pdb = const.LEAP_IN + const.PDB_EXT
 
             utils.run_leap(self.amber_top, self.amber_crd, program = 'tleap',
-                           script = const.LEAP_IN)
+                           script = const.LEAP_IN, cwd = self.workdir)
 
             return
 
@@ -680,14 +884,16 @@ class Ligand(Common):
         # Strangely, sleap does not create sander compatible top files with
         # TIP4P but tleap does.  Sleap also crashes when @<TRIPOS>SUBSTRUCTURE
         # is missing.  Sleap has apparently been abandonded.
-        utils.run_leap(self.amber_top, self.amber_crd, 'tleap', leapin)
+        utils.run_leap(self.amber_top, self.amber_crd, 'tleap', leapin,
+                       self.workdir)
 
         # create DL_FIELD UDFF/PDB for vacuum case
         if not boxtype:
             amber = Sire.IO.Amber()
 
             try:
-                mols = amber.readCrdTop(self.amber_crd, self.amber_top)[0]
+                mols = amber.readCrdTop(self._path(self.amber_crd),
+                                        self._path(self.amber_top) )[0]
             except UserWarning as error:
                 raise errors.SetupError('error opening %s/%s: %s' %
                                         (self.amber_crd, self.amber_top, error) )
@@ -702,7 +908,8 @@ class Ligand(Common):
             lig = mols.molNums()[0]
 
             if write_dlf:
-                dlfield.dlf_write(mols.at(lig).molecule(), '_AG')
+                dlfield.dlf_write(mols.at(lig).molecule(), '_AG',
+                                  workdir=self.workdir)
 
 
     @report
@@ -741,18 +948,18 @@ class Ligand(Common):
             if gnproc:
                 ac_cmd.append('-gn "%s"' % gnproc)
 
-            utils.run_amber(antechamber, ' '.join(ac_cmd) )
+            utils.run_amber(antechamber, ' '.join(ac_cmd), self.workdir)
         elif program == 'gus':
             conv = ob.OBConversion()
             conv.SetInAndOutFormats(self.mol_fmt, 'gamin')
 
             obm = ob.OBMol()
-            conv.ReadFile(obm, self.mol_file)
+            conv.ReadFile(obm, self._path(self.mol_file) )
 
             inp = conv.WriteString(obm)
             nl = inp.find('\n') + 1     # skip first line
             
-            with open(GUS_INP, 'w') as gus:
+            with open(self._path(GUS_INP), 'w') as gus:
                 gus.writelines (gus_header + inp[nl:])
                 
         else:
@@ -769,7 +976,8 @@ class Ligand(Common):
 
         # FIXME: we only need vacuum.parm7/rst7
         try:
-            molecules = amber.readCrdTop(self.amber_crd, self.amber_top)[0]
+            molecules = amber.readCrdTop(self._path(self.amber_crd),
+                                         self._path(self.amber_top) )[0]
         except UserWarning as error:
             raise errors.SetupError('error opening %s/%s: %s' %
                                     (self.amber_crd, self.amber_top, error) )
@@ -801,7 +1009,7 @@ class Ligand(Common):
 
         outstr.append('endmolecule\n')
 
-        with open(const.SIRE_ABS_PERT_FILE, 'w') as pfile:
+        with open(self._path(const.SIRE_ABS_PERT_FILE), 'w') as pfile:
             pfile.write('\n'.join(outstr))
 
         # 2-step
@@ -820,7 +1028,7 @@ class Ligand(Common):
 
         outstr.append('endmolecule\n')
 
-        with open(const.SIRE_ABS_PERT_EL_FILE, 'w') as pfile:
+        with open(self._path(const.SIRE_ABS_PERT_EL_FILE), 'w') as pfile:
             pfile.write('\n'.join(outstr))
 
         outstr = ['version 1', 'molecule %s' % (const.LIGAND_NAME)]
@@ -844,7 +1052,7 @@ class Ligand(Common):
 
         outstr.append('endmolecule\n')
 
-        with open(const.SIRE_ABS_PERT_VDW_FILE, 'w') as pfile:
+        with open(self._path(const.SIRE_ABS_PERT_VDW_FILE), 'w') as pfile:
             pfile.write('\n'.join(outstr))
 
 
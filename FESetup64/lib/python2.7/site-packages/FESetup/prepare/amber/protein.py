@@ -33,6 +33,7 @@ import os
 import FESetup
 from FESetup import const, errors, logger
 from common import *
+from . import reslib
 import utils
 
 
@@ -70,20 +71,28 @@ class Protein(Common):
     @report
     def get_charge(self):
         """
-        Get the protein charge via leap.
+        Get the protein charge from the residue charges in the force field
+        libraries.  Leap is only used if a residue is not in the libraries.
 
         :raises: SetupError
         """
 
-        mol_file = self.mol_file
+        mol_file = self._path(self.mol_file)
 
         if not os.access(mol_file, os.R_OK):
             raise errors.SetupError('the protein start file %s does not exist '
                                     % mol_file)
 
+        charge = reslib.pdb_charge(mol_file, self.ff_cmd + self.solvent_load)
+
+        if charge is not None:
+            self.charge = charge
+            logger.write('Protein charge: %.3f' % self.charge)
+            return
+
         out = utils.run_leap('', '', 'tleap',
                              '%s\np = loadpdb %s\ncharge p\n' %
-                             (self.ff_cmd, mol_file) )
+                             (self.ff_cmd, self.mol_file), self.workdir)
 
         charge = None
 
@@ -145,13 +154,13 @@ class Protein(Common):
         """
 
 
-        if os.access(const.LEAP_IN, os.F_OK):
+        if os.access(self._path(const.LEAP_IN), os.F_OK):
             self.amber_top = const.LEAP_IN + self.TOP_EXT
             self.amber_crd = const.LEAP_IN + self.RST_EXT
             self.amber_pdb = const.LEAP_IN + const.PDB_EXT
 
             utils.run_leap(self.amber_top, self.amber_crd, program = 'tleap',
-                     script = const.LEAP_IN)
+                     script = const.LEAP_IN, cwd = self.workdir)
 
             return
 
@@ -160,4 +169,5 @@ class Protein(Common):
                                         remove_first = False,
                                         conc=conc, dens=dens)
 
-        utils.run_leap(self.amber_top, self.amber_crd, 'tleap', leapin)
+        utils.run_leap(self.amber_top, self.amber_crd, 'tleap', leapin,
+                       self.workdir)
@@ -0,0 +1,275 @@
+#  Copyright (C) 2016  Hannes H Loeffler
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  For full details of the license please see the COPYING file
+#  that should have come with this distribution.
+
+r"""
+Residue charges from the leap library files of a force field.
+
+The leaprc files are followed as leap would: libraries loaded with loadOff,
+PDB residue name maps for the termini from addPdbResMap and unit aliases.
+Protonation variants (see Common.PROT_MAP) are just further library units.
+The parsed libraries are cached for the whole run.
+"""
+
+__revision__ = "$Id$"
+
+
+
+import os, re
+
+from FESetup import logger
+
+
+
+# leap's search path relative to $AMBERHOME
+LEAP_DIRS = ('dat/leap/cmd', 'dat/leap/cmd/oldff', 'dat/leap/lib',
+             'dat/leap/lib/oldff', 'dat/leap/prep', 'dat/leap/parm')
+
+_TERM_MAP = re.compile(r'\{\s*([01])\s+"([^"]+)"\s+"([^"]+)"\s*\}')
+_PLAIN_MAP = re.compile(r'\{\s*"([^"]+)"\s+"([^"]+)"\s*\}')
+_ALIAS = re.compile(r'^(\S+)\s*=\s*(\S+)$')
+_ENTRY = re.compile(r'^!entry\.(\S+)\.unit\.atoms\s+table')
+
+# leap commands -> Library
+_libraries = {}
+
+
+class Library(object):
+    """
+    Unit charges and residue name maps as set up by leap commands.
+    """
+
+    __slots__ = ('charges', 'resmap', 'aliases')
+
+    def __init__(self):
+        self.charges = {}               # unit name -> total charge
+        self.resmap = {}                # (terminus, PDB name) -> unit name
+        self.aliases = {}               # variable name -> unit name
+
+
+    def unit_charge(self, resname, terminus=None):
+        """
+        Charge of a PDB residue.
+
+        :param resname: residue name in the PDB file
+        :type resname: string
+        :param terminus: 0 for N-terminus, 1 for C-terminus, None otherwise
+        :type terminus: int
+        :returns: charge or None if the residue is unknown
+        """
+
+        name = self.resmap.get( (terminus, resname),
+                                self.resmap.get( (None, resname), resname) )
+
+        # follow aliases like HIS = HIE but avoid cycles
+        for _ in range(len(self.aliases) ):
+            if name in self.charges or name not in self.aliases:
+                break
+
+            name = self.aliases[name]
+
+        return self.charges.get(name)
+
+
+def library(commands):
+    """
+    Get the library for leap commands, parsed only once.
+
+    :param commands: leap commands sourcing the force field and solvent
+    :type commands: string
+    :returns: library or None if AMBERHOME is not set
+    :rtype: Library
+    """
+
+    if commands in _libraries:
+        return _libraries[commands]
+
+    if 'AMBERHOME' not in os.environ:
+        return None
+
+    lib = Library()
+    _parse(commands.splitlines(), lib, set() )
+    _libraries[commands] = lib
+
+    return lib
+
+
+def pdb_charge(pdb_file, commands):
+    """
+    Compute the total charge of a PDB file from residue charges.  Chains are
+    separated by TER records as in leap.
+
+    :param pdb_file: the PDB file
+    :type pdb_file: string
+    :param commands: leap commands sourcing the force field and solvent
+    :type commands: string
+    :returns: charge or None if a residue is not in the libraries
+    """
+
+    lib = library(commands)
+
+    if not lib:
+        return None
+
+    chains = [[]]
+    last = None
+
+    with open(pdb_file, 'r') as pdb:
+        for line in pdb:
+            record = line[:6].strip()
+
+            if record in ('ATOM', 'HETATM'):
+                resid = line[17:27]
+
+                if resid != last:
+                    chains[-1].append(line[17:21].strip() )
+                    last = resid
+            elif record == 'TER':
+                chains.append([])
+                last = None
+            elif record in ('END', 'ENDMDL'):
+                break
+
+    charge = 0.0
+
+    for chain in chains:
+        nres = len(chain)
+
+        for i, resname in enumerate(chain):
+            if i == 0:
+                terminus = 0
+            elif i == nres - 1:
+                terminus = 1
+            else:
+                terminus = None
+
+            q = lib.unit_charge(resname, terminus)
+
+            if q is None:
+                logger.write('No library charge for residue %s' % resname)
+                return None
+
+            charge += q
+
+    return charge
+
+
+def _find(filename):
+    """
+    Find a file in the current directory or leap's search path.
+    """
+
+    if os.access(filename, os.R_OK):
+        return filename
+
+    for path in LEAP_DIRS:
+        full = os.path.join(os.environ['AMBERHOME'], path, filename)
+
+        if os.access(full, os.R_OK):
+            return full
+
+    return None
+
+
+def _parse(lines, lib, seen):
+    """
+    Follow leap commands: source, loadOff, addPdbResMap and aliases.
+    """
+
+    block = []
+    depth = 0
+
+    for line in lines:
+        line = line.split('#', 1)[0].strip()
+
+        if not line:
+            continue
+
+        if depth:
+            block.append(line)
+            depth += line.count('{') - line.count('}')
+
+            if depth <= 0:
+                _resmap(' '.join(block), lib)
+                depth = 0
+
+            continue
+
+        words = line.split()
+        cmd = words[0].lower()
+
+        if cmd == 'source' and len(words) > 1:
+            filename = _find(words[1].strip('"') )
+
+            if filename and filename not in seen:
+                seen.add(filename)
+
+                with open(filename, 'r') as leaprc:
+                    _parse(leaprc.readlines(), lib, seen)
+        elif cmd == 'loadoff' and len(words) > 1:
+            filename = _find(words[1].strip('"') )
+
+            if filename and filename not in seen:
+                seen.add(filename)
+                _read_off(filename, lib)
+        elif cmd == 'addpdbresmap':
+            block = [line]
+            depth = line.count('{') - line.count('}')
+
+            if depth <= 0:
+                _resmap(line, lib)
+                depth = 0
+        else:
+            match = _ALIAS.match(line)
+
+            if match:
+                lib.aliases[match.group(1)] = match.group(2)
+
+
+def _resmap(text, lib):
+    """
+    Parse addPdbResMap entries.
+    """
+
+    for term, pdbname, unit in _TERM_MAP.findall(text):
+        lib.resmap[(int(term), pdbname)] = unit
+
+    for pdbname, unit in _PLAIN_MAP.findall(text):
+        lib.resmap[(None, pdbname)] = unit
+
+
+def _read_off(filename, lib):
+    """
+    Sum the atom charges of all units in an OFF library file.
+    """
+
+    unit = None
+
+    with open(filename, 'r') as off:
+        for line in off:
+            if line.startswith('!'):
+                match = _ENTRY.match(line)
+                unit = match.group(1) if match else None
+
+                if unit:
+                    lib.charges[unit] = 0.0
+
+                continue
+
+            if unit:
+                lib.charges[unit] += float(line.split()[-1])
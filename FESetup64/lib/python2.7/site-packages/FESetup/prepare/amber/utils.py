@@ -29,13 +29,20 @@ import sys
 import os
 import re
 import shlex
+import signal
 import string
 import glob
+import shutil
+import hashlib
+import tempfile
 import subprocess as subp
 
 from FESetup import const, errors, logger
 
 
+# key of an AC to MOL2 conversion, stored next to the MOL2 file
+MOL2_KEY_EXT = os.extsep + 'key'
+
 
 def self_check():
     """
@@ -115,7 +122,7 @@ def _setenv():
     return env
 
 
-def run_amber(program, params):
+def run_amber(program, params, cwd=None):
     """
     Simple wrapper to execute external AMBER programs through subprocess.
 
@@ -123,6 +130,8 @@ def run_amber(program, params):
     :type program: string
     :param params: paramters to the AMBER program
     :type params: string
+    :param cwd: working directory for the program, None for the current one
+    :type cwd: string
     :raises: SetupError
     :returns: True on failure
     """
@@ -131,10 +140,12 @@ def run_amber(program, params):
     cmd = shlex.split(program)
     cmd.extend(shlex.split(params))
 
-    logger.write('Executing command:\n%s %s\n' % (program, params) )
+    logger.write('Executing command%s:\n%s %s\n' %
+                 (' in %s' % cwd if cwd else '', program, params) )
 
     env = _setenv()
-    proc = subp.Popen(cmd, stdout=subp.PIPE, stderr=subp.PIPE, env=env)
+    proc = subp.Popen(cmd, stdout=subp.PIPE, stderr=subp.PIPE, env=env,
+                      cwd=cwd or None)
     out, err = proc.communicate()
 
     for stream in out, err:
@@ -150,7 +161,136 @@ def run_amber(program, params):
     return False
 
 
-def run_leap(top, crd, program='tleap', script=''):
+def start_amber(program, params, cwd, logname):
+    """
+    Start an external AMBER program in the background.  stdout and stderr are
+    written to the files logname.out and logname.err in cwd so no pipes need
+    to be drained while the program is running.  The program runs in its own
+    process group so that stop_amber() also terminates its children.
+
+    :param program: AMBER program file name
+    :type program: string
+    :param params: paramters to the AMBER program
+    :type params: string
+    :param cwd: working directory for the program
+    :type cwd: string
+    :param logname: base name of the output files
+    :type logname: string
+    :returns: the process
+    :rtype: subprocess.Popen
+    """
+
+    cmd = shlex.split(program)
+    cmd.extend(shlex.split(params))
+
+    logger.write('Starting command in %s:\n%s %s\n' % (cwd, program, params) )
+
+    env = _setenv()
+
+    with open(os.path.join(cwd, logname + os.extsep + 'out'), 'w') as out, \
+             open(os.path.join(cwd, logname + os.extsep + 'err'), 'w') as err:
+        return subp.Popen(cmd, stdout=out, stderr=err, env=env, cwd=cwd,
+                          preexec_fn=os.setsid)
+
+
+def stop_amber(proc):
+    """
+    Terminate a program started with start_amber() and all its children,
+    e.g. sqm started by antechamber.
+
+    :param proc: the process
+    :type proc: subprocess.Popen
+    """
+
+    if proc.poll() is None:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    proc.wait()
+
+
+def _amber_identity(exe):
+    """
+    Identity of an AMBER installation as seen through one of its programs.
+
+    :param exe: full path of the program
+    :type exe: string
+    :returns: AMBERHOME, resolved program path, size and mtime
+    :rtype: string
+    """
+
+    path = os.path.realpath(exe)
+    stat = os.stat(path)
+
+    return '%s %s %i %i' % (os.environ.get('AMBERHOME', ''), path,
+                            stat.st_size, int(stat.st_mtime) )
+
+
+def ac_to_mol2(ac_file, mol2_file, gaff, flags='', cwd=None):
+    """
+    Convert an AC file to a MOL2 file with GAFF atom types through
+    antechamber.  The key of the conversion (AC file content, GAFF version,
+    flags, AMBER installation) is stored on disk next to the MOL2 file so
+    that an up-to-date MOL2 file is reused instead of running antechamber
+    again, also across separate dGprep runs.  antechamber runs in a private
+    temporary directory and the MOL2 and key files are renamed into place,
+    so concurrent conversions into the same directory do not clash.
+
+    :param ac_file: the AC input file
+    :type ac_file: string
+    :param mol2_file: the MOL2 output file
+    :type mol2_file: string
+    :param gaff: GAFF version: gaff or gaff2
+    :type gaff: string
+    :param flags: additional antechamber flags
+    :type flags: string
+    :param cwd: working directory, file names are relative to it
+    :type cwd: string
+    """
+
+    antechamber = check_amber('antechamber')
+    ac_path = os.path.abspath(os.path.join(cwd or '', ac_file) )
+
+    with open(ac_path, 'rb') as ac:
+        key = '%s %s %s %s' % (hashlib.sha1(ac.read() ).hexdigest(), gaff,
+                               flags, _amber_identity(antechamber) )
+
+    mol2_path = os.path.abspath(os.path.join(cwd or '', mol2_file) )
+    key_path = mol2_path + MOL2_KEY_EXT
+
+    if os.access(mol2_path, os.F_OK) and os.access(key_path, os.F_OK):
+        with open(key_path, 'r') as key_file:
+            if key_file.read().strip() == key:
+                logger.write('Reusing MOL2 file %s' % mol2_path)
+                return
+
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(mol2_path) )
+
+    try:
+        tmp_mol2 = os.path.join(tmpdir, os.path.basename(mol2_path) )
+
+        err = run_amber(antechamber,
+                        '-i %s -fi ac -o %s -fo mol2 -at %s %s' %
+                        (ac_path, os.path.basename(mol2_path), gaff, flags),
+                        tmpdir)
+
+        if os.access(tmp_mol2, os.F_OK):
+            os.rename(tmp_mol2, mol2_path)
+
+            if not err:
+                tmp_key = os.path.join(tmpdir, os.path.basename(key_path) )
+
+                with open(tmp_key, 'w') as key_file:
+                    key_file.write(key + '\n')
+
+                os.rename(tmp_key, key_path)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def run_leap(top, crd, program='tleap', script='', cwd=None):
     """
     Simple wrapper to execute the AMBER leap program.
 
@@ -163,6 +303,8 @@ def run_leap(top, crd, program='tleap', script=''):
     :param script: leap script as string, if 'leap.in' read from respective file
       name
     :type script: string
+    :param cwd: working directory for leap, file names are relative to it
+    :type cwd: string
     :returns: output from leap
     :raises: SetupError
     """
@@ -178,7 +320,7 @@ def run_leap(top, crd, program='tleap', script=''):
         logger.write('Executing command:\n%s' % ' '.join(cmd) )
 
         proc = subp.Popen(cmd, stdin=None, stdout=subp.PIPE, stderr=subp.PIPE,
-                          env=env)
+                          env=env, cwd=cwd or None)
         out = proc.communicate()[0]
     else:
         cmd.append('-')
@@ -186,10 +328,14 @@ def run_leap(top, crd, program='tleap', script=''):
                      (leap, script) )
 
         proc = subp.Popen(cmd, stdin=subp.PIPE, stdout=subp.PIPE,
-                          stderr=subp.PIPE, env=env)
+                          stderr=subp.PIPE, env=env, cwd=cwd or None)
         out = proc.communicate(script)[0]
 
     if top and crd:
+        if cwd:
+            top = os.path.join(cwd, top)
+            crd = os.path.join(cwd, crd)
+
         if os.path.getsize(top) == 0 or os.path.getsize(crd) == 0:
             raise errors.SetupError(
                 'Leap did not create the topology and/or coordinate '
@@ -199,15 +345,18 @@ def run_leap(top, crd, program='tleap', script=''):
     return out
 
 
-def run_exe(cmdline):
+def run_exe(cmdline, cwd=None):
     """
     Simple wrapper to execute the external programs through subprocess.
 
     :param cmdline: complete command line as given on a shell prompt
     :type cmdline: str
+    :param cwd: working directory for the program, None for the current one
+    :type cwd: str
     """
 
-    logger.write('Executing command:\n%s\n' % cmdline)
+    logger.write('Executing command%s:\n%s\n' %
+                 (' in %s' % cwd if cwd else '', cmdline) )
 
     env = os.environ.copy()
 
@@ -217,7 +366,7 @@ def run_exe(cmdline):
          env['LD_LIBRARY_PATH'] = ''
 
     proc = subp.Popen(shlex.split(cmdline), stdout=subp.PIPE, stderr=subp.PIPE,
-                      env=env)
+                      env=env, cwd=cwd or None)
     out, err =  proc.communicate()
 
     return proc.returncode, out, err
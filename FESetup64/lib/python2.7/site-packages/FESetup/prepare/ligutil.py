@@ -28,10 +28,11 @@ __revision__ = "$Id: ligutil.py 633 2016-11-17 14:39:12Z halx $"
 
 import os, sys, re
 
-import pybel
-import openbabel as ob
-
 from FESetup import const, errors, report, logger
+from FESetup.lazyimport import LazyModule
+
+pybel = LazyModule('pybel')
+ob = LazyModule('openbabel')
 
 
 
@@ -103,7 +104,7 @@ def prepare(self, to_format = 'mol2', addH = False, calc_charge = False,
 
     conv = ob.OBConversion()
     mol = ob.OBMol()
-    ob_read_one(conv, self.mol_file, mol, self.mol_fmt, to_format)
+    ob_read_one(conv, self._path(self.mol_file), mol, self.mol_fmt, to_format)
 
     # FIXME: does this test for the right thing?
     if mol.GetDimension() != 3:
@@ -166,7 +167,7 @@ def prepare(self, to_format = 'mol2', addH = False, calc_charge = False,
         self.mol_fmt = to_format
 
         try:
-            conv.WriteFile(mol, self.mol_file)
+            conv.WriteFile(mol, self._path(self.mol_file) )
         except IOError as why:
             raise errors.SetupError(why)
     else:
@@ -241,7 +242,7 @@ def preminimize(self, add_hyd = False, ffield = 'mmff94', nsteps = 10):
 
     # NOTE: Openbabel may miscalculate charges from mol2 files
     try:
-        mol = pybel.readfile(self.mol_fmt, self.mol_file).next()
+        mol = pybel.readfile(self.mol_fmt, self._path(self.mol_file) ).next()
     except IOError as why:
         raise errors.SetupError(why)
 
@@ -255,7 +256,7 @@ def preminimize(self, add_hyd = False, ffield = 'mmff94', nsteps = 10):
                  (self.mol_file, self.mol_fmt) )
 
     try:
-        mol.write(self.mol_fmt, self.mol_file, overwrite = True)
+        mol.write(self.mol_fmt, self._path(self.mol_file), overwrite = True)
     except IOError as why:
         raise errors.SetupError(why)
 
@@ -267,7 +268,8 @@ def preminimize(self, add_hyd = False, ffield = 'mmff94', nsteps = 10):
 def flex(self, name = const.LIGAND_NAME, dobonds = True,
          doangles = True, dodihedrals = True):
     """
-    Create a Sire flexibility file describing how the input ligand can be moved.
+    Create a Sire flexibility file describing how the input ligand can be
+    moved.
 
     :param name: ligand name
     :type name: string
@@ -288,7 +290,8 @@ def flex(self, name = const.LIGAND_NAME, dobonds = True,
     re_sire_error = re.compile(const.RE_SIRE_ERROR_STR)
 
     amber = Sire.IO.Amber()
-    molecules = amber.readCrdTop(self.amber_crd, self.amber_top)[0]
+    molecules = amber.readCrdTop(self._path(self.amber_crd),
+                                 self._path(self.amber_top) )[0]
 
     nmol = molecules.molNums()
     nmol.sort()
@@ -384,9 +387,11 @@ def flex(self, name = const.LIGAND_NAME, dobonds = True,
                     nmoved = 1
 
                 if ( connectivity.inRing(dihedral) ):
-                    angle_deltas[dihedral] = const.BASE_DIHEDRALRING_FLEX / nmoved
+                    base = const.BASE_DIHEDRALRING_FLEX
                 else:
-                    angle_deltas[dihedral] = const.BASE_DIHEDRAL_FLEX / nmoved
+                    base = const.BASE_DIHEDRAL_FLEX
+
+                angle_deltas[dihedral] = base * Sire.Units.degrees / nmoved
 
     ## angles
     var_angles = []
@@ -426,9 +431,12 @@ def flex(self, name = const.LIGAND_NAME, dobonds = True,
                 smallgroup = gr1
 
             if ( connectivity.inRing(angle) ):
-                angle_deltas[angle] = const.BASE_ANGLERING_FLEX / smallgroup.nSelected()
+                base = const.BASE_ANGLERING_FLEX
             else:
-                angle_deltas[angle] = const.BASE_ANGLE_FLEX / smallgroup.nSelected()
+                base = const.BASE_ANGLE_FLEX
+
+            angle_deltas[angle] = (base * Sire.Units.degrees /
+                                   smallgroup.nSelected() )
 
     ## bonds
     var_bonds = []
@@ -457,18 +465,22 @@ def flex(self, name = const.LIGAND_NAME, dobonds = True,
                 smallgroup = gr1
 
             if ( connectivity.inRing(bond) ):
-                bond_deltas[bond] = const.BASE_BONDRING_FLEX / smallgroup.nSelected()
+                base = const.BASE_BONDRING_FLEX
             else:
-                bond_deltas[bond] = const.BASE_BOND_FLEX / smallgroup.nSelected()
+                base = const.BASE_BOND_FLEX
+
+            bond_deltas[bond] = (base * Sire.Units.angstrom /
+                                 smallgroup.nSelected() )
 
 
     ### guess translation
-    translation = const.BASE_TRANSLATION / (solute.nAtoms() / 5.0 + 1.0)
+    translation = (const.BASE_TRANSLATION * Sire.Units.angstrom /
+                   (solute.nAtoms() / 5.0 + 1.0) )
 
 
     ### guess rotation
     sphere_radius = solute.evaluate().boundingSphere().radius()
-    rotation = const.BASE_ROTATION / sphere_radius**2
+    rotation = const.BASE_ROTATION * Sire.Units.degrees / sphere_radius**2
 
 
     ### write flexibility template
@@ -479,8 +491,10 @@ molecule %s
 rigidbody rotate %-5.3f translate %-5.3f
 maximumbondvariables %-3d
 maximumanglevariables %-3d
-maximumdihedralvariables %-3d\n''' % (solute_name, rotation.to(Sire.Units.degrees),
-translation.to(Sire.Units.angstrom), const.BASE_MAXBONDVAR, const.BASE_MAXANGLEVAR, const.BASE_MAXDIHEDRALVAR) ]
+maximumdihedralvariables %-3d\n''' %
+             (solute_name, rotation.to(Sire.Units.degrees),
+              translation.to(Sire.Units.angstrom), const.BASE_MAXBONDVAR,
+              const.BASE_MAXANGLEVAR, const.BASE_MAXDIHEDRALVAR) ]
 
     for bond in var_bonds:
         at0name = solute.select(bond.atom0()).name().value()
@@ -509,7 +523,7 @@ translation.to(Sire.Units.angstrom), const.BASE_MAXBONDVAR, const.BASE_MAXANGLEV
         lines.append('dihedral %-4s %-4s %-4s %-4s flex %-5.3f\n' \
                  % (at0name, at1name, at2name, at3name, delta))
 
-    with open(const.LIGAND_FLEX_FILE, 'w') as output:
+    with open(self._path(const.LIGAND_FLEX_FILE), 'w') as output:
             output.write(''.join(lines))
 
 
@@ -532,7 +546,7 @@ def conf_search(self, do_ga = False, numconf = 30, geomsteps = 5,
     """
 
     try:
-        mol = pybel.readfile(self.mol_fmt, self.mol_file).next()
+        mol = pybel.readfile(self.mol_fmt, self._path(self.mol_file) ).next()
     except IOError as why:
         raise errors.SetupError(why)
 
@@ -596,7 +610,7 @@ def conf_search(self, do_ga = False, numconf = 30, geomsteps = 5,
                  (self.mol_fmt, outmol) )
 
     try:
-        mol.write(self.mol_fmt, outmol, overwrite = True)
+        mol.write(self.mol_fmt, self._path(outmol), overwrite = True)
     except IOError as why:
         raise errors.SetupError(why)
 
@@ -636,8 +650,8 @@ def align(self, inc_hyd = False, symmetry = False, filt = False):
     errlev = ob.obErrorLog.GetOutputLevel()
     ob.obErrorLog.SetOutputLevel(0)
 
-    conv.ReadFile(ref, self.ref_file)
-    conv.ReadFile(tgt, self.mol_file)
+    conv.ReadFile(ref, self._path(self.ref_file) )
+    conv.ReadFile(tgt, self._path(self.mol_file) )
 
     ob.obErrorLog.SetOutputLevel(errlev)
 
@@ -720,7 +734,7 @@ def align(self, inc_hyd = False, symmetry = False, filt = False):
             return
 
     try:
-        conv.WriteFile(tgt, self.mol_file)
+        conv.WriteFile(tgt, self._path(self.mol_file) )
     except IOError as why:
         raise errors.SetupError(why)
 
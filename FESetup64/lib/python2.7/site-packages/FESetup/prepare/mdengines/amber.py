@@ -26,13 +26,20 @@ __revision__ = "$Id: amber.py 558 2016-04-29 08:09:51Z halx $"
 
 
 import os
+import time
 
 import mdebase
-from FESetup import errors, logger
+from FESetup import errors, logger, restart
 from FESetup.prepare.amber import utils
 
 
 
+# write NetCDF restarts (ntxo = 2) from this system size on
+NETCDF_MIN_ATOMS = 20000
+
+BATCH_GROUP_FILE = 'batch%05i.group'
+
+
 def is_periodic(topfile):
     """
     Check if AMBER topology file was made for a periodic system.
@@ -55,19 +62,26 @@ class MDEngine(mdebase.MDEBase):
     Amber MD engine.
     """
 
+    ATOMS_PER_PROC = 2000
+
     # FIXME: files are specific to AMBER but needed for conversion for
     #        other MD packages
     def __init__(self, amber_top, amber_crd, sander_crd, sander_rst,
                  amber_pdb, box_dims=None, solvent=None, mdprog='sander',
-                 mdpref='', mdpost=''):
+                 mdpref='', mdpost='', workdir=''):
 
-        super(MDEngine, self).__init__()
+        super(MDEngine, self).__init__(workdir)
 
         # FIXME: do not assume that top/crd are in AMBER format
         self.update_files(amber_top, amber_crd, sander_crd, sander_rst,
                           amber_pdb)
 
         self.mdpref = mdpref
+        self.press_done = False
+
+        # set through GroupBatch.attach(): runs are queued, not executed
+        self.batch = None
+        self._queued = []
 
         self.mdprog = ''
         self._self_check(mdprog)
@@ -81,13 +95,21 @@ class MDEngine(mdebase.MDEBase):
         self.sander_rst = sander_rst
         self.amber_pdb = amber_pdb
 
-        if is_periodic(self.amber_top):
+        top = self._path(self.amber_top)
+
+        if is_periodic(top):
             self.min_periodic = ' ntb = 1,\n'
             self.md_periodic = ''           # must be in pre-defined namelist
         else: # FIXME: this needs a closer look
             self.min_periodic = ' ntb = 0, cut = 99999.0,\n'
             self.md_periodic = ' ntb = 0, igb = 2, cut = 16.0, nrespa = 2\n'
 
+        # large systems avoid ASCII restarts, final state converted in to_rst7
+        if restart.HAVE_NETCDF and mdebase.natoms(top) >= NETCDF_MIN_ATOMS:
+            self.ntxo = 2
+        else:
+            self.ntxo = 1
+
 
     def minimize(self, namelist='%ALL', nsteps=100, ncyc=10, restr_str='',
                  restr_force=5.0):
@@ -121,17 +143,14 @@ class MDEngine(mdebase.MDEBase):
             restraint = ''
 
             if restr_str:
-                try:
-                    mask = mdebase._restraint_table[restr_str]
-                except KeyError:
-                    mask = restr_str
-
+                mask = self.restraint_mask(restr_str)
                 restraint = (mdebase._rs % (restr_force, mask) )
 
             namelist = namelist.format(nsteps, ncyc, nsteps / 5,
-                                       self.min_periodic + restraint)
+                                       self.min_periodic + restraint,
+                                       self.ntxo)
 
-        self._run_mdprog(mdebase.MIN_PREFIX, namelist, mask, False)
+        self._run_mdprog(mdebase.MIN_PREFIX, namelist, restr_str, False)
 
 
     def md(self, namelist='', nsteps=1000, T=300.0, p=1.0,
@@ -167,6 +186,11 @@ class MDEngine(mdebase.MDEBase):
             pname = namelist[1:]
             logger.write('Running MD with protocol %s' % pname)
 
+            if pname == 'RELRES':
+                self._relax_restraints(nsteps, T, p, restr_str, restr_force,
+                                       nrel, wrap, dt)
+                return
+
             if pname == 'PRESS' or pname == 'SHRINK':
                 constp = True
 
@@ -176,22 +200,89 @@ class MDEngine(mdebase.MDEBase):
                 raise errors.SetupError('no such MD protocol predefined: '
                                         '%s' % namelist)
 
-            restraint = ''
+            namelist = self._md_namelist(namelist, nsteps, T, p, restr_str,
+                                         restr_force, wrap, dt)
 
-            if restr_str:
-                try:
-                    mask = mdebase._restraint_table[restr_str]
-                except KeyError:
-                    mask = restr_str
+            if pname == 'PRESS':
+                self.press_done = True
 
-                restraint = (mdebase._rs % (restr_force, mask) )
+        self._run_mdprog(mdebase.MD_PREFIX, namelist, restr_str, constp)
+
+
+    def _md_namelist(self, namelist, nsteps, T, p, restr_str, restr_force,
+                     wrap, dt):
+        """
+        Fill in a pre-defined MD namelist.
+        """
+
+        restraint = ''
+
+        if restr_str:
+            mask = self.restraint_mask(restr_str)
+            restraint = (mdebase._rs % (restr_force, mask) )
+
+        return namelist.format(nsteps, nsteps / 5, nsteps / 10,
+                               self.md_periodic + restraint,
+                               '{:d}'.format(wrap), T, p, dt, self.ntxo)
+
+
+    def _relax_restraints(self, nsteps, T, p, restr_str, restr_force, nrel,
+                          wrap, dt):
+        """
+        Release positional restraints in nrel - 1 stages of nsteps each with
+        the force constant linearly decreasing from restr_force to zero.
+        Stages run at constant pressure if a pressure run has been carried out
+        before, otherwise at constant temperature.
+
+        A single run with nmropt = 1 and a &wt type = 'REST' ramp is not
+        possible: REST only weights the NMR restraints read from DISANG while
+        the ntr positional restraints keep the constant restraint_wt of the
+        namelist.  One sander/pmemd process per stage is therefore required.
+        All stages are written up-front and chained in a single driver script
+        which is executed with one call.  In batch mode the stages are simply
+        queued.
+        """
+
+        if nrel < 2:
+            return
+
+        sp = restr_force / (nrel - 1)
+
+        if self.press_done:
+            template = PROTOCOLS['MD_PRESS']
+        else:
+            template = PROTOCOLS['MD_CONSTT']
+
+        if self.batch:
+            for k in range(nrel - 2, -1, -1):
+                namelist = self._md_namelist(template, nsteps, T, p, restr_str,
+                                             sp * k, wrap, dt)
+                self._run_mdprog(mdebase.MD_PREFIX, namelist, restr_str,
+                                 self.press_done)
 
-            namelist = namelist.format(nsteps, nsteps / 5, nsteps / 10,
-                                       self.md_periodic + restraint,
-                                       '{:d}'.format(wrap), T, p, dt)
+            return
 
+        driver = 'relres%05i.sh' % self.run_no
+        cmds = []
 
-        self._run_mdprog(mdebase.MD_PREFIX, namelist, mask, constp)
+        for k in range(nrel - 2, -1, -1):
+            namelist = self._md_namelist(template, nsteps, T, p, restr_str,
+                                         sp * k, wrap, dt)
+            prefix, flags = self._prepare_mdprog(mdebase.MD_PREFIX, namelist,
+                                                 restr_str, self.press_done)
+            cmds.append(' '.join((self._sized(self.mdpref), self.mdprog,
+                                  flags) ) )
+
+        with open(self._path(driver), 'w') as script:
+            script.write('set -e\n')
+            script.write('\n'.join(cmds) + '\n')
+
+        err = utils.run_amber('sh', driver, cwd=self.workdir)
+
+        if err:
+            logger.write('sander/pmemd failed with message %s' % err[1])
+            raise errors.SetupError('error in restraint relaxation %s: %s' %
+                                    (driver, err[1]) )
 
 
     def get_box_dims(self):
@@ -201,25 +292,31 @@ class MDEngine(mdebase.MDEBase):
         :returns: box dimensions
         """
 
-        with open(self.sander_rst, 'r') as rst:
-            for line in rst:
-                box_dims = line
-
         # FIXME: rectangular box only
-        return [float(d) for d in box_dims.split()]
+        return restart.read_box(self._path(self.sander_rst) )
 
 
-    def _run_mdprog(self, prefix, namelist, mask, constp):
+    def _prepare_mdprog(self, prefix, namelist, mask, constp, base=''):
         """
-        Run sander/pmemd from the Amber package.
+        Write the input file for the next sander/pmemd run and advance the
+        run state.
+
+        :param base: directory prepended to all file names in the flags,
+                     the input file is always written to the working directory
+        :type base: string
+        :returns: run prefix and command line flags
         """
 
         prefix += '%05i'
 
         prefix = prefix % self.run_no
-        self.sander_rst = prefix + mdebase.RST_EXT
 
-        with open(prefix + os.extsep + 'in', 'w') as mdin:
+        if self.ntxo == 2:
+            self.sander_rst = prefix + restart.NCRST_EXT
+        else:
+            self.sander_rst = prefix + mdebase.RST_EXT
+
+        with open(self._path(prefix + os.extsep + 'in'), 'w') as mdin:
             mdin.writelines(namelist)
 
         # NOTE: we assume trajectory will be written in NetCDF
@@ -230,25 +327,57 @@ class MDEngine(mdebase.MDEBase):
         if mask:
             # Constant pressure with positional restraints shifts coordinates.
             if constp:
-                flags += ' -ref %s' % self.sander_crd
+                flags += ' -ref %s' % os.path.join(base, self.sander_crd)
             else:
-                flags += ' -ref %s' % self.amber_crd
+                flags += ' -ref %s' % os.path.join(base, self.amber_crd)
+
+        flags = flags.format(*[os.path.join(base, name) for name in
+                               (prefix, self.amber_top, self.sander_crd,
+                                self.sander_rst)])
+
+        self.sander_crd = self.sander_rst
+        self.run_no += 1
+
+        return prefix, flags
 
-        err = utils.run_amber(self.mdpref + ' ' + self.mdprog,
-                              flags.format(prefix, self.amber_top,
-                                           self.sander_crd, self.sander_rst) )
+
+    def _run_mdprog(self, prefix, namelist, mask, constp):
+        """
+        Run sander/pmemd from the Amber package.  In batch mode the run is
+        only queued with absolute paths.
+        """
+
+        if self.batch:
+            prefix, flags = self._prepare_mdprog(prefix, namelist, mask,
+                                                 constp, self.workdir)
+            self._queued.append( (prefix, flags) )
+            return
+
+        prefix, flags = self._prepare_mdprog(prefix, namelist, mask, constp)
+
+        err = utils.run_amber(self._sized(self.mdpref) + ' ' + self.mdprog,
+                              flags, cwd=self.workdir)
 
         if err:
             logger.write('sander/pmemd failed with message %s' % err[1])
             raise errors.SetupError('error in sander run %s: %s' %
                                     (prefix, err[1]) )
 
-        self.sander_crd = self.sander_rst
-        self.run_no += 1
 
+    def _convert_rst7(self):
+        """
+        Convert a NetCDF restart into ASCII rst7.
+        """
+
+        if not restart.is_netcdf(self._path(self.sander_crd) ):
+            return
+
+        rst = restart.read_ncrst(self._path(self.sander_crd) )
+        rst7 = os.path.splitext(self.sander_crd)[0] + mdebase.RST_EXT
 
-    def to_rst7(self):
-        pass
+        restart.write_rst7(self._path(rst7), rst.coords, rst.vels, rst.box,
+                           rst.title, rst.time)
+        self.sander_crd = rst7
 
 
     def _self_check(self, mdprog):
@@ -269,6 +398,139 @@ class MDEngine(mdebase.MDEBase):
                                     mdprog)
 
 
+class GroupBatch(object):
+    """
+    Run the same protocol stage of many small systems as one multi-sander/pmemd
+    job (-ng) under MPI.  Attached engines only queue their runs with absolute
+    paths.  run() then executes the k-th queued run of every system in one
+    groupfile job, so all output is written straight into each system's
+    working directory.
+    """
+
+    def __init__(self, size=0, mpirun='mpirun -np'):
+        """
+        :param size: maximum number of systems per job, 0 for no limit
+        :type size: int
+        :param mpirun: MPI launcher, the number of processes is appended
+        :type mpirun: string
+        """
+
+        self.size = size
+        self.mpirun = mpirun
+        self.engines = []
+        self.run_no = 1
+
+
+    def attach(self, engine, workdir):
+        """
+        Switch an engine to batch mode.
+
+        :param engine: the MD engine
+        :type engine: MDEngine
+        :param workdir: absolute path to the working directory of the system
+        :type workdir: string
+        """
+
+        engine.batch = self
+        engine.chain = True
+        engine.workdir = workdir
+        engine._queued = []
+
+
+    def add(self, engine):
+        """
+        Register an attached engine for the next run() once all its stages
+        have been queued successfully.
+
+        :param engine: the MD engine
+        :type engine: MDEngine
+        """
+
+        if engine.batch is not self:
+            raise errors.SetupError('engine not attached to this batch')
+
+        self.engines.append(engine)
+
+
+    def run(self):
+        """
+        Run all queued stages round by round.  A system that fails is dropped
+        from all later rounds.
+
+        :returns: the engines that have failed
+        """
+
+        failed = []
+        nrounds = max([len(e._queued) for e in self.engines] or [0])
+
+        for k in range(nrounds):
+            active = [e for e in self.engines
+                      if k < len(e._queued) and e not in failed]
+            size = self.size if self.size > 0 else len(active)
+
+            for start in range(0, len(active), size):
+                failed.extend(self._run_group(active[start:start+size], k) )
+
+        for engine in self.engines:
+            engine.batch = None
+            engine._queued = []
+
+        self.engines = []
+
+        return failed
+
+
+    def _run_group(self, engines, k):
+        """
+        Run the k-th stage of a group of systems as one -ng job.
+
+        :returns: the engines that have failed
+        """
+
+        ngroups = len(engines)
+        group_file = os.path.abspath(BATCH_GROUP_FILE % self.run_no)
+        self.run_no += 1
+
+        with open(group_file, 'w') as gfile:
+            for engine in engines:
+                gfile.write(engine._queued[k][1] + '\n')
+
+        mdprog = engines[0].mdprog
+
+        if not mdprog.endswith('.MPI'):
+            mdprog += '.MPI'
+
+        if not os.access(mdprog, os.X_OK):
+            raise errors.SetupError('no MPI binary %s for batch mode' % mdprog)
+
+        logger.write('Running batch of %i systems' % ngroups)
+
+        start = int(time.time() )
+        err = utils.run_amber('%s %i %s' % (self.mpirun, ngroups, mdprog),
+                              '-ng %i -groupfile %s' % (ngroups, group_file) )
+
+        if not err:
+            return []
+
+        logger.write('multi-sander/pmemd failed with message %s' % err[1])
+
+        # multi-sander aborts all groups, keep those that finished
+        failed = []
+
+        for engine in engines:
+            if engine.ntxo == 2:
+                ext = restart.NCRST_EXT
+            else:
+                ext = mdebase.RST_EXT
+
+            rst = os.path.join(engine.workdir, engine._queued[k][0] + ext)
+
+            if not os.access(rst, os.F_OK) or os.path.getmtime(rst) < start:
+                failed.append(engine)
+
+        return failed
+
+
 PROTOCOLS = dict(
     MIN_FIXH = '''Fix hydrogens
  &cntrl
@@ -276,7 +538,7 @@ PROTOCOLS = dict(
    maxcyc = {0}, ncyc = {1},
    ntpr = {2}, ntwe = {2},
    dx0 = 1.0D-7,
-   ntxo = 1,  ! 2 is default in AMBER16 for NetCDF file
+   ntxo = {4},
    ntc = 2, noshakemask = '!:WAT,HOH,T3P,T4P,T4E',
    {3}
  /
@@ -288,7 +550,7 @@ PROTOCOLS = dict(
    maxcyc = {0}, ncyc = {1},
    ntpr = {2}, ntwe = {2},
    dx0 = 1.0D-7,
-   ntxo = 1,  ! 2 is default in AMBER16 for NetCDF file
+   ntxo = {4},
    {3}
  /
 ''',
@@ -301,7 +563,7 @@ PROTOCOLS = dict(
    ntb = 2,
    ntc = 2, ntf = 2,
    ioutfm = 1, iwrap = {4},
-   ntxo = 1,  ! 2 is default in AMBER16 for NetCDF file
+   ntxo = {8},
    ntwe = {1}, ntwx = {1}, ntpr = {2},
    {3}
  /
@@ -314,13 +576,12 @@ PROTOCOLS = dict(
    ntb = 1,
    ntc = 2, ntf = 2,
    ioutfm = 1, iwrap = {4},
-   ntxo = 1,  ! 2 is default in AMBER16 for NetCDF file
+   ntxo = {8},
    ntwe = {1}, ntwx = {1}, ntpr = {2},
    {3}
  /
 ''',
     
-# we may later want to add ntxo = 2, i.e. restart file in NetCDF format
     MD_HEAT = '''heat the system
  &cntrl
    imin = 0, nstlim = {0}, irest = 0, ntx = 1, dt = {7},
@@ -329,7 +590,7 @@ PROTOCOLS = dict(
    ntb = 1, pres0 = {6},
    ntc = 2, ntf = 2,
    ioutfm = 1, iwrap = {4},
-   ntxo = 1,  ! 2 is default in AMBER16 for NetCDF file
+   ntxo = {8},
    ntwe = {1}, ntwx = {1}, ntpr = {2},
    {3}
  /
@@ -351,7 +612,7 @@ PROTOCOLS = dict(
    ntb = 1,
    ntc = 2, ntf = 2,
    ioutfm = 1, iwrap = {4},
-   ntxo = 1,  ! 2 is default in AMBER16 for NetCDF file
+   ntxo = {8},
    ntwe = {1}, ntwx = {1}, ntpr = {2},
    {3}
  /
@@ -367,7 +628,7 @@ PROTOCOLS = dict(
    ntc = 2, ntf = 2,
    ioutfm = 1, iwrap = {4},
    ntwe = {1}, ntwx = {1}, ntpr = {2},
-   ntxo = 1,  ! 2 is default in AMBER16 for NetCDF file
+   ntxo = {8},
    {3}
  /
 '''
@@ -54,9 +54,9 @@ class MDEngine(mdebase.MDEBase):
 
     def __init__(self, amber_top, amber_crd, sander_crd, sander_rst,
                  amber_pdb, box_dims = None, solvent = None,
-                 mdprog = 'DLPOLY.Z', mdpref = '', mdpost = ''):
+                 mdprog = 'DLPOLY.Z', mdpref = '', mdpost = '', workdir = ''):
 
-        super(MDEngine, self).__init__()
+        super(MDEngine, self).__init__(workdir)
 
         self.update_files(amber_top, amber_crd, sander_crd, sander_rst,
                           amber_pdb)
@@ -79,8 +79,11 @@ class MDEngine(mdebase.MDEBase):
         self.amber_pdb = amber_pdb
 
         self.dlpoly = dlpoly.DLPolyField()
-        self.dlpoly.readParm(amber_top, amber_crd)
-        self.dlpoly.writeConfig(CONFIG_FILENAME)
+        self.dlpoly.readParm(self._path(amber_top), self._path(amber_crd) )
+        self.dlpoly.writeConfig(self._path(CONFIG_FILENAME) )
+
+        # restraints the current FIELD file was written with
+        self._field_posres = None
 
 
     def minimize(self, config = '%STD', nsteps = 100, ncyc = 100,
@@ -192,7 +195,7 @@ class MDEngine(mdebase.MDEBase):
         :returns: box dimensions
         """
 
-        config_file = CONFIG_FILENAME
+        config_file = self._path(CONFIG_FILENAME)
         line_no = 0
         box_dims = []
 
@@ -238,14 +241,21 @@ class MDEngine(mdebase.MDEBase):
 
         if mask:
              self._make_restraints(mask, restr_force)
+        else:
+             self.dlpoly.posres = []
 
-        self.dlpoly.writeField(FIELD_FILENAME)
+        # FIELD only changes with the restraints
+        if self.dlpoly.posres != self._field_posres:
+            self.dlpoly.writeField(self._path(FIELD_FILENAME) )
+            self._field_posres = self.dlpoly.posres
 
-        with open(CONTROL_FILENAME, 'w') as mdin:
+        with open(self._path(CONTROL_FILENAME), 'w') as mdin:
             mdin.writelines(config)
 
-        retc, out, err = utils.run_exe(' '.join((self.mdpref, self.mdprog,
-                                                 self.mdpost)))
+        retc, out, err = utils.run_exe(' '.join((self._sized(self.mdpref),
+                                                 self.mdprog,
+                                                 self._sized(self.mdpost) )),
+                                       cwd=self.workdir)
 
         if retc:
             logger.write(err)
@@ -253,14 +263,18 @@ class MDEngine(mdebase.MDEBase):
                                     self.mdprog)
 
         for mfile in MOVE_LIST:
+            mfile = self._path(mfile)
+
             try:
                 shutil.move(mfile, mfile + os.extsep + suffix)
             except IOError:             # some files may not be created
                 continue
 
+        revcon = self._path(REVCON_FILENAME)
+
         try:
-            shutil.copy2(REVCON_FILENAME, REVCON_FILENAME + os.extsep + suffix)
-            shutil.move(REVCON_FILENAME, CONFIG_FILENAME)
+            shutil.copy2(revcon, revcon + os.extsep + suffix)
+            shutil.move(revcon, self._path(CONFIG_FILENAME) )
         except IOError as why:
             raise errors.SetupError(why)
 
@@ -274,18 +288,13 @@ class MDEngine(mdebase.MDEBase):
         if k < sys.float_info.epsilon:
             return
 
-        try:
-            mask = mdebase._restraint_table[restr]
-        except KeyError:
-            mask = restr
-
-        mask_idx = list(self.mask_indexes(self.amber_top, mask) )
+        mask = self.restraint_mask(restr)
+        mask_idx = self.mask_indexes(self._path(self.amber_top), mask)
 
-        for idx in mask_idx:
-            self.dlpoly.posres.append( (idx + 1, k) )
+        self.dlpoly.posres = [(idx + 1, k) for idx in mask_idx.tolist()]
 
 
-    def to_rst7(self):
+    def _convert_rst7(self):
         """
         Extract coordinates, velocities and box dimensions from REVCON file.
         Units of velocities = Angstrom/ps
@@ -294,8 +303,8 @@ class MDEngine(mdebase.MDEBase):
         """
 
         # CONFIG is actually the most recent REVCON, see _run_mdprog()
-        config_file = CONFIG_FILENAME
-        self.prev = config_file + os.extsep + '%05i' % (self.run_no - 1)
+        config_file = self._path(CONFIG_FILENAME)
+        self.prev = CONFIG_FILENAME + os.extsep + '%05i' % (self.run_no - 1)
 
         line_no = 0
         natoms = 0
@@ -29,8 +29,10 @@ import os
 import glob
 import re
 
+import numpy as np
+
 import mdebase
-from FESetup import const, errors, logger
+from FESetup import const, errors, logger, restart
 from FESetup.prepare.amber import gromacs, utils
 
 
@@ -51,6 +53,14 @@ def _check_exe(bindir, exe_name):
 
     return None
 
+def _newer(native, orig):
+    """
+    Check if native file exists and is not older than the original file.
+    """
+
+    return (os.path.isfile(native) and
+            os.path.getmtime(native) >= os.path.getmtime(orig) )
+
 def _get_suffix(name, suffix):
     for i, char in enumerate(name):
         if char == suffix:
@@ -64,11 +74,13 @@ class MDEngine(mdebase.MDEBase):
     Gromacs MD engine.
     """
 
+    ATOMS_PER_PROC = 500
+
     def __init__(self, amber_top, amber_crd, sander_crd, sander_rst,
                  amber_pdb, box_dims=None, solvent=None, mdprog='mdrun',
-                 mdpref='', mdpost=''):
+                 mdpref='', mdpost='', workdir=''):
 
-        super(MDEngine, self).__init__()
+        super(MDEngine, self).__init__(workdir)
 
         self.update_files(amber_top, amber_crd, sander_crd, sander_rst,
                           amber_pdb)
@@ -97,15 +109,36 @@ class MDEngine(mdebase.MDEBase):
         self.top = os.path.splitext(amber_top)[0] + os.extsep + 'top'
         self.gro = os.path.splitext(amber_crd)[0] + os.extsep + 'gro'
 
-        gtop = gromacs.GromacsTop()
+        self._gtop = None
+
+        # only convert if the native files are out of date
+        if not (_newer(self._path(self.top), self._path(amber_top) ) and
+                _newer(self._path(self.gro), self._path(amber_crd) ) ):
+            self.gtop.writeTop(self._path(self.top), '', '', False)
+            self.gtop.writeGro(self._path(self.gro) )
+
+        # per molecule type restraint indexes of the last mask and the force
+        # constant the posres files were written with
+        self._posres = None
+        self._posres_mask = None
+        self._posres_k = None
+
+
+    @property
+    def gtop(self):
+        """The GROMACS topology, read from the AMBER files on first use."""
 
-        gtop.readParm(amber_top, amber_crd)
-        self.molidx = gtop.molidx
+        if not self._gtop:
+            self._gtop = gromacs.GromacsTop()
+            self._gtop.readParm(self._path(self.amber_top),
+                                self._path(self.amber_crd) )
 
-        gtop.writeTop(self.top, '', '', False)
-        gtop.writeGro(self.gro)
+        return self._gtop
 
-        self.gtop = gtop
+
+    @property
+    def molidx(self):
+        return self.gtop.molidx
 
 
     def minimize(self, config='%STD', nsteps=100, ncyc=100, mask='',
@@ -222,10 +255,7 @@ class MDEngine(mdebase.MDEBase):
         """
 
         gro_file = self.prefix + os.extsep + 'gro'
-
-        with open(gro_file, 'r') as rst:
-            for line in rst:
-                last_line = line
+        last_line = restart.last_line(self._path(gro_file) )
 
         # FIXME: rectangular box only
         box_dims = [float(d) / const.A2NM for d in last_line.split()]
@@ -242,7 +272,7 @@ class MDEngine(mdebase.MDEBase):
         filename = prefix + os.extsep
         config_filename = '_' + filename + 'mdp'
 
-        with open(config_filename, 'w') as mdin:
+        with open(self._path(config_filename), 'w') as mdin:
             mdin.writelines(config)
 
         if self.run_no == 1:
@@ -261,7 +291,8 @@ class MDEngine(mdebase.MDEBase):
         if mask:
              self._make_restraints(mask, restr_force)
 
-        retc, out, err = utils.run_exe(' '.join((self.grompp, params)))
+        retc, out, err = utils.run_exe(' '.join((self.grompp, params)),
+                                       cwd=self.workdir)
 
         if retc:
             logger.write(err)
@@ -270,8 +301,11 @@ class MDEngine(mdebase.MDEBase):
 
         params = '-deffnm %s' % prefix
 
-        retc, out, err = utils.run_exe(' '.join((self.mdpref, self.mdprog,
-                                                 self.mdpost, params)))
+        retc, out, err = utils.run_exe(' '.join((self._sized(self.mdpref),
+                                                 self.mdprog,
+                                                 self._sized(self.mdpost),
+                                                 params)),
+                                       cwd=self.workdir)
 
         if retc:
             logger.write(err)
@@ -283,45 +317,56 @@ class MDEngine(mdebase.MDEBase):
 
 
     def _make_restraints(self, restr, k):
+        """
+        Write the position restraint include files.  The per molecule type
+        index sets are computed only once per mask and the files are only
+        rewritten when mask or force constant change.
+        """
 
         k *= const.CALA2JNM2
+        mask = self.restraint_mask(restr)
+
+        if mask != self._posres_mask:
+            mask_idx = self.mask_indexes(self._path(self.amber_top), mask)
+            self._posres = {}
 
-        try:
-            mask = mdebase._restraint_table[restr]
-        except KeyError:
-            mask = restr
+            # FIXME: each molecule type only recorded once, so this means that
+            #        the mask is assumed to be the same for each type
+            for name, data in self.molidx.iteritems():
+                natoms = data[1]
 
-        mask_idx = list(self.mask_indexes(self.amber_top, mask) )
+                # FIXME: only checks first occurence of molecule in mask index
+                idx_list = np.asarray(data[0][:natoms], dtype=int)
+                molt_idx = idx_list[np.in1d(idx_list, mask_idx)]
 
-        # FIXME: each molecule type only recorded once, so this means that
-        #        the mask is assumed to be the same for each type
-        for name, data in self.molidx.iteritems():
-            idx_list = data[0]
-            natoms = data[1]
-            molt_idx = []
+                if len(molt_idx):
+                    self._posres[name] = molt_idx + 1 - molt_idx.min()
+                else:
+                    self._posres[name] = molt_idx
+
+            self._posres_mask = mask
+            self._posres_k = None
 
-            # FIXME: only checks first occurence of molecule in mask index
-            for i in idx_list[:natoms]:
-                if i in mask_idx:
-                    molt_idx.append(i)
+        if k == self._posres_k:
+            return
 
-            posres_file = (const.GROMACS_POSRES_PREFIX + name +
-                           const.GROMACS_ITP_EXT)
+        for name, rel_idx in self._posres.iteritems():
+            posres_file = self._path(const.GROMACS_POSRES_PREFIX + name +
+                                     const.GROMACS_ITP_EXT)
 
-            if molt_idx:
-                mi = min(molt_idx)
+            if len(rel_idx):
+                fc = ' 1 %.2f %.2f %.2f\n' % (k, k, k)
 
                 with open(posres_file, 'w') as posres:
                     posres.write('[ position_restraints ]\n')
-
-                    for i in molt_idx:
-                        posres.write('%i 1 %.2f %.2f %.2f\n' %
-                                     (i + 1 - mi, k, k, k) )
+                    posres.write(''.join('%i%s' % (i, fc) for i in rel_idx) )
             else:
                 open(posres_file, 'w').close()
 
+        self._posres_k = k
+
 
-    def to_rst7(self):
+    def _convert_rst7(self):
         """
         Use gmxdump to extract coordinates, velocities and box dimensions
         from either the trajectory and convert to AMBER ASCII .rst7
@@ -330,7 +375,8 @@ class MDEngine(mdebase.MDEBase):
         """
 
         params = '-f %s' % (self.prev + os.extsep + 'trr')
-        retc, out, err = utils.run_exe(' '.join((self.gmxdump, params)))
+        retc, out, err = utils.run_exe(' '.join((self.gmxdump, params)),
+                                       cwd=self.workdir)
 
         if retc:
             logger.write(err)
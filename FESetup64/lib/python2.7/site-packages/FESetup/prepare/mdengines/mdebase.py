@@ -25,12 +25,16 @@ __revision__ = "$Id: mdebase.py 590 2016-05-13 20:58:09Z halx $"
 
 
 
-import os, sys
+import os
+import multiprocessing
 
-from parmed.amber.mask import AmberMask
-from parmed.amber.readparm import AmberParm
+import numpy as np
 
-from FESetup import const
+from FESetup import const, errors, logger, restart
+from FESetup.ambermask import AmberMask, MaskTables
+from FESetup.lazyimport import LazyModule
+
+parmed = LazyModule('parmed')
 
 
 
@@ -40,6 +44,12 @@ RST_EXT = os.extsep + 'rst7'
 
 _rs = ' ntr = 1, restraint_wt = %.2f,\n restraintmask="%s",'
 
+# placeholder in mdengine.prefix/postfix replaced by the per run process count
+NPROCS_FIELD = '{np}'
+
+# node-wide settings for process count sizing, see set_sizing()
+_sizing = {'maxprocs': 0, 'scaling': []}
+
 # FIXME: more specific, may not be just protein+water
 #        make FESetup aware what it is dealing with and do this dynamically
 _restraint_table = {
@@ -54,120 +64,283 @@ _restraint_table = {
     }
 
 
+def natoms(topfile):
+    """
+    Get number of atoms from AMBER topology file.
+
+    :param topfile: the topology file
+    :type topfile: string
+    :raises: SetupError
+    :rtype: integer
+    """
+
+    with open(topfile, 'r') as top:
+        for line in top:
+            if line.startswith('%FLAG POINTERS'):
+                top.next()                  # %FORMAT line
+
+                return int(top.next()[:8])
+
+    raise errors.SetupError('no POINTERS section in %s' % topfile)
+
+
+def set_sizing(maxprocs=0, scaling=''):
+    """
+    Configure sizing of process/thread counts for all MD engine launches.
+
+    :param maxprocs: maximum number of processes per run, 0 for all cores
+    :type maxprocs: int
+    :param scaling: file with measured scaling data: lines of number of atoms
+                    and best number of processes, '#' starts a comment
+    :type scaling: string
+    :raises: SetupError
+    """
+
+    table = []
+
+    if scaling:
+        try:
+            with open(scaling, 'r') as data:
+                for line in data:
+                    fields = line.split('#', 1)[0].split()
+
+                    if fields:
+                        table.append( (int(fields[0]), int(fields[1]) ) )
+        except (IOError, IndexError, ValueError) as why:
+            raise errors.SetupError('cannot read scaling data from %s: %s' %
+                                    (scaling, why) )
+
+    table.sort()
+
+    _sizing['maxprocs'] = maxprocs
+    _sizing['scaling'] = table
+
+
+def free_cores():
+    """
+    Estimate the number of idle cores from the 1 min load average so that
+    concurrent builds on the same node share it.
+
+    :returns: number of idle cores, at least 1
+    """
+
+    ncores = multiprocessing.cpu_count()
+
+    try:
+        load = int(round(os.getloadavg()[0]) )
+    except OSError:
+        load = 0
+
+    return max(1, ncores - load)
+
+
+def nprocs(nat, atoms_per_proc):
+    """
+    Size the number of processes for a system.  Measured scaling data is used
+    if available: the process count of the largest measured system not
+    larger than the current one.  Otherwise one process per atoms_per_proc
+    atoms.  The result is limited by the idle cores and maxprocs.
+
+    :param nat: number of atoms
+    :type nat: int
+    :param atoms_per_proc: minimum number of atoms per process
+    :type atoms_per_proc: int
+    :returns: number of processes, at least 1
+    """
+
+    table = _sizing['scaling']
+
+    if table:
+        nproc = 1
+
+        for size, best in table:
+            if size > nat:
+                break
+
+            nproc = best
+    else:
+        nproc = nat // atoms_per_proc
+
+    nproc = min(nproc, free_cores() )
+
+    if _sizing['maxprocs'] > 0:
+        nproc = min(nproc, _sizing['maxprocs'])
+
+    return max(1, nproc)
+
+
 class MDEBase(object):
     """
     MD engine base.
     """
 
-    def __init__(self):
+    # default for sizing without measured scaling data
+    ATOMS_PER_PROC = 1000
+
+    def __init__(self, workdir=''):
+        # all files are relative to workdir, the process' cwd is never changed
+        self.workdir = workdir
         self.run_no = 1
 
+        # engines supporting it queue stages until flush() is called
+        self.chain = False
 
-    def mask_indexes(self, parmtop, mask):
+        # run number of the state last converted to rst7
+        self._rst7_run_no = None
+
+        self._mask_tables = {}
+        self._mask_cache = {}
+
+        self._natoms = (None, 0)
+
+
+    def _path(self, filename):
         """
-        Create AMBER mask index generator from parmtop file.
+        Get the path of a file in the working directory.
 
-        :param parmtop: parmtop filename
-        :type parmtop: string
-        :param mask: AMBER mask
-        :type mask: integer
-        :returns: mask index generator
+        :param filename: file name relative to the working directory
+        :type filename: string
+        :returns: path usable from the current directory
         """
-                
-        p = AmberParm(parmtop)
-        m = AmberMask(p, mask)
 
-        return m.Selected()
+        return os.path.join(self.workdir, filename)
 
 
-    def _write_rst7(self, natoms, xx, yy, zz, coords, vels, center = 'False'):
+    def flush(self):
+        """
+        Run stages queued in chain mode.  Noop for engines running every stage
+        immediately.
         """
-        Write AMBER .rst7 file
 
-        Format:
-        20A4 title
-        I5,5E15.7 #atoms time(ps)    why 5E15.7?
-        6F12.7 coords
-        ...
-        6F12.7 vels (if MD)
-        ...
-        6F12.7 box size
+        pass
 
-        :returns: file name of created rst7 file
+
+    def to_rst7(self):
+        """
+        Convert the current engine-native state to AMBER rst7.  Consecutive
+        stages exchange coordinates, velocities and box in the native format
+        of the engine so conversion is only done on request and at most once
+        per state.
         """
 
-        delx = dely = delz = 0.0
+        self.flush()
 
-        # FIXME: only cuboid box
-        if center:
-            minc = [ sys.float_info[0],  sys.float_info[0],  sys.float_info[0] ]
-            maxc = [-sys.float_info[0], -sys.float_info[0], -sys.float_info[0] ]
-
-            for i in range(0, len(coords), 3):
-                if coords[i]   < minc[0]:
-                    minc[0] = coords[i]
-                if coords[i+1] < minc[1]:
-                    minc[1] = coords[i+1]
-                if coords[i+2] < minc[2]:
-                    minc[2] = coords[i+2]
-
-                if coords[i]   > maxc[0]:
-                    maxc[0] = coords[i]
-                if coords[i+1] > maxc[1]:
-                    maxc[1] = coords[i+1]
-                if coords[i+2] > maxc[2]:
-                    maxc[2] = coords[i+2]
+        if self._rst7_run_no == self.run_no:
+            return
 
-            # FIXME: do we have do consider vdW radii?
-            delx = minc[0] - (xx - maxc[0] + minc[0]) / 2
-            dely = minc[1] - (yy - maxc[1] + minc[1]) / 2
-            delz = minc[2] - (zz - maxc[2] + minc[2]) / 2
+        self._convert_rst7()
+        self._rst7_run_no = self.run_no
 
 
-        with open(self.prev + RST_EXT, 'w') as rst7:
-            rst7.write('converted with FESetup\n')
-            rst7.write('%5i%15.7f\n' % (natoms, 0.0) )
+    def _convert_rst7(self):
+        """
+        Engine specific conversion of the current state into sander_crd.
+        """
+
+        pass
 
-            cnt = 0
-            nl_done = False
 
-            for i in range(0, len(coords), 3):
-                cnt += 3
-                nl_done = False
+    def _sized(self, launch):
+        """
+        Replace the process count placeholder in a launch string, e.g.
+        'mpirun -np {np}', 'gmx mdrun -nt {np}' or 'namd2 +p{np}', with the
+        count sized for the current system.
 
-                x = coords[i]   - delx
-                y = coords[i+1] - dely
-                z = coords[i+2] - delz
+        :param launch: prefix or postfix of the MD program
+        :type launch: string
+        :returns: launch string for this run
+        """
 
-                rst7.write('%12.7f%12.7f%12.7f' % (x, y, z) )
+        if NPROCS_FIELD not in launch:
+            return launch
 
-                if cnt >= 6:
-                    rst7.write('\n')
-                    cnt = 0
-                    nl_done = True
+        top = self._path(self.amber_top)
+        topkey = (top, os.path.getmtime(top) )
 
-            if cnt < 6 and not nl_done:
-                rst7.write('\n')
+        if self._natoms[0] != topkey:
+            self._natoms = (topkey, natoms(top) )
 
-            cnt = 0
-            nl_done = False
+        nproc = nprocs(self._natoms[1], self.ATOMS_PER_PROC)
+        logger.write('Using %i processes for %i atoms' %
+                     (nproc, self._natoms[1]) )
 
-            for coord in vels:
-                cnt += 1
-                nl_done = False
+        return launch.replace(NPROCS_FIELD, str(nproc) )
 
-                rst7.write('%12.7f' % coord)
 
-                if cnt >= 6:
-                    rst7.write('\n')
-                    cnt = 0
-                    nl_done = True
+    def mask_indexes(self, parmtop, mask):
+        """
+        Get atom indexes selected by an AMBER mask from parmtop file.  The
+        result is memoised per (topology, mask) so that repeated restraint
+        setups, e.g. in the restraint relaxation loop, neither re-read the
+        parmtop nor re-evaluate the mask.  The topology is identified by path
+        and modification time.
+
+        :param parmtop: parmtop filename
+        :type parmtop: string
+        :param mask: AMBER mask
+        :type mask: string
+        :returns: (0-based) mask indexes
+        :rtype: numpy.ndarray
+        """
 
-            if cnt < 6 and not nl_done:
-                rst7.write('\n')
+        topkey = (os.path.abspath(parmtop), os.path.getmtime(parmtop) )
+        key = (topkey, mask)
+
+        if key not in self._mask_cache:
+            if topkey not in self._mask_tables:
+                parm = parmed.amber.AmberParm(parmtop)
+                self._mask_tables[topkey] = MaskTables(parm)
+
+            self._mask_cache[key] = \
+                AmberMask(self._mask_tables[topkey], mask).indexes()
+
+        return self._mask_cache[key]
+
+
+    def restraint_mask(self, restr):
+        """
+        Translate a pre-defined restraint name into an AMBER mask.
+
+        :param restr: pre-defined restraint or AMBER mask
+        :type restr: string
+        :returns: AMBER mask
+        """
+
+        try:
+            return _restraint_table[restr]
+        except KeyError:
+            return restr
+
+
+    def _write_rst7(self, natoms, xx, yy, zz, coords, vels, center = False):
+        """
+        Write AMBER .rst7 file
+
+        :param natoms: number of atoms
+        :type natoms: integer
+        :param xx, yy, zz: box lengths
+        :type xx, yy, zz: float
+        :param coords: flat list of coordinates
+        :type coords: array-like
+        :param vels: flat list of velocities (AMBER units)
+        :type vels: array-like
+        :param center: center coordinates in the box
+        :type center: bool
+        :returns: file name of created rst7 file
+        """
+
+        crd = np.asarray(coords, dtype=np.float64).reshape(natoms, 3)
+
+        # FIXME: only cuboid box
+        if center:
+            minc = crd.min(axis=0)
+            maxc = crd.max(axis=0)
+
+            # FIXME: do we have do consider vdW radii?
+            crd = crd - (minc - (np.array( (xx, yy, zz) ) - maxc + minc) / 2)
 
-            # FIXME: only cuboid box
-            rst7.write('%12.7f%12.7f%12.7f%12.7f%12.7f%12.7f\n' %
-                       (xx, yy, zz, 90.0, 90.0, 90.0) )
+        filename = self.prev + RST_EXT
+        restart.write_rst7(self._path(filename), crd, vels, (xx, yy, zz),
+                           'converted with FESetup')
 
-        return self.prev + RST_EXT
+        return filename
@@ -28,7 +28,7 @@ __revision__ = "$Id: namd.py 558 2016-04-29 08:09:51Z halx $"
 import os, sys, struct
 
 import mdebase
-from FESetup import const, errors, logger
+from FESetup import const, errors, logger, restart
 from FESetup.prepare.amber import utils
 
 
@@ -75,7 +75,6 @@ def namd_velcoor(filename):
     return natoms, coords
 
 
-# FIXME: write individual steps into TCL script and run only once
 class MDEngine(mdebase.MDEBase):
     """
     NAM MD engine.
@@ -85,9 +84,9 @@ class MDEngine(mdebase.MDEBase):
     #        other MD packages
     def __init__(self, amber_top, amber_crd, sander_crd, sander_rst,
                  amber_pdb, box_dims=[0.0, 0.0, 0.0], solvent='tip3',
-                 mdprog='namd2', mdpref='', mdpost=''):
+                 mdprog='namd2', mdpref='', mdpost='', workdir=''):
 
-        super(MDEngine, self).__init__()
+        super(MDEngine, self).__init__(workdir)
 
         # FIXME: do not assume that top/crd are in AMBER format
         self.update_files(amber_top, amber_crd, sander_crd, sander_rst,
@@ -99,6 +98,9 @@ class MDEngine(mdebase.MDEBase):
         self.prev = ''
         self.prefix = ''
 
+        # stages queued in chain mode
+        self._stages = []
+
         self.mdprog = ''
         self._self_check(mdprog)
 
@@ -120,6 +122,10 @@ class MDEngine(mdebase.MDEBase):
         # FIXME: only cuboid box
         self.xx, self.yy, self.zz = box_dims[0:3]
 
+        # PDB template for restraint files: lines and restraint flags
+        self._restr_lines = None
+        self._restr_mask = None
+
 
     def minimize(self, config='%STD', nsteps=100, ncyc=10, mask='',
                  restr_force=5.0):
@@ -142,6 +148,19 @@ class MDEngine(mdebase.MDEBase):
         :raises: SetupError
         """
 
+        if self.chain and config[0] == '%':
+            if 'AMBER_MIN_%s' % config[1:] not in PROTOCOLS:
+                raise errors.SetupError('no such min protocol predefined: '
+                                        '%s' % config)
+
+            logger.write('Queueing minimisation with protocol %s' %
+                         config[1:])
+            self._queue('min', nsteps, mask, restr_force)
+
+            return
+
+        self.flush()
+
         prefix = mdebase.MIN_PREFIX + '%05i' % self.run_no
         restr_filen = prefix + '_restr' + const.PDB_EXT
 
@@ -204,6 +223,21 @@ class MDEngine(mdebase.MDEBase):
         """
 
         dt = dt * 1000.0
+
+        if nsteps % STEPS_PER_CYCLE:
+            nsteps = (nsteps / STEPS_PER_CYCLE + 1) * STEPS_PER_CYCLE
+            logger.write('Warning: nsteps has been changed to %i to ensure it '
+                         'to be multiple of stepsPerCycle' % nsteps)
+
+        if self.chain and config[0] == '%':
+            logger.write('Queueing MD with protocol %s' % config[1:])
+            self._queue(config[1:].lower(), nsteps, mask, restr_force, T=T,
+                        p=p, nrel=nrel, wrap=wrap, dt=dt)
+
+            return
+
+        self.flush()
+
         prefix = mdebase.MD_PREFIX + '%05i' % self.run_no
         
         restr_filen = prefix + '_restr' + const.PDB_EXT
@@ -214,11 +248,6 @@ class MDEngine(mdebase.MDEBase):
         else:
             restb = 'F'
 
-        if nsteps % STEPS_PER_CYCLE:
-            nsteps = (nsteps / STEPS_PER_CYCLE + 1) * STEPS_PER_CYCLE
-            logger.write('Warning: nsteps has been changed to %i to ensure it '
-                         'to be multiple of stepsPerCycle' % nsteps)
-
         if config[0] == '%':
             pname = config[1:]
             logger.write('Running MD with protocol %s' % pname)
@@ -253,20 +282,17 @@ class MDEngine(mdebase.MDEBase):
         :returns: box dimensions
         """
 
-        xst_file = self.prefix + os.extsep + 'xst'
-
-        with open(xst_file, 'r') as rst:
-            for line in rst:
-                last_line = line
+        # xsc is written for single runs and chain stages alike
+        xsc_file = self.prefix + os.extsep + 'xsc'
 
         # FIXME: rectangular box only
-        d = last_line.split()
+        d = restart.last_line(self._path(xsc_file) ).split()
         box_dims = [float(d[1]), float(d[5]), float(d[9]), 90.0, 90.0, 90.0]
                         
         return box_dims
 
 
-    def to_rst7(self):
+    def _convert_rst7(self):
         """
         Convert binary NAMD coordinates and velocities plus extended system
         information (xsc) into AMBER ASCII .rst7
@@ -274,7 +300,7 @@ class MDEngine(mdebase.MDEBase):
         :raises: SetupError
         """
         
-        prefix = self.prev + os.extsep
+        prefix = self._path(self.prev + os.extsep)
 
         natoms, coords = namd_velcoor(prefix + 'coor')
         ncheck, vels = namd_velcoor(prefix + 'vel')
@@ -283,11 +309,7 @@ class MDEngine(mdebase.MDEBase):
             raise errors.SetupError('different number of atoms in coor(%i) '
                                     'and vel(%i) files' % (natoms, ncheck) )
 
-        with open(prefix + 'xsc') as xsc:
-            for line in xsc:
-                ext = line
-
-        ext = ext.split()
+        ext = restart.last_line(prefix + 'xsc').split()
 
         # FIXME: only cuboid box
         xx, yy, zz = float(ext[1]), float(ext[5]), float(ext[9])
@@ -301,17 +323,30 @@ class MDEngine(mdebase.MDEBase):
         Run namd.
         """
 
+        self._run_namd(prefix, config)
+
+        self.run_no += 1
+        self.prev = prefix
+
+
+    def _run_namd(self, prefix, config):
+        """
+        Write config file and execute namd.
+        """
+
         filename = prefix + os.extsep
         config_filename = filename + 'in'
         
-        with open(config_filename, 'w') as mdin:
+        with open(self._path(config_filename), 'w') as mdin:
             mdin.writelines(config)
 
-        retc, out, err = utils.run_exe(' '.join((self.mdpref, self.mdprog,
-                                                 self.mdpost,
-                                                 config_filename)))
+        retc, out, err = utils.run_exe(' '.join((self._sized(self.mdpref),
+                                                 self.mdprog,
+                                                 self._sized(self.mdpost),
+                                                 config_filename)),
+                                       cwd=self.workdir)
 
-        with open(filename + 'out', 'w') as outfile:
+        with open(self._path(filename + 'out'), 'w') as outfile:
             outfile.writelines(out)
 
         if retc:
@@ -319,35 +354,143 @@ class MDEngine(mdebase.MDEBase):
             raise errors.SetupError('%s has failed (see logfile)' %
                                     self.mdprog)
 
+
+    def _queue(self, job_type, nsteps, mask, restr_force, T=0.0, p=1.0,
+               nrel=1, wrap=True, dt=None):
+        """
+        Queue a stage for a later chained run.  The stage prefix is allocated
+        now so that checkpoint names are the same as for individual runs.
+        """
+
+        if job_type == 'min':
+            prefix = mdebase.MIN_PREFIX + '%05i' % self.run_no
+        else:
+            prefix = mdebase.MD_PREFIX + '%05i' % self.run_no
+
         self.run_no += 1
-        self.prev = prefix
+
+        self._stages.append(dict(
+            job_type=job_type, prefix=prefix, nsteps=nsteps,
+            mask=self.restraint_mask(mask) if mask else '', k=restr_force,
+            T=T, p=p, nrel=nrel, wrap=wrap, dt=dt,
+            constp=job_type in ('press', 'shrink', 'relres') ) )
+
+
+    def flush(self):
+        """
+        Run all queued stages.  Consecutive stages which agree in the settings
+        NAMD cannot change between run commands (pressure coupling, time step,
+        restraint atoms) are compiled into one TCL script and executed with a
+        single namd2 invocation.  Each stage writes a checkpoint (coor, vel,
+        xsc) under its own prefix.
+        """
+
+        stages = self._stages
+        self._stages = []
+        group = []
+
+        for stage in stages:
+            if group and not _chainable(group, stage):
+                self._run_chain(group)
+                group = []
+
+            group.append(stage)
+
+        if group:
+            self._run_chain(group)
+
+
+    def _run_chain(self, stages):
+        """
+        Compile stages into a single TCL script and run namd once.
+        """
+
+        first, last = stages[0], stages[-1]
+
+        masks = [s['mask'] for s in stages if s['mask']]
+        md_stages = [s for s in stages if s['job_type'] != 'min']
+
+        # restraint force constants are set per stage via constraintScaling
+        if masks:
+            restr_filen = first['prefix'] + '_restr' + const.PDB_EXT
+            self._make_restraints(restr_filen, masks[0], 1.0)
+            cons = 'on'
+        else:
+            restr_filen = ''
+            cons = 'off'
+
+        if md_stages:
+            dt = md_stages[0]['dt']
+            wrap = 'on' if md_stages[0]['wrap'] else 'off'
+            p = md_stages[0]['p']
+            outfreq = max(STEPS_PER_CYCLE,
+                          min(s['nsteps'] for s in md_stages) / 10)
+        else:
+            dt = 1.0
+            wrap = 'on'
+            p = 1.0
+            outfreq = STEPS_PER_CYCLE
+
+        if first['job_type'] == 'min':
+            startT = 0.0
+        elif first['job_type'] == 'heat':
+            startT = START_T
+        else:
+            startT = first['T']
+
+        logger.write('Running NAMD chain %s' %
+                     ' '.join('%s(%s)' % (s['prefix'], s['job_type'])
+                              for s in stages) )
+
+        config = [PROTOCOLS['AMBER_CHAIN'].format(
+            self.prev, last['prefix'], self.amber_top, self.amber_pdb,
+            self.solvent, self.xx, self.yy, self.zz, startT,
+            'on' if first['constp'] else 'off', p, outfreq, wrap, cons,
+            restr_filen, STEPS_PER_CYCLE, dt)]
+
+        for stage in stages:
+            config.append(_chain_stage(stage, bool(masks) ) )
+
+        self._run_namd(last['prefix'], ''.join(config) )
+
+        self.prev = last['prefix']
+        self.prefix = last['prefix']
 
 
     def _make_restraints(self, ofilen, restr, k):
+        """
+        Write PDB file with restraint force constants in the B-factor column.
+        The PDB template and the selected atoms are only determined once per
+        mask, subsequent calls only write the new force constant.
+        """
 
-        try:
-            mask = mdebase._restraint_table[restr]
-        except KeyError:
-            mask = restr
+        mask = self.restraint_mask(restr)
 
-        # FIXME: assumes AMBER parmtop
-        indexes = list(self.mask_indexes(self.amber_top, mask) )
-        acnt = 0
+        if mask != self._restr_mask:
+            # FIXME: assumes AMBER parmtop
+            indexes = set(self.mask_indexes(self._path(self.amber_top),
+                                            mask).tolist() )
+            acnt = 0
+            self._restr_lines = []
 
-        with open(ofilen, 'w') as opdb:
-            with open(self.amber_pdb, 'r') as ipdb:
+            with open(self._path(self.amber_pdb), 'r') as ipdb:
                 for line in ipdb:
                     if line[:6] == 'ATOM  ' or line[:6] == 'HETATM':
-                        if acnt in indexes:
-                            tmp = line[:60] + '%6.2f' % k + line[66:]
-                        else:
-                            tmp = line
-
+                        self._restr_lines.append( (line, acnt in indexes) )
                         acnt += 1
                     else:
-                        tmp = line
+                        self._restr_lines.append( (line, False) )
+
+            self._restr_mask = mask
 
-                    opdb.write(tmp)
+        bval = '%6.2f' % k
+
+        with open(self._path(ofilen), 'w') as opdb:
+            for line, restrained in self._restr_lines:
+                if restrained:
+                    opdb.write(line[:60] + bval + line[66:])
+                else:
+                    opdb.write(line)
 
 
     def _self_check(self, mdprog):
@@ -369,6 +512,92 @@ class MDEngine(mdebase.MDEBase):
         
         
 
+START_T = 5.0
+
+
+def _chainable(stages, stage):
+    """
+    Check if stage can be appended to a chain of stages.
+    """
+
+    ref = stages[0]
+
+    if stage['constp'] != ref['constp']:
+        return False
+
+    for s in stages:
+        if s['dt'] and stage['dt'] and s['dt'] != stage['dt']:
+            return False
+
+        if s['mask'] and stage['mask'] and s['mask'] != stage['mask']:
+            return False
+
+    return True
+
+
+def _chain_stage(stage, restraints):
+    """
+    Create the TCL code for a single stage in a chained run.
+
+    :param stage: the stage parameters
+    :type stage: dict
+    :param restraints: if restraints are active in this chain
+    :type restraints: bool
+    :returns: TCL code
+    """
+
+    job_type = stage['job_type']
+    T = stage['T']
+    nsteps = stage['nsteps']
+
+    tcl = ['\n# stage %s: %s\n' % (stage['prefix'], job_type)]
+
+    if restraints:
+        k = stage['k'] if stage['mask'] else 0.0
+        tcl.append('constraintScaling %.4f\n' % k)
+
+    if job_type == 'min':
+        tcl.append('minimize %i\n' % nsteps)
+    else:
+        if job_type == 'randomv':
+            tcl.append('reinitvels %.2f\n' % T)
+
+        if job_type == 'heat':
+            tcl.append(CHAIN_HEAT.format(nsteps, START_T, T, STEPS_PER_CYCLE) )
+        elif job_type == 'relres' and restraints and stage['mask']:
+            tcl.append(CHAIN_RELRES.format(nsteps, stage['nrel'], k, T,
+                                           STEPS_PER_CYCLE) )
+        else:
+            tcl.append('langevinTemp %.2f\nrun %i\n' % (T, nsteps) )
+
+    tcl.append('output "%s"\n' % stage['prefix'])
+
+    return ''.join(tcl)
+
+
+CHAIN_HEAT = '''set nsteps {0}
+set tinc [check_multiple [expr $nsteps / 10] {3}]
+
+for {{set step 0}} {{$step < [expr $nsteps - $tinc]}} {{incr step $tinc}} {{
+  langevinTemp [expr {{({2} - {1}) * $step / $nsteps + {1}}} ]
+  run $tinc
+}}
+
+langevinTemp {2}
+run $tinc
+'''
+
+CHAIN_RELRES = '''set nsteps {0}
+set rinc [check_multiple [expr $nsteps / {1:d}] {4}]
+langevinTemp {3}
+
+for {{set step 0}} {{$step < $nsteps}} {{incr step $rinc}} {{
+  constraintScaling [ expr {{ {2} * (-double($step) / $nsteps + 1.0) }} ]
+  run $rinc
+}}
+'''
+
+
 PROTOCOLS = dict(
     # NAMD also appears to need prior minimisation, possibly because of tight
     # pressure coupling
@@ -577,5 +806,106 @@ if {{$job_type == "randomv"}} {{
     run $nsteps
   }}
 }}
+''',
+
+    # header for chained runs, stages are appended by MDEngine._run_chain
+    AMBER_CHAIN = '''
+set prev_step     "{0}"
+
+amber             yes
+parmfile          "{2}"
+coordinates       "{3}"
+readexclusions    yes
+exclude           scaled1-4
+1-4scaling        0.833333
+scnb              2.0
+zeromomentum      on
+LJcorrection      on
+
+watermodel        {4}
+useSettle         on
+rigidBonds        all
+rigidIterations   300
+rigidTolerance    1.0e-8
+rigidDieOnError   off
+
+PME                on
+PMEGridSpacing     1.0
+nonbondedFreq      1
+fullElectFrequency 1
+
+switching         off
+cutoff            8.0
+pairlistsPerCycle 1
+stepspercycle     {15}
+
+minTinyStep       1.0E-3
+minBabyStep       1.0E-7
+
+langevin          on
+langevinHydrogen  on
+langevinDamping   1
+
+if {{"{9}" == "on"}} {{
+  margin               2.5
+  BerendsenPressure  on
+  BerendsenPressureTarget {10}
+  BerendsenPressureCompressibility 4.5E-5
+  BerendsenPressureRelaxationTime 50.0
+}} else {{
+  useGroupPressure  yes
+  LangevinPiston    off
+  BerendsenPressure off
+}}
+
+outputname       "{1}"
+outputEnergies   {11}
+outputPressure   {11}
+binaryoutput     yes
+
+restartname      "{1}"
+restartfreq      {11}
+binaryrestart    yes
+
+XSTfile          "{1}.xst"
+XSTfreq          {11}
+
+wrapAll          {12}
+wrapNearest      on
+DCDfile          "{1}.dcd"
+DCDUnitCell      yes
+DCDfreq          {11}
+
+constraints       {13}
+
+if {{"{13}" == "on"}} {{
+  consexp           2
+  consref           "{14}"
+  conskfile         "{14}"
+  conskcol          B
+}}
+
+if {{$prev_step != ""}} {{
+  binvelocities       "$prev_step.vel"
+  bincoordinates      "$prev_step.coor"
+  ExtendedSystem      "$prev_step.xsc"
+  firsttimestep       0
+}} else {{
+  cellBasisVector1    {5}  0  0
+  cellBasisVector2    0  {6} 0
+  cellBasisVector3    0  0  {7}
+  temperature {8}
+}}
+
+timestep {16}
+
+
+proc check_multiple {{p1 p2}} {{
+  if {{[expr $p1 % $p2] != 0}} {{
+    set p1 [expr ($p1 / $p2 + 1) * $p2]
+  }}
+
+  return $p1
+}}
 '''
 )
@@ -54,12 +54,13 @@ def protonate_propka(self, pH = 7.0):
 
     # add PDB file name to options to avoid warning of missing file, also
     # set config file path to module path to find propka.cfg
-    options, dummy = plib.loadOptions( ['--pH', pH, '-q', self.mol_file] )
+    mol_file = self._path(self.mol_file)
+    options, dummy = plib.loadOptions( ['--pH', pH, '-q', mol_file] )
     options.parameters = os.path.join(os.path.dirname(pmc.__file__),
                                       options.parameters)
 
     with CaptureOutput() as output:
-        mol = pmc.Molecular_container_new(self.mol_file, options)
+        mol = pmc.Molecular_container_new(mol_file, options)
         pKas = mol.calculate_pka()
 
     logger.write('%s%s' % (output[0], output[1]) )
@@ -79,8 +80,8 @@ def protonate_propka(self, pH = 7.0):
 
     msg_res = set()
 
-    with open(const.PROTONATED_PDB_FILE, 'w') as newfile:
-        with open(self.mol_file, 'r') as pdbfile:
+    with open(self._path(const.PROTONATED_PDB_FILE), 'w') as newfile:
+        with open(mol_file, 'r') as pdbfile:
             for line in pdbfile:
                 if line[:6] in ('ATOM  ', 'HETATM'):
                     resName = line[17:21].strip()
@@ -0,0 +1,403 @@
+#  Copyright (C) 2016  Hannes H Loeffler
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  For full details of the license please see the COPYING file
+#  that should have come with this distribution.
+
+r"""
+Reading and writing of AMBER restart files: ASCII rst7 and NetCDF.
+
+All data is handled as NumPy arrays and formatted/parsed in bulk.  NetCDF
+support requires scipy.io.netcdf, check HAVE_NETCDF.
+"""
+
+__revision__ = "$Id$"
+
+
+
+import os
+
+import numpy as np
+
+try:
+    from scipy.io import netcdf as _netcdf
+    HAVE_NETCDF = True
+except ImportError:
+    HAVE_NETCDF = False
+
+from FESetup import const, errors
+
+
+
+RST7_EXT = os.extsep + 'rst7'
+NCRST_EXT = os.extsep + 'ncrst'
+
+_FIELD_WIDTH = 12
+_PER_LINE = 6
+_TAIL_BYTES = 512
+_NETCDF_MAGIC = ('CDF\x01', 'CDF\x02', '\x89HDF')
+
+
+class Restart(object):
+    """
+    Restart data: coordinates and velocities as (N,3) arrays, velocities and
+    box may be None.
+    """
+
+    __slots__ = ('title', 'time', 'coords', 'vels', 'box')
+
+    def __init__(self, coords, vels=None, box=None, title='', time=0.0):
+        self.coords = coords
+        self.vels = vels
+        self.box = box
+        self.title = title
+        self.time = time
+
+
+    @property
+    def natoms(self):
+        return self.coords.shape[0]
+
+
+def is_netcdf(filename):
+    """
+    Check if file is in NetCDF format.
+
+    :param filename: file name
+    :type filename: string
+    :rtype: bool
+    """
+
+    with open(filename, 'rb') as rst:
+        return rst.read(4) in _NETCDF_MAGIC
+
+
+def read_box(filename):
+    """
+    Get the box from a restart file.  For ASCII files only the end of the file
+    is read.
+
+    :param filename: name of the restart file
+    :type filename: string
+    :returns: box lengths and angles (if present in file)
+    :rtype: list of float
+    """
+
+    if is_netcdf(filename):
+        rst = read_ncrst(filename)
+
+        if rst.box is None:
+            return []
+
+        return rst.box.tolist()
+
+    return _parse_fields(last_line(filename) ).tolist()
+
+
+def last_line(filename):
+    """
+    Get the last non-empty line of a text file by seeking from the end.
+
+    :param filename: file name
+    :type filename: string
+    :raises: SetupError
+    :returns: last line
+    """
+
+    with open(filename, 'rb') as text:
+        text.seek(0, os.SEEK_END)
+        size = text.tell()
+        nbytes = _TAIL_BYTES
+
+        while True:
+            text.seek(max(0, size - nbytes) )
+            lines = text.read().rstrip().splitlines()
+
+            if len(lines) > 1 or nbytes >= size:
+                break
+
+            nbytes *= 2
+
+    if not lines:
+        raise errors.SetupError('empty file %s' % filename)
+
+    return lines[-1]
+
+
+def read_restart(filename):
+    """
+    Read ASCII or NetCDF restart file.
+
+    :param filename: name of the restart file
+    :type filename: string
+    :returns: restart data
+    :rtype: Restart
+    """
+
+    if is_netcdf(filename):
+        return read_ncrst(filename)
+
+    return read_rst7(filename)
+
+
+def read_rst7(filename):
+    """
+    Read ASCII rst7 file.
+
+    :param filename: name of the rst7 file
+    :type filename: string
+    :raises: SetupError
+    :returns: restart data
+    :rtype: Restart
+    """
+
+    with open(filename, 'rb') as rst:
+        title = rst.readline().rstrip()
+        header = rst.readline().split()
+        data = ''.join(line.rstrip() for line in rst)
+
+    try:
+        natoms = int(header[0])
+        time = float(header[1]) if len(header) > 1 else 0.0
+    except (IndexError, ValueError):
+        raise errors.SetupError('malformed header in %s' % filename)
+
+    values = _parse_fields(data)
+
+    ncrd = 3 * natoms
+    nval = len(values)
+
+    if nval < ncrd:
+        raise errors.SetupError('too few coordinates in %s' % filename)
+
+    coords = values[:ncrd].reshape(natoms, 3)
+    vels = None
+    box = None
+
+    rest = values[ncrd:]
+
+    # velocities only if followed by nothing, box lengths or lengths and angles
+    if len(rest) in (ncrd, ncrd + 3, ncrd + 6):
+        vels = rest[:ncrd].reshape(natoms, 3)
+        rest = rest[ncrd:]
+
+    if len(rest) not in (0, 3, 6):
+        raise errors.SetupError('unexpected number of values (%i) after the '
+                                'coordinates in %s' %
+                                (nval - ncrd, filename) )
+
+    if len(rest):
+        box = rest
+
+    return Restart(coords, vels, box, title, time)
+
+
+def write_rst7(filename, coords, vels=None, box=None, title='', time=0.0):
+    """
+    Write ASCII rst7 file.
+
+    :param filename: name of the rst7 file
+    :type filename: string
+    :param coords: coordinates
+    :type coords: array-like (N,3) or flat
+    :param vels: velocities in AMBER units
+    :type vels: array-like (N,3) or flat
+    :param box: box lengths and optionally angles
+    :type box: array-like
+    :param title: title line
+    :type title: string
+    :param time: simulation time in ps
+    :type time: float
+    """
+
+    coords = np.asarray(coords, dtype=np.float64).ravel()
+    natoms = len(coords) / 3
+
+    with open(filename, 'w') as rst:
+        rst.write('%s\n' % (title or 'written by FESetup') )
+        rst.write('%5i%15.7f\n' % (natoms, time) )
+        rst.write(_format_block(coords) )
+
+        if vels is not None and len(vels):
+            rst.write(_format_block(vels) )
+
+        if box is not None and len(box):
+            box = list(box)
+
+            if len(box) == 3:
+                box.extend( (90.0, 90.0, 90.0) )
+
+            rst.write(_format_block(box) )
+
+
+def read_ncrst(filename):
+    """
+    Read AMBER NetCDF restart file.
+
+    :param filename: name of the NetCDF restart file
+    :type filename: string
+    :raises: SetupError
+    :returns: restart data
+    :rtype: Restart
+    """
+
+    if not HAVE_NETCDF:
+        raise errors.SetupError('NetCDF support requires scipy.io.netcdf')
+
+    ncf = _netcdf.netcdf_file(filename, 'r', mmap=False)
+
+    try:
+        var = ncf.variables
+
+        coords = np.array(var['coordinates'][:], dtype=np.float64)
+        vels = None
+        box = None
+
+        if 'velocities' in var:
+            vels = np.array(var['velocities'][:], dtype=np.float64)
+
+        if 'cell_lengths' in var:
+            box = np.concatenate( (var['cell_lengths'][:],
+                                   var['cell_angles'][:]) ).astype(np.float64)
+
+        time = float(var['time'].getValue() ) if 'time' in var else 0.0
+        title = getattr(ncf, 'title', '')
+    finally:
+        ncf.close()
+
+    return Restart(coords, vels, box, title, time)
+
+
+def write_ncrst(filename, coords, vels=None, box=None, title='', time=0.0):
+    """
+    Write AMBER NetCDF restart file (AMBERRESTART convention).
+
+    :param filename: name of the NetCDF restart file
+    :type filename: string
+    :param coords: coordinates
+    :type coords: array-like (N,3) or flat
+    :param vels: velocities in AMBER units
+    :type vels: array-like (N,3) or flat
+    :param box: box lengths and optionally angles
+    :type box: array-like
+    :param title: title
+    :type title: string
+    :param time: simulation time in ps
+    :type time: float
+    :raises: SetupError
+    """
+
+    if not HAVE_NETCDF:
+        raise errors.SetupError('NetCDF support requires scipy.io.netcdf')
+
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+    natoms = coords.shape[0]
+
+    ncf = _netcdf.netcdf_file(filename, 'w', version=2)
+
+    try:
+        ncf.Conventions = 'AMBERRESTART'
+        ncf.ConventionVersion = '1.0'
+        ncf.application = 'AMBER'
+        ncf.program = 'FESetup'
+        ncf.programVersion = '1.0'
+        ncf.title = title or 'written by FESetup'
+
+        ncf.createDimension('spatial', 3)
+        ncf.createDimension('atom', natoms)
+        ncf.createDimension('label', 5)
+        ncf.createDimension('cell_spatial', 3)
+        ncf.createDimension('cell_angular', 3)
+
+        spatial = ncf.createVariable('spatial', 'c', ('spatial',) )
+        spatial[:] = np.array(list('xyz') )
+
+        tvar = ncf.createVariable('time', 'd', () )
+        tvar.units = 'picosecond'
+        tvar.assignValue(time)
+
+        cvar = ncf.createVariable('coordinates', 'd', ('atom', 'spatial') )
+        cvar.units = 'angstrom'
+        cvar[:] = coords
+
+        if vels is not None and len(vels):
+            vvar = ncf.createVariable('velocities', 'd', ('atom', 'spatial') )
+            vvar.units = 'angstrom/picosecond'
+            vvar.scale_factor = const.AMBER_VELCONV
+            vvar[:] = np.asarray(vels, dtype=np.float64).reshape(-1, 3)
+
+        if box is not None and len(box):
+            box = list(box)
+
+            if len(box) == 3:
+                box.extend( (90.0, 90.0, 90.0) )
+
+            cspatial = ncf.createVariable('cell_spatial', 'c',
+                                          ('cell_spatial',) )
+            cspatial[:] = np.array(list('abc') )
+
+            cangular = ncf.createVariable('cell_angular', 'c',
+                                          ('cell_angular', 'label') )
+            cangular[:] = np.array([list('alpha'), list('beta '),
+                                    list('gamma')])
+
+            lvar = ncf.createVariable('cell_lengths', 'd', ('cell_spatial',) )
+            lvar.units = 'angstrom'
+            lvar[:] = np.array(box[:3], dtype=np.float64)
+
+            avar = ncf.createVariable('cell_angles', 'd', ('cell_angular',) )
+            avar.units = 'degree'
+            avar[:] = np.array(box[3:6], dtype=np.float64)
+    finally:
+        ncf.close()
+
+
+def _parse_fields(data):
+    """
+    Parse a string of concatenated fixed width (12) rst7 fields.
+    """
+
+    nval = len(data) / _FIELD_WIDTH
+
+    if not nval:
+        return np.zeros(0)
+
+    try:
+        return np.frombuffer(data[:nval * _FIELD_WIDTH],
+                             dtype='S%i' % _FIELD_WIDTH).astype(np.float64)
+    except ValueError:
+        raise errors.SetupError('malformed fields in rst7 data')
+
+
+def _format_block(values):
+    """
+    Format values in rst7 style: 6F12.7 per line.
+    """
+
+    flat = np.asarray(values, dtype=np.float64).ravel()
+    nfull = len(flat) / _PER_LINE * _PER_LINE
+    fmt = '%12.7f' * _PER_LINE + '\n'
+    block = []
+
+    if nfull:
+        block.append( (fmt * (nfull / _PER_LINE) ) % tuple(flat[:nfull]) )
+
+    rest = flat[nfull:]
+
+    if len(rest):
+        block.append( ('%12.7f' * len(rest) + '\n') % tuple(rest) )
+
+    return ''.join(block)
@@ -0,0 +1,111 @@
+#  Copyright (C) 2016  Hannes H Loeffler
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+#  For full details of the license please see the COPYING file
+#  that should have come with this distribution.
+
+r"""
+Startup time benchmark for dGprep: --help, output of the defaults and a
+no-op restart run, i.e. an input file whose models all exist already.  Also
+lists the chemistry toolkits loaded by a plain import of dGprep which should
+be none.  Run through the FESetup wrapper script so that the environment is
+set up, e.g.
+
+  FESetup startup_bench.py -n 10 -i setup.in
+"""
+
+__revision__ = "$Id$"
+
+
+
+import os
+import sys
+import time
+import argparse
+import subprocess as subp
+
+import FESetup.ui
+
+
+HEAVY_MODULES = ('Sire', 'rdkit', 'openbabel', 'pybel', 'parmed', 'numpy',
+                 'scipy')
+
+IMPORT_CHECK = ('import sys; import FESetup.ui.dGprep; '
+                'print(" ".join(m for m in %r if m in sys.modules))' %
+                (HEAVY_MODULES, ) )
+
+
+def timeit(cmd, nrepeat, cwd=None):
+    """
+    Time a command line.
+
+    :param cmd: the command line
+    :type cmd: list
+    :param nrepeat: number of repetitions
+    :type nrepeat: int
+    :param cwd: working directory
+    :type cwd: str
+    :returns: minimum and median wall clock time
+    """
+
+    times = []
+
+    with open(os.devnull, 'w') as null:
+        for i in range(nrepeat):
+            start = time.time()
+            retc = subp.call(cmd, stdout=null, stderr=null, cwd=cwd)
+            times.append(time.time() - start)
+
+            if retc:
+                sys.exit('Command %s failed with exit code %i' %
+                         (' '.join(cmd), retc) )
+
+    times.sort()
+
+    return times[0], times[len(times) // 2]
+
+
+if __name__ == '__main__':
+    default = os.path.join(os.path.dirname(FESetup.ui.__file__), 'dGprep.py')
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--repeat', type=int, default=5,
+                        help='number of repetitions per case')
+    parser.add_argument('-i', '--infile',
+                        help='input file of a completed setup for the no-op '
+                        'restart case, run in the directory of the file')
+    parser.add_argument('--dgprep', default=default,
+                        help='dGprep script to be benchmarked')
+    args = parser.parse_args()
+
+    dgprep = [sys.executable, args.dgprep]
+
+    cases = [('--help', dgprep + ['--help'], None),
+             ('defaults', dgprep, None)]
+
+    if args.infile:
+        infile = os.path.abspath(args.infile)
+        cases.append( ('no-op restart', dgprep + [infile],
+                       os.path.dirname(infile) ) )
+
+    loaded = subp.check_output([sys.executable, '-c', IMPORT_CHECK]).strip()
+    print('Modules loaded on import: %s' % (loaded or 'none') )
+
+    print('%-16s %10s %10s' % ('case', 'min/s', 'median/s') )
+
+    for name, cmd, cwd in cases:
+        tmin, tmed = timeit(cmd, args.repeat, cwd)
+        print('%-16s %10.3f %10.3f' % (name, tmin, tmed) )
@@ -44,26 +44,24 @@ istring = ('Please cite: HH Loeffler, J Michel, C Woods, '
 
 import os
 import argparse
-import shutil
 import glob
 import copy
 import atexit
-import warnings
-from collections import OrderedDict, namedtuple
+from collections import OrderedDict
 
 import FESetup.prepare as prep
-from FESetup import const, errors, create_logger, logger, DirManager
+from FESetup import const, errors, create_logger, logger
 from FESetup.ui.iniparser import IniParser
 from FESetup.modelconf import ModelConfig
+from FESetup.lazyimport import LazyModule
 
-# FIXME: That's here solely to suppress a warning over a fmcs/Sire double
-# data type registration collision.  Impact limited as much as possible but
-# still potentially dangerous.  Fix actual problem instead!
-with warnings.catch_warnings():
-    warnings.filterwarnings('ignore',
-                            'to-Python converter for.*already registered')
-
-    from FESetup import mutate
+# NOTE: the morph code pulls in Sire, RDKit, OpenBabel and ParmEd, so it is
+#       only imported when the first morph is created
+# FIXME: The warning filter is here solely to suppress a warning over a
+# fmcs/Sire double data type registration collision.  Impact limited as much
+# as possible but still potentially dangerous.  Fix actual problem instead!
+mutate = LazyModule('FESetup.mutate',
+                    'to-Python converter for.*already registered')
 
 
 
@@ -114,6 +112,12 @@ def prelude(opts):
     logger.write('\n%s\n\n%s\n' % (vstring, istring))
     atexit.register(lambda : logger.finalize() )
 
+    # '{np}' in mdengine.prefix/postfix is sized per run
+    from FESetup.prepare.mdengines import mdebase
+
+    mdebase.set_sizing(opts[SECT_DEF]['mdengine.maxprocs'],
+                       opts[SECT_DEF]['mdengine.scaling'])
+
     ff_opts = list(opts[SECT_DEF]['forcefield'])
     lu = len(ff_opts)
     ff_opts[lu:] = deff[lu:]
@@ -141,6 +145,32 @@ def _param_glob(cmds):
     return ''.join(load_cmds)
 
 
+def _afe_types(opts):
+    """
+    Get the free energy types.  Several comma separated types are morphed
+    in a single pass, see Morph.
+
+    :param opts: the options
+    :type opts: IniParser
+    :returns: list of free energy types
+    """
+
+    return [t.strip() for t in opts[SECT_DEF]['AFE.type'].split(LIST_SEP)]
+
+
+def _make_workdir(workdir):
+    """
+    Create the working directory of a molecule if it does not exist yet.
+
+    :param workdir: the working directory
+    :type workdir: str
+    """
+
+    if not os.access(workdir, os.F_OK):
+        logger.write('Creating directory %s' % workdir)
+        os.makedirs(workdir)
+
+
 def _minmd_done(dico):
     for key in dico:
         if '.nsteps' in key and dico[key]:
@@ -209,7 +239,8 @@ def save_model(model, mol, filename, dest_dir):
     :param mol: Common
     :param filename: name of file to be saved to
     :type filename: string
-    :param dest_dir: name of destination directory
+    :param dest_dir: name of destination directory relative to the working
+                     directory of the molecule
     :type dest_dir: string
     """
 
@@ -234,24 +265,158 @@ def save_model(model, mol, filename, dest_dir):
         model['box.dimensions'] = box_dims
         model['box.format'] = 'bla'  # FIXME: boxlengths-angle
 
-    if mol.ssbond_file and os.path.isfile(mol.ssbond_file):
+    if mol.ssbond_file and os.path.isfile(os.path.join(mol.workdir,
+                                                       mol.ssbond_file) ):
         model['top.ssbond_file'] = mol.ssbond_file
         model.add_file(mol.ssbond_file)
 
+    # MolHandle rebuilds the molecule from its attributes, so these must
+    # agree with the model
+    if 'crd.original' in model:
+        mol.orig_file = model['crd.original']
+
     # the final blessing
     model['is.valid'] = 1
 
-    model.write(filename)
+    model.write(os.path.join(mol.workdir, dest_dir, filename), mol.workdir)
+
+
+def _from_model(mol, model):
+    """
+    Set charge, file names and box of a molecule from its model.
+
+    :param mol: the 'molecule' class
+    :type mol: Common
+    :param model: the model of the molecule
+    :type model: ModelConfig
+    """
+
+    mol.charge = float(model['charge.total'])
+    mol.amber_top = model['top.filename']
+    mol.amber_crd = model['crd.filename']
+
+    if 'crd.original' in model:
+        mol.orig_file = model['crd.original']
+
+    if 'top.ssbond_file' in model:
+        mol.ssbond_file = model['top.ssbond_file']
+
+    if 'box.dimensions' in model:
+        mol.box_dims = [float(b) for b in
+                        model['box.dimensions'].strip('[]').split(',')]
+
+
+def _ligand_from_model(ligand, model):
+    """
+    Set the data of a ligand from its model.
+
+    :param ligand: the ligand
+    :type ligand: Ligand
+    :param model: the model of the ligand
+    :type model: ModelConfig
+    """
+
+    _from_model(ligand, model)
+
+    ligand.gaff = model['forcefield']
+    ligand.mol_file = ligand.orig_file
+    ligand.mol_fmt ='mol2'
+
+    # this file will not be created when skip_param = True
+    try:
+        ligand.frcmod = model['frcmod']
+    except KeyError:
+        pass
+
+
+# molecule data kept by a MolHandle, the same as stored in the model
+_HANDLE_DATA = ('charge', 'amber_top', 'amber_crd', 'box_dims', 'ssbond_file',
+                'orig_file', 'frcmod', 'gaff')
+
+
+class MolHandle(object):
+    """
+    Compact handle of a prepared ligand, protein or complex holding only
+    names, paths, the charge and the box.  The full object is rebuilt from
+    these on demand so that the molecule objects of large campaigns are not
+    all kept in memory.  The model file is not read again.
+    """
+
+    __slots__ = ('kind', 'mol_name', 'parts', 'workdir', 'model_path',
+                 'leapcmd') + _HANDLE_DATA
+
+    def __init__(self, kind, mol, workdir, leapcmd, parts=()):
+        """
+        :param kind: 'ligand', 'protein' or 'complex'
+        :type kind: str
+        :param mol: the prepared molecule, its model must have been saved
+        :type mol: Common
+        :param workdir: absolute path to the working directory of the molecule
+        :type workdir: str
+        :param leapcmd: leap commands needed to load the molecule
+        :type leapcmd: str
+        :param parts: names of protein and ligand of a complex
+        :type parts: tuple of str
+        :raises: SetupError
+        """
+
+        self.kind = kind
+        self.mol_name = mol.mol_name
+        self.parts = parts
+        self.workdir = workdir
+        self.leapcmd = leapcmd
+
+        # attributes not defined for this kind of molecule are None
+        for name in _HANDLE_DATA:
+            setattr(self, name, getattr(mol, name, None) )
+
+        self.box_dims = list(self.box_dims or [])
+
+        self.model_path = _search_for_model(
+            ['solv_' + mol.mol_name + const.MODEL_EXT,
+             mol.mol_name + const.MODEL_EXT], os.path.dirname(workdir) )
+
+        if not self.model_path:
+            raise errors.SetupError('no model file for %s' % mol.mol_name)
+
+
+    def load(self, ff):
+        """
+        Rebuild the molecule from the data of the handle.  The model data
+        have already been extracted into the working directory.
+
+        :param ff: the ForceField class
+        :type ff: ForceField
+        :raises: SetupError
+        :returns: the molecule
+        """
+
+        if self.kind == 'ligand':
+            mol = ff.Ligand(self.mol_name)
+        elif self.kind == 'protein':
+            mol = ff.Protein(self.mol_name)
+        else:
+            mol = ff.Complex(*self.parts)
+
+        for name in _HANDLE_DATA:
+            value = getattr(self, name)
+
+            if value is not None:
+                setattr(mol, name, value)
+
+        mol.box_dims = list(self.box_dims)
 
-    mname = os.path.join(dest_dir, filename)
+        # as in _ligand_from_model()
+        if self.kind == 'ligand':
+            mol.mol_file = mol.orig_file
+            mol.mol_fmt = 'mol2'
 
-    if os.access(mname, os.F_OK):
-        os.remove(mname)
+        mol.workdir = self.workdir
 
-    shutil.move(filename, dest_dir)
+        return mol
 
 
-def make_ligand(name, ff, opts):
+def make_ligand(name, ff, opts, batch=None):
     """
     Prepare ligands for simulation: charge parameters, vacuum top/crd,
     confomer search + alignment (both optional), optionally hydrated
@@ -264,6 +429,10 @@ def make_ligand(name, ff, opts):
     :type ff: ForceField
     :param opts: the name of the ligandx
     :type opts: IniParser
+    :param batch: if given, MD stages are only queued in the batch and the
+                  solvated model must be saved with finish_ligand() after
+                  the batch has been run
+    :type batch: GroupBatch
     """
 
     logger.write('*** Working on %s ***\n' % name)
@@ -295,36 +464,16 @@ def make_ligand(name, ff, opts):
             model.extract(direc = workdir)
 
             ligand = ff.Ligand(name)
+            ligand.workdir = workdir
 
-            # invoke context manager to preset directory for absolute file
-            # creation below
-            with DirManager(workdir):
-                logger.write('Found model %s, extracting data' % name)
-
-                ligand.charge = float(model['charge.total'])
-                ligand.gaff = model['forcefield']
-                ligand.amber_top = model['top.filename']
-                ligand.amber_crd = model['crd.filename']
-                ligand.orig_file = model['crd.original']
-                ligand.mol_file = ligand.orig_file
-                ligand.mol_fmt ='mol2'
-
-                # this file will not be created when skip_param = True
-                try:
-                    ligand.frcmod = model['frcmod']
-                except KeyError:
-                    pass
+            logger.write('Found model %s, extracting data' % name)
 
-                if 'box.dimensions' in model:
-                    ligand.box_dims = [float(b) for b in
-                                       model['box.dimensions'].strip('[]')\
-                                       .split(',')]
+            _ligand_from_model(ligand, model)
 
-                if lig['morph.absolute'] and \
-                       opts[SECT_DEF]['AFE.type'] == 'Sire':
-                    logger.write('Creating input files for absolute '
-                                 'transformations with Sire')
-                    ligand.create_absolute_Sire()
+            if lig['morph.absolute'] and 'Sire' in _afe_types(opts):
+                logger.write('Creating input files for absolute '
+                             'transformations with Sire')
+                ligand.create_absolute_Sire()
 
             if os.path.basename(model_path) == vac_model_filename:
                 from_scratch = False
@@ -344,9 +493,10 @@ def make_ligand(name, ff, opts):
     if from_scratch:
         model = ModelConfig(name)
         ligand = ff.Ligand(name, lig['file.name'], fmt)
+        ligand.workdir = workdir
 
     # this file will not be created when skip_param = True
-    if os.path.isfile(ligand.frcmod):
+    if os.path.isfile(os.path.join(workdir, ligand.frcmod) ):
         model['frcmod'] = ligand.frcmod
         model.add_file(ligand.frcmod)
 
@@ -355,150 +505,179 @@ def make_ligand(name, ff, opts):
     else:
         src = os.path.join(os.getcwd(), lig['basedir'], name)
 
-    with DirManager(workdir):
-        if from_scratch:
-            ligand.copy_files((src,), None, opts[SECT_DEF]['overwrite'])
-
-            if not os.access(lig['file.name'], os.F_OK):
-                raise errors.SetupError('start file %s does not exist in %s' %
-                                        (lig['file.name'], os.getcwd() ) )
-
-            if lig['skip_param']:
-                if fmt != 'pdb' and fmt != 'mol2':
-                    raise dGprepError('When parameterisation is skipped, the input '
-                                      'format must be PDB or MOL2')
-
-                ligand.prepare('', lig['add_hydrogens'], lig['calc_charge'],
-                               lig['correct_for_pH'], lig['pH'])
-            elif not os.access(os.path.join(workdir, const.GAFF_MOL2_FILE),
-                               os.F_OK):
-                # IMPORTANT: do not allow OpenBabel to add Hs, it may mess up
-                # everything
-                ligand.prepare('mol2', lig['add_hydrogens'], lig['calc_charge'],
-                               lig['correct_for_pH'], lig['pH'])
-                ligand.param(lig['gb_charges'])
-            else: # FIXME: ugly
-                ligand.prepare('', lig['add_hydrogens'], lig['calc_charge'],
-                               lig['correct_for_pH'], lig['pH'])
-                ligand.mol_file = const.GAFF_MOL2_FILE
-                ligand.mol_fmt = 'mol2'
-
-            ligand.prepare_top()
-            ligand.create_top(boxtype='', addcmd=load_cmds,
-                              write_dlf=lig['write_dlf'])
-
-            # this file will not be created when skip_param = True
-            if os.path.isfile(const.LIGAND_AC_FILE):
-                model['charge.filename'] = const.LIGAND_AC_FILE
-                model.add_file(const.LIGAND_AC_FILE)
-
-            model['charge.total'] = ligand.charge
-            model['charge.filetype'] = 'ac'
-            model['charge.method'] = 'AM1-BCC'
-            model['forcefield'] = ligand.gaff
-            model['molecule.type'] = 'ligand'
-
-            model.add_file(ligand.mol_file)
-            model['crd.original'] = ligand.mol_file
-
-            save_model(model, ligand, vac_model_filename, '..')
-
-            if opts[SECT_DEF]['MC_prep']:
-                ligand.flex()
-
-            nconf = lig['conf_search.numconf']
-
-            if lig['morph.absolute'] and opts[SECT_DEF]['AFE.type'] == 'Sire':
-                ligand.create_absolute_Sire()
+    _make_workdir(workdir)
+
+    if from_scratch:
+        ligand.copy_files((src,), None, opts[SECT_DEF]['overwrite'])
+
+        if not os.access(os.path.join(workdir, lig['file.name']), os.F_OK):
+            raise errors.SetupError('start file %s does not exist in %s' %
+                                    (lig['file.name'], workdir) )
+
+        if lig['skip_param']:
+            if fmt != 'pdb' and fmt != 'mol2':
+                raise dGprepError('When parameterisation is skipped, the input '
+                                  'format must be PDB or MOL2')
+
+            ligand.prepare('', lig['add_hydrogens'], lig['calc_charge'],
+                           lig['correct_for_pH'], lig['pH'])
+        elif not os.access(os.path.join(workdir, const.GAFF_MOL2_FILE),
+                           os.F_OK):
+            # IMPORTANT: do not allow OpenBabel to add Hs, it may mess up
+            # everything
+            ligand.prepare('mol2', lig['add_hydrogens'], lig['calc_charge'],
+                           lig['correct_for_pH'], lig['pH'])
+            ligand.param(lig['gb_charges'],
+                         sqm_parallel = lig['sqm.parallel'])
+        else: # FIXME: ugly
+            ligand.prepare('', lig['add_hydrogens'], lig['calc_charge'],
+                           lig['correct_for_pH'], lig['pH'])
+            ligand.mol_file = const.GAFF_MOL2_FILE
+            ligand.mol_fmt = 'mol2'
+
+        ligand.prepare_top()
+        ligand.create_top(boxtype='', addcmd=load_cmds,
+                          write_dlf=lig['write_dlf'])
+
+        # this file will not be created when skip_param = True
+        if os.path.isfile(os.path.join(workdir, const.LIGAND_AC_FILE) ):
+            model['charge.filename'] = const.LIGAND_AC_FILE
+            model.add_file(const.LIGAND_AC_FILE)
+
+        model['charge.total'] = ligand.charge
+        model['charge.filetype'] = 'ac'
+        model['charge.method'] = 'AM1-BCC'
+        model['forcefield'] = ligand.gaff
+        model['molecule.type'] = 'ligand'
+
+        model.add_file(ligand.mol_file)
+        model['crd.original'] = ligand.mol_file
+
+        save_model(model, ligand, vac_model_filename, '..')
+
+        if opts[SECT_DEF]['MC_prep']:
+            ligand.flex()
+
+        nconf = lig['conf_search.numconf']
+
+        if lig['morph.absolute'] and 'Sire' in _afe_types(opts):
+            ligand.create_absolute_Sire()
+
+        if nconf > 0:
+            ligand.conf_search(numconf = nconf,
+                               geomsteps = lig['conf_search.geomsteps'],
+                               steep_steps = lig['conf_search.steep_steps'],
+                               steep_econv = lig['conf_search.steep_econv'],
+                               conj_steps = lig['conf_search.conj_steps'],
+                               conj_econv = lig['conf_search.conj_econv'],
+                               ffield = lig['conf_search.ffield'])
+            ligand.align()
+
+    # FIXME: also check for boxlength and neutralize
+    if lig['box.type']:
+        ligand.prepare_top()
+        ligand.create_top(boxtype = lig['box.type'],
+                          boxlength = lig['box.length'],
+                          neutralize = lig['neutralize'],
+                          addcmd = load_cmds, remove_first = False)
+
+        if lig['ions.conc'] > 0.0:
+            ligand.add_ions(lig['ions.conc'], lig['ions.dens'])
+
+        restr_force = lig['min.restr_force']
+        nsteps = lig['min.nsteps']
+
+        ligand.setup_MDEngine(opts[SECT_DEF]['mdengine'][1],
+                              opts[SECT_DEF]['mdengine.prefix'],
+                              opts[SECT_DEF]['mdengine.postfix'])
+
+        # NAMD runs all stages in as few invocations as possible
+        if opts[SECT_DEF]['mdengine'][0] == 'namd':
+            ligand.mdengine.chain = True
+
+        if batch:
+            batch.attach(ligand.mdengine, workdir)
+
+        if nsteps > 0:
+            do_min(ligand, lig)
+
+        press_done = False
+        nsteps = lig['md.heat.nsteps']
+
+        if nsteps > 0:
+            restr_force = lig['md.heat.restr_force']
+            do_md(ligand, lig, 'heat')
+
+        nsteps = lig['md.constT.nsteps']
+
+        if nsteps > 0:
+            restr_force = lig['md.constT.restr_force']
+            do_md(ligand, lig, 'constT')
+
+        nsteps = lig['md.press.nsteps']
+
+        if nsteps > 0:
+            restr_force = lig['md.press.restr_force']
+            do_md(ligand, lig, 'press')
+            press_done = True
+
+        nrestr = lig['md.relax.nrestr']
+
+        if nrestr > 0:
+            # NAMD and AMBER run the whole restraint ramp in one go
+            if opts[SECT_DEF]['mdengine'][0] in ('namd', 'amber'):
+                ligand.md('%RELRES', lig['md.relax.nsteps'],
+                          lig['md.relax.T'], lig['md.relax.p'],
+                          lig['md.relax.restraint'], restr_force,
+                          nrestr, wrap = True)
+            else:
+                sp = restr_force / (nrestr - 1)
+
+                for k in range(nrestr - 2, -1, -1):
+                    if press_done:
+                        nmlist = '%PRESS'
+                    else:
+                        nmlist = '%CONSTT'
 
-            if nconf > 0:
-                ligand.conf_search(numconf = nconf,
-                                   geomsteps = lig['conf_search.geomsteps'],
-                                   steep_steps = lig['conf_search.steep_steps'],
-                                   steep_econv = lig['conf_search.steep_econv'],
-                                   conj_steps = lig['conf_search.conj_steps'],
-                                   conj_econv = lig['conf_search.conj_econv'],
-                                   ffield = lig['conf_search.ffield'])
-                ligand.align()
-
-        # FIXME: also check for boxlength and neutralize
-        if lig['box.type']:
-            ligand.prepare_top()
-            ligand.create_top(boxtype = lig['box.type'],
-                              boxlength = lig['box.length'],
-                              neutralize = lig['neutralize'],
-                              addcmd = load_cmds, remove_first = False)
-
-            if lig['ions.conc'] > 0.0:
-                ligand.create_top(boxtype = lig['box.type'],
-                                  boxlength = lig['box.length'],
-                                  neutralize = 2,
-                                  addcmd = load_cmds, remove_first = False,
-                                  conc = lig['ions.conc'],
-                                  dens = lig['ions.dens'])
-
-            restr_force = lig['min.restr_force']
-            nsteps = lig['min.nsteps']
-
-            ligand.setup_MDEngine(opts[SECT_DEF]['mdengine'][1],
-                                  opts[SECT_DEF]['mdengine.prefix'],
-                                  opts[SECT_DEF]['mdengine.postfix'])
-
-            if nsteps > 0:
-                do_min(ligand, lig)
-
-            press_done = False
-            nsteps = lig['md.heat.nsteps']
-
-            if nsteps > 0:
-                restr_force = lig['md.heat.restr_force']
-                do_md(ligand, lig, 'heat')
-
-            nsteps = lig['md.constT.nsteps']
-
-            if nsteps > 0:
-                restr_force = lig['md.constT.restr_force']
-                do_md(ligand, lig, 'constT')
-
-            nsteps = lig['md.press.nsteps']
-
-            if nsteps > 0:
-                restr_force = lig['md.press.restr_force']
-                do_md(ligand, lig, 'press')
-                press_done = True
-
-            nrestr = lig['md.relax.nrestr']
-
-            if nrestr > 0:
-                # FIXME: unify with AMBER mdengine
-                if opts[SECT_DEF]['mdengine'][0] == 'namd':
-                    ligand.md('%RELRES', lig['md.relax.nsteps'],
+                    ligand.md(nmlist, lig['md.relax.nsteps'],
                               lig['md.relax.T'], lig['md.relax.p'],
-                              lig['md.relax.restraint'], restr_force,
-                              nrestr, wrap = True)
-                else:
-                    sp = restr_force / (nrestr - 1)
-
-                    for k in range(nrestr - 2, -1, -1):
-                        if press_done:
-                            nmlist = '%PRESS'
-                        else:
-                            nmlist = '%CONSTT'
+                              lig['md.relax.restraint'], sp * k,
+                              wrap = True)
+
+        if batch:
+            batch.add(ligand.mdengine)
+            ligand.model = model
 
-                        ligand.md(nmlist, lig['md.relax.nsteps'],
-                                  lig['md.relax.T'], lig['md.relax.p'],
-                                  lig['md.relax.restraint'], sp * k,
-                                  wrap = True)
+            return ligand, load_cmds
 
-            if opts[SECT_DEF]['mdengine'][0] != 'amber':
-                if _minmd_done(lig):
-                   ligand.to_rst7()
+        # native or NetCDF restarts are converted only once at the end
+        if _minmd_done(lig):
+            ligand.to_rst7()
 
-            save_model(model, ligand, sol_model_filename, '..')
+        save_model(model, ligand, sol_model_filename, '..')
 
     return ligand, load_cmds
 
 
+def finish_ligand(ligand, opts):
+    """
+    Save the solvated model of a ligand whose MD stages were run in a batch.
+
+    :param ligand: the ligand
+    :type ligand: Ligand
+    :param opts: the name of the ligandx
+    :type opts: IniParser
+    """
+
+    if _minmd_done(opts[SECT_LIG]):
+        ligand.to_rst7()
+
+    save_model(ligand.model, ligand, 'solv_' + ligand.mol_name +
+               const.MODEL_EXT, '..')
+
+    del ligand.model
+
+
 def make_protein(name, ff, opts):
     """
     Prepare proteins for simulation.
@@ -533,17 +712,8 @@ def make_protein(name, ff, opts):
             model.extract(direc = workdir)
 
             protein = ff.Protein(name, prot['basedir'])
-
-            protein.charge = float(model['charge.total'])
-            protein.amber_top = model['top.filename']
-            protein.amber_crd = model['crd.filename']
-            protein.orig_file = model['crd.original']
-
-            if 'top.ssbond_file' in model:
-                protein.ssbond_file = model['top.ssbond_file']
-
-            if 'box.dimensions' in model:
-                protein.box_dims = model['box.dimensions']
+            protein.workdir = workdir
+            _from_model(protein, model)
 
             if os.path.basename(model_path) == vac_model_filename:
                 from_scratch = False
@@ -563,106 +733,106 @@ def make_protein(name, ff, opts):
     if from_scratch:
         model = ModelConfig(name)
         protein = ff.Protein(name, prot['file.name'])
+        protein.workdir = workdir
         model['crd.original'] = protein.mol_file
         model.add_file(protein.mol_file)
 
-    with DirManager(workdir):
-        if from_scratch:
-            protein.copy_files((src,), None, opts[SECT_DEF]['overwrite'])
+    _make_workdir(workdir)
 
-            if prot['propka']:
-                protein.protonate_propka(pH = prot['propka.pH'])
+    if from_scratch:
+        protein.copy_files((src,), None, opts[SECT_DEF]['overwrite'])
 
-            protein.get_charge()    # must be done explicitly
-            protein.prepare_top()
-            protein.create_top(boxtype = '')
+        if prot['propka']:
+            protein.protonate_propka(pH = prot['propka.pH'])
 
-            model['charge.total'] = protein.charge
-            model['forcefield'] = 'AMBER'    # FIXME
-            model['molecule.type'] = 'biomolecule'
+        protein.get_charge()    # must be done explicitly
+        protein.prepare_top()
+        protein.create_top(boxtype = '')
 
-            save_model(model, protein, vac_model_filename, '..')
+        model['charge.total'] = protein.charge
+        model['forcefield'] = 'AMBER'    # FIXME
+        model['molecule.type'] = 'biomolecule'
 
-        # FIXME: also check for boxlength and neutralize
+        save_model(model, protein, vac_model_filename, '..')
 
-        if prot['box.type']:
-            protein.prepare_top()
-            protein.create_top(boxtype = prot['box.type'],
-                               boxlength = prot['box.length'],
-                               neutralize = prot['neutralize'],
-                               align = prot['align_axes'],
-                               addcmd = load_cmds, remove_first = True)
+    # FIXME: also check for boxlength and neutralize
 
-            if prot['ions.conc'] > 0.0:
-                protein.create_top(boxtype = prot['box.type'],
-                                   boxlength = prot['box.length'],
-                                   neutralize = 2,
-                                   align = prot['align_axes'],
-                                   addcmd = load_cmds, remove_first = False,
-                                   conc = prot['ions.conc'],
-                                   dens = prot['ions.dens'])
+    if prot['box.type']:
+        protein.prepare_top()
+        protein.create_top(boxtype = prot['box.type'],
+                           boxlength = prot['box.length'],
+                           neutralize = prot['neutralize'],
+                           align = prot['align_axes'],
+                           addcmd = load_cmds, remove_first = True)
 
-            restr_force = prot['min.restr_force']
-            nsteps = prot['min.nsteps']
+        if prot['ions.conc'] > 0.0:
+            protein.add_ions(prot['ions.conc'], prot['ions.dens'])
 
-            protein.setup_MDEngine(opts[SECT_DEF]['mdengine'][1],
-                                   opts[SECT_DEF]['mdengine.prefix'],
-                                   opts[SECT_DEF]['mdengine.postfix'])
+        restr_force = prot['min.restr_force']
+        nsteps = prot['min.nsteps']
 
-            if nsteps > 0:
-                do_min(protein, prot)
+        protein.setup_MDEngine(opts[SECT_DEF]['mdengine'][1],
+                               opts[SECT_DEF]['mdengine.prefix'],
+                               opts[SECT_DEF]['mdengine.postfix'])
 
-            press_done = False
+        # NAMD runs all stages in as few invocations as possible
+        if opts[SECT_DEF]['mdengine'][0] == 'namd':
+            protein.mdengine.chain = True
 
-            #protein.md('%SHRINK', 200, 5.0, 1.0, ':LIG', 5.0, wrap = True)
+        if nsteps > 0:
+            do_min(protein, prot)
 
-            nsteps = prot['md.heat.nsteps']
+        press_done = False
 
-            if nsteps > 0:
-                restr_force = prot['md.heat.restr_force']
-                do_md(protein, prot, 'heat')
+        #protein.md('%SHRINK', 200, 5.0, 1.0, ':LIG', 5.0, wrap = True)
 
-            nsteps = prot['md.constT.nsteps']
+        nsteps = prot['md.heat.nsteps']
 
-            if nsteps > 0:
-                restr_force = prot['md.constT.restr_force']
-                do_md(protein, prot, 'constT')
+        if nsteps > 0:
+            restr_force = prot['md.heat.restr_force']
+            do_md(protein, prot, 'heat')
 
-            nsteps = prot['md.press.nsteps']
+        nsteps = prot['md.constT.nsteps']
 
-            if nsteps > 0:
-                restr_force = prot['md.press.restr_force']
-                do_md(protein, prot, 'press')
-                press_done = True
+        if nsteps > 0:
+            restr_force = prot['md.constT.restr_force']
+            do_md(protein, prot, 'constT')
 
-            nrestr = prot['md.relax.nrestr']
+        nsteps = prot['md.press.nsteps']
 
-            if nrestr > 0:
-                if opts[SECT_DEF]['mdengine'][0] == 'namd':
-                    protein.md('%RELRES', prot['md.relax.nsteps'],
-                               prot['md.relax.T'], prot['md.relax.p'],
-                               prot['md.relax.restraint'], restr_force,
-                               nrestr, wrap = True)
-                else:
-                    sp = restr_force / (nrestr - 1)
+        if nsteps > 0:
+            restr_force = prot['md.press.restr_force']
+            do_md(protein, prot, 'press')
+            press_done = True
 
-                    for k in range(nrestr - 2, -1, -1):
-                        if press_done:
-                            nmlist = '%PRESS'
-                        else:
-                            nmlist = '%CONSTT'
+        nrestr = prot['md.relax.nrestr']
 
-                        protein.md(nmlist, prot['md.relax.nsteps'],
-                                   prot['md.relax.T'],
-                                   prot['md.relax.p'],
-                                   prot['md.relax.restraint'], sp * k,
-                                   wrap = True)
+        if nrestr > 0:
+            if opts[SECT_DEF]['mdengine'][0] in ('namd', 'amber'):
+                protein.md('%RELRES', prot['md.relax.nsteps'],
+                           prot['md.relax.T'], prot['md.relax.p'],
+                           prot['md.relax.restraint'], restr_force,
+                           nrestr, wrap = True)
+            else:
+                sp = restr_force / (nrestr - 1)
 
-            if opts[SECT_DEF]['mdengine'][0] != 'amber':
-                if _minmd_done(prot):
-                   protein.to_rst7()
+                for k in range(nrestr - 2, -1, -1):
+                    if press_done:
+                        nmlist = '%PRESS'
+                    else:
+                        nmlist = '%CONSTT'
 
-            save_model(model, protein, sol_model_filename, '..')
+                    protein.md(nmlist, prot['md.relax.nsteps'],
+                               prot['md.relax.T'],
+                               prot['md.relax.p'],
+                               prot['md.relax.restraint'], sp * k,
+                               wrap = True)
+
+        # native or NetCDF restarts are converted only once at the end
+        if _minmd_done(prot):
+            protein.to_rst7()
+
+        save_model(model, protein, sol_model_filename, '..')
 
     return protein, load_cmds
 
@@ -692,16 +862,8 @@ def make_complex(prot, lig, ff, opts, load_cmds):
             model.extract(direc = workdir)
 
             complex = ff.Complex(prot, lig)
-
-            complex.charge = float(model['charge.total'])
-            complex.amber_top = model['top.filename']
-            complex.amber_crd = model['crd.filename']
-
-            if 'top.ssbond_file' in model:
-                complex.ssbond_file = model['top.ssbond_file']
-
-            if 'box.dimensions' in model:
-                complex.box_dims = model['box.dimensions']
+            complex.workdir = workdir
+            _from_model(complex, model)
 
             if os.path.basename(model_path) == vac_model_filename:
                 from_scratch = False
@@ -715,30 +877,40 @@ def make_complex(prot, lig, ff, opts, load_cmds):
 
     if not model_path:
         complex = ff.Complex(prot, lig)
+        complex.workdir = workdir
 
     lig_src = os.path.join(os.getcwd(), const.LIGAND_WORKDIR, lig.mol_name)
     prot_src = os.path.join(os.getcwd(), const.PROTEIN_WORKDIR, prot.mol_name)
 
-    with DirManager(workdir):
-        if from_scratch:
-            complex.copy_files((lig_src, prot_src),
-                               (ligand.orig_file, ligand.frcmod, protein.orig_file,
-                                const.LIGAND_AC_FILE, const.SSBOND_FILE),
-                               opts[SECT_DEF]['overwrite'])
-
-            complex.ligand_fmt = lig.mol_fmt
-            complex.prepare_top(gaff=options[SECT_DEF]['gaff'])
-            complex.create_top(boxtype='', addcmd=load_cmds)
-
-            model['name'] = complex.complex_name
-            model['charge.total'] = complex.charge
-            model['forcefield'] = 'AMBER'   # FIXME
-            model['molecule.type'] = 'complex'  # FIXME
-
-            save_model(model, complex, vac_model_filename, '..')
+    _make_workdir(workdir)
 
-        # FIXME: also check for boxlength and neutralize
-        if com['box.type']:
+    if from_scratch:
+        complex.copy_files((lig_src, prot_src),
+                           (lig.orig_file, lig.frcmod, prot.orig_file,
+                            const.LIGAND_AC_FILE, const.SSBOND_FILE),
+                           opts[SECT_DEF]['overwrite'])
+
+        complex.ligand_fmt = lig.mol_fmt
+        complex.prepare_top(gaff=options[SECT_DEF]['gaff'])
+        complex.create_top(boxtype='', addcmd=load_cmds)
+
+        model['name'] = complex.complex_name
+        model['charge.total'] = complex.charge
+        model['forcefield'] = 'AMBER'   # FIXME
+        model['molecule.type'] = 'complex'  # FIXME
+
+        save_model(model, complex, vac_model_filename, '..')
+
+    # FIXME: also check for boxlength and neutralize
+    if com['box.type']:
+        if com['box.presolvated']:
+            # the equilibrated protein box is shared by the whole series
+            complex.create_top_presolvated(
+                os.path.join(prot_src, prot.amber_top),
+                os.path.join(prot_src, prot.amber_crd),
+                com['box.presolvated.cutoff'], com['ions.conc'],
+                com['ions.dens'])
+        else:
             complex.prepare_top(gaff=options[SECT_DEF]['gaff'])
             complex.create_top(boxtype=com['box.type'],
                                boxlength=com['box.length'],
@@ -747,82 +919,269 @@ def make_complex(prot, lig, ff, opts, load_cmds):
                                addcmd=load_cmds, remove_first = True)
 
             if com['ions.conc'] > 0.0:
-                complex.create_top(boxtype=com['box.type'],
-                                   boxlength=com['box.length'],
-                                   neutralize=2,
-                                   align=com['align_axes'],
-                                   addcmd=load_cmds, remove_first=False,
-                                   conc=com['ions.conc'],
-                                   dens=com['ions.dens'])
+                complex.add_ions(com['ions.conc'], com['ions.dens'])
 
-            restr_force = com['min.restr_force']
-            nsteps = com['min.nsteps']
+        restr_force = com['min.restr_force']
+        nsteps = com['min.nsteps']
 
-            complex.setup_MDEngine(opts[SECT_DEF]['mdengine'][1],
-                                   opts[SECT_DEF]['mdengine.prefix'],
-                                   opts[SECT_DEF]['mdengine.postfix'])
+        complex.setup_MDEngine(opts[SECT_DEF]['mdengine'][1],
+                               opts[SECT_DEF]['mdengine.prefix'],
+                               opts[SECT_DEF]['mdengine.postfix'])
 
-            if nsteps > 0:
-                do_min(complex, com)
+        # NAMD runs all stages in as few invocations as possible
+        if opts[SECT_DEF]['mdengine'][0] == 'namd':
+            complex.mdengine.chain = True
 
-            if opts[SECT_DEF]['MC_prep']:
-                complex.prot_flex()
-                complex.flatten_rings()
+        if nsteps > 0:
+            do_min(complex, com)
 
-            press_done = False
+        if opts[SECT_DEF]['MC_prep']:
+            complex.prot_flex()
+            complex.flatten_rings()
 
-            #complex.md('%SHRINK', 200, 5.0, 1.0, 'bb_lig', 5.0, wrap = True)
+        press_done = False
 
-            nsteps = com['md.heat.nsteps']
+        #complex.md('%SHRINK', 200, 5.0, 1.0, 'bb_lig', 5.0, wrap = True)
 
-            if nsteps > 0:
-                restr_force = com['md.heat.restr_force']
-                do_md(complex, com, 'heat')
+        nsteps = com['md.heat.nsteps']
 
-            nsteps = com['md.constT.nsteps']
+        if nsteps > 0:
+            restr_force = com['md.heat.restr_force']
+            do_md(complex, com, 'heat')
 
-            if nsteps > 0:
-                restr_force = com['md.constT.restr_force']
-                do_md(complex, com, 'constT')
+        nsteps = com['md.constT.nsteps']
 
-            nsteps = com['md.press.nsteps']
+        if nsteps > 0:
+            restr_force = com['md.constT.restr_force']
+            do_md(complex, com, 'constT')
 
-            if nsteps > 0:
-                restr_force = com['md.press.restr_force']
-                do_md(complex, com, 'press')
-                press_done = True
+        nsteps = com['md.press.nsteps']
 
-            nrestr = com['md.relax.nrestr']
+        if nsteps > 0:
+            restr_force = com['md.press.restr_force']
+            do_md(complex, com, 'press')
+            press_done = True
 
-            if nrestr > 0:
-                if opts[SECT_DEF]['mdengine'][0] == 'namd':
-                    complex.md('%RELRES', com['md.relax.nsteps'],
-                               com['md.relax.T'], com['md.relax.p'],
-                               com['md.relax.restraint'], restr_force,
-                               nrestr, wrap = True)
-                else:
-                    sp = restr_force / (nrestr - 1)
-
-                    for k in range(nrestr - 2, -1, -1):
-                        if press_done:
-                            nmlist = '%PRESS'
-                        else:
-                            nmlist = '%CONSTT'
+        nrestr = com['md.relax.nrestr']
+
+        if nrestr > 0:
+            if opts[SECT_DEF]['mdengine'][0] in ('namd', 'amber'):
+                complex.md('%RELRES', com['md.relax.nsteps'],
+                           com['md.relax.T'], com['md.relax.p'],
+                           com['md.relax.restraint'], restr_force,
+                           nrestr, wrap = True)
+            else:
+                sp = restr_force / (nrestr - 1)
 
-                        complex.md(nmlist, com['md.relax.nsteps'],
-                                   com['md.relax.T'], com['md.relax.p'],
-                                   com['md.relax.restraint'], sp * k,
-                                   wrap = True)
+                for k in range(nrestr - 2, -1, -1):
+                    if press_done:
+                        nmlist = '%PRESS'
+                    else:
+                        nmlist = '%CONSTT'
 
-            if opts[SECT_DEF]['mdengine'][0] != 'amber':
-                if _minmd_done(com):
-                    complex.to_rst7()
+                    complex.md(nmlist, com['md.relax.nsteps'],
+                               com['md.relax.T'], com['md.relax.p'],
+                               com['md.relax.restraint'], sp * k,
+                               wrap = True)
 
-            save_model(model, complex, sol_model_filename, '..')
+        # native or NetCDF restarts are converted only once at the end
+        if _minmd_done(com):
+            complex.to_rst7()
+
+        save_model(model, complex, sol_model_filename, '..')
 
     return complex, load_cmds
 
 
+def _complex_wanted(prot_name, lig_name, pairs):
+    """
+    Check if a complex is requested by the complex pairs.
+
+    :param prot_name: name of the protein
+    :type prot_name: str
+    :param lig_name: name of the ligand
+    :type lig_name: str
+    :param pairs: requested protein/ligand pairs, all complexes if empty
+    :type pairs: list
+    """
+
+    if not pairs:
+        return True
+
+    for pair in pairs:
+        if (pair[0] == prot_name and pair[1] == lig_name) or \
+           (pair[0] == lig_name and pair[1] == prot_name):
+            return True
+
+    return False
+
+
+def build_complexes(lig_name, proteins, ligands, ff, opts, failed):
+    """
+    Build the complexes of a ligand with all proteins.
+
+    :param lig_name: name of the ligand
+    :type lig_name: str
+    :param proteins: handles of the proteins
+    :type proteins: dict
+    :param ligands: handles of the ligands
+    :type ligands: dict
+    :param ff: the ForceField class
+    :type ff: ForceField
+    :param opts: the options
+    :type opts: IniParser
+    :param failed: names of failed complexes, will be extended
+    :type failed: list
+    :returns: handles of the complexes
+    :rtype: list
+    """
+
+    lig = ligands[lig_name]
+    handles = []
+
+    for prot_name, prot in proteins.iteritems():
+        if not _complex_wanted(prot_name, lig_name, opts[SECT_COM]['pairs']):
+            continue
+
+        name = '%s:%s' % (prot_name, lig_name)
+
+        try:
+            complex, cmds = make_complex(prot.load(ff), lig.load(ff), ff, opts,
+                                         lig.leapcmd + prot.leapcmd)
+
+            workdir = os.path.join(os.getcwd(), const.COMPLEX_WORKDIR,
+                                   complex.mol_name)
+            handles.append(MolHandle('complex', complex, workdir, cmds,
+                                     (prot.mol_name, lig.mol_name) ) )
+        except errors.SetupError as why:
+            failed.append(name)
+            print ('ERROR: %s failed: %s' % (name, why))
+
+    return handles
+
+
+def stream_morphs(morph_pairs, morph_maps, ligands, complexes, build, ff,
+                  opts, failed, core=''):
+    """
+    Run each morph through vacuum setup, solvated ligand coordinates and
+    complex coordinates before the next one is started.  The complexes of
+    the initial ligand are only built when first needed.  The morph is
+    released after its last coordinates have been written.  When the reverse
+    pair is listed too its atom mapping is derived from the inverted forward
+    mapping instead of running the MCSS again.
+
+    :param morph_pairs: pairs of ligand names
+    :type morph_pairs: list
+    :param morph_maps: user atom maps per pair
+    :type morph_maps: dict
+    :param ligands: handles of the ligands
+    :type ligands: dict
+    :param complexes: complex handles per ligand name, will be extended
+    :type complexes: dict
+    :param build: builds the complex handles of a ligand name
+    :type build: callable
+    :param ff: the ForceField class
+    :type ff: ForceField
+    :param opts: the options
+    :type opts: IniParser
+    :param failed: names of failed morphs, will be extended
+    :type failed: list
+    :param core: SMARTS of the series core seeding the MCSS
+    :type core: str
+    :returns: generator of name and directory of each successful morph,
+              one directory per free energy type
+    """
+
+    # inverted index maps of finished forward morphs by reverse pair
+    reverse_maps = {}
+    started = set()
+
+    for pair in morph_pairs:
+        started.add(pair)
+
+        try:
+            l1 = ligands[pair[0] ]
+            l2 = ligands[pair[1] ]
+
+            ligand1 = l1.load(ff)
+            ligand2 = l2.load(ff)
+        except (KeyError, errors.SetupError) as why:
+            name = pair[0] + const.MORPH_SEP + pair[1]
+            failed.append(name)
+            print ('ERROR: %s failed: %s' % (name, why))
+            continue
+
+        if pair[0] not in complexes:
+            complexes[pair[0]] = build(pair[0])
+
+        nfailed = len(failed)
+
+        cmd1 = l1.leapcmd
+        cmd2 = l2.leapcmd
+        isotope_map = morph_maps.get( (pair[0], pair[1]), {})
+
+        basedir = os.path.join(os.getcwd(), opts[SECT_LIG]['basedir'])
+        wd1 = l1.workdir
+        wd2 = l2.workdir
+
+        with mutate.Morph(ligand1, ligand2, wd1, wd2, ff,
+                          _afe_types(opts),
+                          opts[SECT_DEF]['AFE.separate_vdw_elec'],
+                          opts[SECT_DEF]['mcs.timeout'],
+                          opts[SECT_DEF]['mcs.match_by'],
+                          opts[SECT_DEF]['gaff'], core,
+                          opts[SECT_DEF]['mcs.portfolio']) as morph:
+
+            print ('Morphing %s to %s...' % pair)
+
+            if (pair[1], pair[0]) in morph_pairs:
+                rev = ligand2
+            else:
+                rev = None
+
+            try:
+                morph.setup(cmd1, cmd2, basedir, isotope_map,
+                            reverse_maps.pop(pair, None) )
+
+                if rev and (pair[1], pair[0]) not in started:
+                    reverse_maps[(pair[1], pair[0])] = \
+                                            morph.reverse_index_map()
+
+                if opts[SECT_LIG]['box.type']:
+                    morph.create_coords(ligand1, 'solvated', wd1,
+                                        cmd1, cmd2, rev, wd2)
+            except errors.SetupError as why:
+                failed.append(morph.name)
+                print ('ERROR: %s failed: %s' % (morph.name, why))
+
+                # no complexes for a morph that could not be set up
+                continue
+
+            for com in complexes[pair[0]]:
+                name = com.mol_name + '/' + morph.name
+
+                print('Creating complex %s with ligand morph %s...' %
+                      (com.mol_name, morph.name) )
+
+                try:
+                    morph.create_coords(com.load(ff), 'complex', com.workdir,
+                                        com.leapcmd, '')
+                except errors.SetupError as why:
+                    failed.append(name)
+                    print ('ERROR: complex %s with ligand morph %s failed: %s'
+                           % (com.mol_name, morph.name, why) )
+
+        name = morph.name
+        dsts = [target[2] for target in morph.targets]
+
+        # all coordinates written, release the morph and its Sire molecules
+        del morph, ligand1, ligand2, rev
+
+        if len(failed) == nfailed:
+            for dst in dsts:
+                yield name, dst
+
+
 def do_min(what, opts):
     #FIXME: unify
     if options[SECT_DEF]['mdengine'][0] == 'amber':
@@ -852,6 +1211,8 @@ defaults[SECT_DEF] = {
     'mdengine': (['amber', 'sander'], ('list', LIST_SEP) ),
     'mdengine.prefix': ('', None),
     'mdengine.postfix': ('', None),
+    'mdengine.maxprocs': (0, (int, ) ),
+    'mdengine.scaling': ('', None),
     'parmchk_version': (2, (int, ) ),
     'FE_type': ('', None),
     'AFE.type': ('Sire', None),
@@ -860,6 +1221,8 @@ defaults[SECT_DEF] = {
     'remake': (False, ('bool', ) ),
     'mcs.timeout': (60, (int, ) ),      # int because of FMCS/C++
     'mcs.match_by': ('', None),
+    'mcs.series_core': (False, ('bool', ) ),
+    'mcs.portfolio': (False, ('bool', ) ),
     'overwrite': (False, ('bool', ) ),
     'user_params': (False, ('bool', ) ),
     'MC_prep': (False, ('bool', ) ),
@@ -886,11 +1249,15 @@ defaults[SECT_LIG] = {
     'conf_search.ffield': ('mmff94', None),
     'calc_charge': (False, ('bool', ) ),
     'gb_charges': (False, ('bool', ) ),
+    'sqm.parallel': (1, (int, ) ),
     'add_hydrogens': (False, ('bool', ) ),
     'correct_for_pH': (False, ('bool', ) ),
     'pH': (7.4, (float, ) ),
     'skip_param': (False, ('bool', ) ),
-    'write_dlf': (False, ('bool', ) )
+    'write_dlf': (False, ('bool', ) ),
+    'md.batch': (False, ('bool', ) ),
+    'md.batch.size': (0, (int, ) ),
+    'md.batch.mpirun': ('mpirun -np', None)
     }
 
 defaults[SECT_PROT] = {
@@ -915,6 +1282,8 @@ defaults[SECT_COM] = {
     'ions.conc': (0.0, (float, ) ),
     'ions.dens': (1.0, (float, ) ),
     'align_axes': (False, ('bool', ) ),
+    'box.presolvated': (False, ('bool', ) ),
+    'box.presolvated.cutoff': (2.2, (float, ) ),
     'min.nsteps': (100, (int, ) ),
     'min.ncyc': (10, (int, ) ),
     'min.restraint': ('notsolvent', None),
@@ -996,8 +1365,9 @@ if __name__ == '__main__':
     logger.write('--------\n\nForce field and MD engine:\n%s\n' % ff)
 
 
-    # FIXME: We keep all molecule objects in memory.  For 2000 morph pairs
-    #        this may mean more than 1 GB on a 64 bit machine.
+    # NOTE: only compact handles of the molecules are kept in memory and the
+    #       full objects are rehydrated from their model files when needed.
+    #       Morphs are released as soon as all their coordinates are written.
 
     ### proteins
 
@@ -1007,7 +1377,10 @@ if __name__ == '__main__':
     for prot_name in options[SECT_PROT]['molecules']:
         try:
             protein, cmds = make_protein(prot_name, ff, options)
-            proteins[protein] = cmds
+            workdir = os.path.join(os.getcwd(), const.PROTEIN_WORKDIR,
+                                   protein.mol_name)
+            proteins[protein.mol_name] = MolHandle('protein', protein,
+                                                   workdir, cmds)
         except errors.SetupError as why:
             prot_failed.append(prot_name)
             print ('ERROR: %s failed: %s' % (prot_name, why))
@@ -1016,7 +1389,6 @@ if __name__ == '__main__':
     ### ligands
 
     ligands = {}
-    Ligdata = namedtuple('Ligdata', ['ref', 'leapcmd'])
     lig_failed = []
 
     morph_pairs = copy.deepcopy(options[SECT_LIG]['morph_pairs'])
@@ -1058,155 +1430,117 @@ if __name__ == '__main__':
         uniq = list(OrderedDict( (val, None) for val in mols) )
         molecules = uniq
 
-    for lig_name in molecules:
-        try:
-            ligand, cmds = make_ligand(lig_name, ff, options)
-            ligands[lig_name] = Ligdata(ligand, cmds)
-        except errors.SetupError as why:
-            lig_failed.append(lig_name)
-            print('ERROR: %s failed: %s' % (lig_name, why))
+    batch = None
 
+    # equilibrate many small ligand boxes in multi-sander/pmemd jobs
+    if options[SECT_LIG]['md.batch'] and options[SECT_LIG]['box.type'] and \
+           options[SECT_DEF]['mdengine'][0] == 'amber':
+        from FESetup.prepare.mdengines.amber import GroupBatch
 
-    ### ligand morphs
+        batch = GroupBatch(options[SECT_LIG]['md.batch.size'],
+                           options[SECT_LIG]['md.batch.mpirun'])
 
-    if morph_pairs:
-        print('Morphs will be generated for %s' % options[SECT_DEF]['AFE.type'])
-        logger.write('Morphs will be generated for %s\n' %
-                     options[SECT_DEF]['AFE.type'])
+    # ligands waiting for the batch MD, handles are created afterwards
+    batched = []
 
-    morphs = []
-    morph_failed = []
-
-    for pair in morph_pairs:
+    for lig_name in molecules:
         try:
-            l1 = ligands[pair[0] ]
-            l2 = ligands[pair[1] ]
-        except KeyError as why:
-            name = pair[0] + const.MORPH_SEP + pair[1]
-            morph_failed.append(name)
-            print ('ERROR: %s failed: %s' % (name, why))
-            continue
-
-        ligand1 = l1.ref
-        ligand2 = l2.ref
-
-        cmd1 = l1.leapcmd
-        cmd2 = l2.leapcmd
-
-        isotope_map = {}
-
-        if (pair[0], pair[1]) in morph_maps:
-            isotope_map = morph_maps[pair[0], pair[1]]
+            ligand, cmds = make_ligand(lig_name, ff, options, batch)
 
-        basedir = os.path.join(os.getcwd(), options[SECT_LIG]['basedir'])
-        wd1 = os.path.join(os.getcwd(), const.LIGAND_WORKDIR, pair[0])
-        wd2 = os.path.join(os.getcwd(), const.LIGAND_WORKDIR, pair[1])
+            if hasattr(ligand, 'model'):
+                batched.append( (lig_name, ligand, cmds) )
+            else:
+                workdir = os.path.join(os.getcwd(), const.LIGAND_WORKDIR,
+                                       lig_name)
+                ligands[lig_name] = MolHandle('ligand', ligand, workdir, cmds)
+        except errors.SetupError as why:
+            lig_failed.append(lig_name)
+            print('ERROR: %s failed: %s' % (lig_name, why))
 
-        with mutate.Morph(ligand1, ligand2, wd1, wd2, ff,
-                          options[SECT_DEF]['AFE.type'],
-                          options[SECT_DEF]['AFE.separate_vdw_elec'],
-                          options[SECT_DEF]['mcs.timeout'],
-                          options[SECT_DEF]['mcs.match_by'],
-                          options[SECT_DEF]['gaff']) as morph:
+    if batch:
+        engines = [ligand.mdengine for name, ligand, cmds in batched]
 
-            print ('Morphing %s to %s...' % pair)
+        try:
+            md_failed = batch.run()
+        except errors.SetupError as why:
+            md_failed = engines
+            print('ERROR: batch MD failed: %s' % why)
 
-            if (pair[1], pair[0]) in morph_pairs:
-                rev = ligand2
-            else:
-                rev = None
+        for lig_name, ligand, cmds in batched:
+            if ligand.mdengine in md_failed:
+                lig_failed.append(lig_name)
+                print('ERROR: %s failed: batch MD failed' % lig_name)
+                continue
 
             try:
-                morph.setup(cmd1, cmd2, basedir, isotope_map)
-
-                if options[SECT_LIG]['box.type']:
-                    morph.create_coords(ligand1, 'solvated', wd1,
-                                        cmd1, cmd2, rev, wd2)
+                finish_ligand(ligand, options)
+                workdir = os.path.join(os.getcwd(), const.LIGAND_WORKDIR,
+                                       lig_name)
+                ligands[lig_name] = MolHandle('ligand', ligand, workdir, cmds)
             except errors.SetupError as why:
-                morph_failed.append(morph.name)
-                print ('ERROR: %s failed: %s' % (morph.name, why))
+                lig_failed.append(lig_name)
+                print('ERROR: %s failed: %s' % (lig_name, why))
 
-            morphs.append(morph)
+        del batched, engines
 
 
-    ### complexes
+    ### ligand and complex morphs
 
+    # complexes are built on first use by a morph, the others afterwards
     complexes = {}
     com_failed = []
 
-    # NOTE: does a complex for individual ligands need to be built when
-    #       complex morphs are requested?
-    for protein in proteins.keys():
-        if proteins[protein] in prot_failed:
-            print ('WARNING: not making complex with protein %s because '
-                   'build failed' %  protein.mol_name)
-            continue
+    def build(lig_name):
+        return build_complexes(lig_name, proteins, ligands, ff, options,
+                               com_failed)
 
-        for lig_name in ligands:
-            if lig_name in lig_failed:
-                print ('WARNING: not making complex with ligand %s '
-                       'because build failed' % lig_name)
-                continue
+    if morph_pairs:
+        print('Morphs will be generated for %s' % options[SECT_DEF]['AFE.type'])
+        logger.write('Morphs will be generated for %s\n' %
+                     options[SECT_DEF]['AFE.type'])
 
-            if options[SECT_COM]['pairs']:
-                bfound = False
+        done_file = os.path.join(os.getcwd(), const.MORPH_WORKDIR,
+                                 const.MORPH_DONE_FILE)
 
-                for pair in options[SECT_COM]['pairs']:
-                    if (pair[0] == protein.mol_name and \
-                        pair[1] == lig_name) or \
-                        (pair[0] == lig_name and \
-                         pair[1] == protein.mol_name):
-                        bfound = True
-                        break
-            else:
-                bfound = True
+        if os.access(done_file, os.F_OK):
+            os.remove(done_file)
 
-            cmds = ligands[lig_name].leapcmd + proteins[protein]
+    core = ''
 
-            if bfound:
-                name = '%s:%s' % (protein.mol_name, lig_name)
+    # common core of the whole series to speed up the pairwise MCSS
+    if morph_pairs and options[SECT_DEF]['mcs.series_core']:
+        names = sorted(set(name for pair in morph_pairs for name in pair
+                           if name in ligands) )
 
-                try:
-                    complex, cmds = make_complex(protein,
-                                                 ligands[lig_name].ref,
-                                                 ff, options, cmds)
-
-                    # NOTE: no real need here to limit the list of complexes
-                    #       as it is checked again below
-                    for pair in morph_pairs:
-                        if complex.ligand.mol_name == pair[0]:
-                            complexes[complex] = cmds
-                except errors.SetupError as why:
-                    com_failed.append(name)
-                    print ('ERROR: %s failed: %s' % (name, why))
+        print('Computing common core of %i ligands...' % len(names) )
 
+        try:
+            core = mutate.series_core([ligands[name].load(ff)
+                                       for name in names],
+                                      options[SECT_DEF]['mcs.timeout'])
+        except errors.SetupError as why:
+            print('WARNING: no common core: %s' % why)
 
-    ### complex morphs
+    morph_failed = []
 
-    # FIXME: For some reason the cwd is _perturbations/type/morph for the
-    #        second morph in the loop below as if a chdir didn't take place(?).
-    #        So remember the cwd before entering create_coords()
-    cwd = os.getcwd()
+    # finished morph directories are announced as soon as they are complete
+    # so that simulations can be started while preparation continues
+    for name, dst in stream_morphs(morph_pairs, morph_maps, ligands,
+                                   complexes, build, ff, options,
+                                   morph_failed, core):
+        with open(done_file, 'a') as done:
+            done.write(dst + '\n')
 
-    for morph in morphs:
-        for complex in complexes.keys():
-            name = complex.mol_name + '/' + morph.name
+        logger.write('Morph %s finished in %s' % (name, dst) )
 
-            # FIXME: Complex has no ligand component after restart
-            if complex.ligand.mol_name == morph.initial_name:
-                print('Creating complex %s with ligand morph %s...' %
-                      (complex.mol_name, morph.name) )
 
-                #print(os.getcwd())
-                wd = os.path.join(cwd, const.COMPLEX_WORKDIR, complex.mol_name)
+    ### remaining complexes
 
-                try:
-                    morph.create_coords(complex, 'complex', wd,
-                                        complexes[complex], '')
-                except errors.SetupError as why:
-                    morph_failed.append(name)
-                    print ('ERROR: complex %s with ligand morph %s failed: %s'
-                           % (complex.mol_name, morph.name, why) )
+    # NOTE: does a complex for individual ligands need to be built when
+    #       complex morphs are requested?
+    for lig_name in ligands:
+        if lig_name not in complexes:
+            complexes[lig_name] = build(lig_name)
 
 
     ### final message